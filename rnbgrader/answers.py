@@ -8,8 +8,23 @@ import numpy as np
 from PIL import Image
 
 
+def _overrides(answer, names):
+    """ True if class of `answer` overrides any of methods `names`
+
+    Compares against the nearest base class defined in this module, so
+    subclasses here, such as :class:`RegexAnswer`, do not count.
+    """
+    klass = type(answer)
+    base = next(c for c in klass.__mro__ if c.__module__ == __name__)
+    return any(getattr(klass, name) is not getattr(base, name)
+               for name in names)
+
+
 class Answer:
 
+    # Output types the answer can give marks for, or None for any type.
+    output_types = None
+
     def __init__(self, mark, tester, *, name=None):
         self.mark = mark
         self.tester = tester
@@ -23,6 +38,28 @@ class Answer:
     def _grade(self, ev_chunk):
         return self.tester(ev_chunk)
 
+    def grade_many(self, evaluated_chunks):
+        """ Return array of marks for each chunk in `evaluated_chunks`
+
+        Marks are NaN for chunks that have not run, as for calling the
+        answer.  Subclasses can override :meth:`_grade_many` to grade the run
+        chunks together.  If a subclass overrides ``__call__``, we call the
+        answer for each chunk instead.
+        """
+        if type(self).__call__ is not Answer.__call__:
+            return np.array([self(ev_chunk) for ev_chunk in evaluated_chunks],
+                            dtype=float)
+        marks = np.full(len(evaluated_chunks), np.nan)
+        run = [i for i, ev_chunk in enumerate(evaluated_chunks)
+               if ev_chunk.results is not None]
+        if run:
+            marks[run] = self._grade_many(
+                [evaluated_chunks[i] for i in run])
+        return marks
+
+    def _grade_many(self, ev_chunks):
+        return [self._grade(ev_chunk) for ev_chunk in ev_chunks]
+
 
 class AnyAnswer(Answer):
 
@@ -36,6 +73,18 @@ class AnyAnswer(Answer):
 
 class TextAnswer(AnyAnswer):
 
+    # Methods deciding marks.  Subclasses overriding these may give marks for
+    # other output types.
+    _typed_methods = ('__call__', '_grade', 'tester', '_test')
+
+    @property
+    def output_types(self):
+        """ Output types the answer can give marks for, or None for any type
+        """
+        if _overrides(self, self._typed_methods):
+            return None
+        return frozenset(('text', 'stdout'))
+
     def __init__(self, mark, target, strip=False, *, name=None):
         self.mark = mark
         self.target = target.strip() if strip else target
@@ -52,6 +101,27 @@ class TextAnswer(AnyAnswer):
             return 0
         return self.mark if self._test(result['content']) else 0
 
+    def _grade_many(self, ev_chunks):
+        if _overrides(self, ('_grade', 'tester')):
+            return super()._grade_many(ev_chunks)
+        marks = np.zeros(len(ev_chunks))
+        if self.mark <= 0:
+            # AnyAnswer only gives marks above 0.
+            return marks
+        # Test each distinct text output once.
+        passes = {}
+        for i, ev_chunk in enumerate(ev_chunks):
+            for result in ev_chunk.results:
+                if result['type'] not in ('text', 'stdout'):
+                    continue
+                content = result['content']
+                if content not in passes:
+                    passes[content] = bool(self._test(content))
+                if passes[content]:
+                    marks[i] = self.mark
+                    break
+        return marks
+
 
 class StartTextAnswer(TextAnswer):
 
@@ -132,6 +202,17 @@ class RawRegexAnswer(RegexAnswer):
 
 class ImgAnswer(AnyAnswer):
 
+    # Methods deciding marks; see :class:`TextAnswer`.
+    _typed_methods = ('__call__', '_grade', 'tester')
+
+    @property
+    def output_types(self):
+        """ Output types the answer can give marks for, or None for any type
+        """
+        if _overrides(self, self._typed_methods):
+            return None
+        return frozenset(('image',))
+
     def __init__(self, mark, expected, crop_box=None, thresh=None, bw=False,
                 *, name=None):
         self.mark = mark
@@ -159,11 +240,59 @@ class ImgAnswer(AnyAnswer):
     def _rms(self, img):
         return np.sqrt(np.mean(np.asarray(img) ** 2))
 
+    def _cmp_images(self, images):
+        """ Return boolean array, True where image in `images` matches
+
+        Compare images with the same array shape as the expected image in one
+        stacked comparison, and others one by one.
+        """
+        this = self._cropped_expected
+        matches = np.zeros(len(images), dtype=bool)
+        if self.bw:
+            matches[:] = [self._cmp_image(image) for image in images]
+            return matches
+        this_arr = np.array(this)
+        stack_is, stack = [], []
+        for i, image in enumerate(images):
+            other = image.crop(self.crop_box)
+            if not other.size == this.size:
+                continue
+            other_arr = np.array(other)
+            if (other_arr.shape, other_arr.dtype) == (this_arr.shape,
+                                                      this_arr.dtype):
+                stack_is.append(i)
+                stack.append(other_arr)
+            else:
+                matches[i] = self._cmp_image(image)
+        if stack:
+            diffs = this_arr - np.stack(stack)
+            axes = tuple(range(1, diffs.ndim))
+            rms = np.sqrt(np.mean(diffs ** 2, axis=axes))
+            matches[stack_is] = rms < self.thresh
+        return matches
+
     def tester(self, result):
         if result['type'] != 'image':
             return 0
         return self.mark if self._cmp_image(result['content']) else 0
 
+    def _grade_many(self, ev_chunks):
+        if _overrides(self, ('_grade', 'tester', '_cmp_image')):
+            return super()._grade_many(ev_chunks)
+        marks = np.zeros(len(ev_chunks))
+        if self.mark <= 0:
+            # AnyAnswer only gives marks above 0.
+            return marks
+        chunk_is, images = [], []
+        for i, ev_chunk in enumerate(ev_chunks):
+            for result in ev_chunk.results:
+                if result['type'] == 'image':
+                    chunk_is.append(i)
+                    images.append(result['content'])
+        marks[np.array(chunk_is, dtype=int)[self._cmp_images(images)]] = (
+            self.mark)
+        return marks
+
 
 class BestOf(Answer):
 
@@ -171,9 +300,22 @@ class BestOf(Answer):
         self.answers = answers
         self.name = name
 
+    @property
+    def mark(self):
+        return max(answer.mark for answer in self.answers)
+
+    @property
+    def output_types(self):
+        types = [answer.output_types for answer in self.answers]
+        return None if None in types else frozenset().union(*types)
+
     def _grade(self, ev_chunk):
         return max([answer._grade(ev_chunk) for answer in self.answers])
 
+    def _grade_many(self, ev_chunks):
+        return np.max([answer._grade_many(ev_chunks)
+                       for answer in self.answers], axis=0)
+
 
 def make_bestof_texts(mark, texts, strip=False, *, name=None):
     return BestOf(
@@ -0,0 +1,68 @@
+""" Benchmark notebook parser engines
+
+Run with::
+
+    python -m rnbgrader.benchmarks.bench_nbparser
+"""
+
+from timeit import repeat
+from argparse import ArgumentParser
+from base64 import b64encode
+
+from rnbgrader.nbparser import RNotebook
+
+CHUNK = """\
+Some markdown text about the next chunk.
+
+```{r, echo=FALSE}
+a <- c(1, 2, 3)
+mean(a)
+```
+
+"""
+
+
+def make_notebook(n_chunks, dump_bytes=0):
+    """ Return notebook string with `n_chunks` chunks
+
+    Put an embedded image-like data dump of `dump_bytes` bytes, as base64,
+    before each chunk.
+    """
+    dump = ''
+    if dump_bytes:
+        encoded = b64encode(bytes(range(256)) * (dump_bytes // 256 + 1))
+        dump = '![img](data:image/png;base64,{})\n\n'.format(
+            encoded[:dump_bytes].decode('ascii'))
+    return (dump + CHUNK) * n_chunks
+
+
+def bench_engines(nb_str, number=5, repeats=3):
+    """ Return dict with best time in seconds for each parse engine
+    """
+    times = {}
+    for engine in ('lines', 'regex'):
+        times[engine] = min(repeat(
+            lambda: RNotebook(nb_str, engine=engine),
+            number=number,
+            repeat=repeats)) / number
+    return times
+
+
+def main(args=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=5,
+                        help='Number of parses per timing')
+    args = parser.parse_args(args)
+    print(f'{"chunks":>8} {"dump":>8} {"MB":>6} {"lines":>9} {"regex":>9}')
+    for n_chunks, dump_bytes in ((100, 0), (10_000, 0), (100, 100_000),
+                                 (1_000, 10_000)):
+        nb_str = make_notebook(n_chunks, dump_bytes)
+        chunks = RNotebook(nb_str, engine='lines').chunks
+        assert RNotebook(nb_str, engine='regex').chunks == chunks
+        times = bench_engines(nb_str, args.number)
+        print(f'{n_chunks:8d} {dump_bytes:8d} {len(nb_str) / 1e6:6.1f} '
+              f'{times["lines"]:9.4f} {times["regex"]:9.4f}')
+
+
+if __name__ == '__main__':
+    main()
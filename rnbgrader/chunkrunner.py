@@ -1,22 +1,320 @@
 """ Class to run notebooks and return report
 """
 
-from .kernels import JupyterKernel
+import os
+from os import makedirs
+from os.path import exists, join as pjoin
+from time import perf_counter
+from hashlib import sha1
+from collections import Counter
+import pickle
+
+import pandas as pd
+
+from .kernels import JupyterKernel, AsyncJupyterKernel
 
 
 class EvaluatedChunk:
 
-    def __init__(self, chunk, results=None):
+    # Resource use running chunk; None if not run, or not available.
+    wall_time = None
+    cpu_time = None
+    peak_rss = None
+    # True if results came from a :class:`ChunkCache`.
+    cached = False
+    # True if results came from a :class:`ChunkJournal`.
+    resumed = False
+
+    def __init__(self, chunk, results=None, wall_time=None, cpu_time=None,
+                 peak_rss=None):
+        """ Initialize evaluated chunk
+
+        Parameters
+        ----------
+        chunk : chunk instance
+            Notebook code chunk.
+        results : None or sequence, optional
+            Outputs from running chunk, or None if chunk was not run.
+        wall_time : None or float, optional
+            Seconds of elapsed time running chunk.
+        cpu_time : None or float, optional
+            Seconds of kernel CPU time running chunk.
+        peak_rss : None or int, optional
+            Peak resident memory of kernel, in bytes, while running chunk.
+        """
         self.chunk = chunk
         self.results = results
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        # Resource use varies between runs; compare chunk and results.
+        return (self.chunk, self.results) == (other.chunk, other.results)
+
+
+class ChunkCache:
+    """ Cache of chunk outputs, shared across notebooks
+
+    The key for a chunk is a hash of the kernel name and the code of all
+    chunks up to and including this one.  Notebooks starting with the same
+    chunks, such as chunks from a template, can then share outputs for these
+    chunks.
+
+    Only use the cache for chunks where the outputs and the kernel state
+    depend only on the code so far, and not, for example, on random numbers,
+    the time, or changing files.  Cache keys stop at the first chunk that is
+    not deterministic in this sense.
+
+    Caching is opt-in.  By default, we only reuse outputs for chunks with
+    the knitr option ``cache=TRUE``.  Pass `cacheable` to choose other
+    chunks, for example ``cacheable=lambda chunk: True`` for all chunks.
+
+    Cache hits still run the code in the kernel.  The cache stores outputs,
+    not kernel state, so we run the code for cached chunks, silently and in
+    batches, before the next chunk that needs the kernel, so later chunks see
+    the state they expect.  A cache hit saves fetching and processing the
+    outputs, but saves no kernel time for slow chunks, unless they are at the
+    end of the notebook, and `restore_state` is False.
+    """
+
+    def __init__(self, cache_dir=None, deterministic=None,
+                 restore_state=True, cacheable=None):
+        """ Initialize chunk cache
+
+        Parameters
+        ----------
+        cache_dir : None or str, optional
+            Directory in which to store cached outputs.  None means keep
+            cached outputs in memory only.
+        deterministic : None or callable, optional
+            Callable accepting a chunk, and returning True if the chunk is
+            deterministic (see above).  None means treat all chunks as
+            deterministic for the cache keys; `cacheable` decides which
+            chunks reuse outputs.
+        restore_state : {True, False}, optional
+            If True, when all remaining chunks come from the cache, run the
+            cached chunks in the kernel at the end of the notebook, so the
+            kernel state is as if we had run all chunks.  Set to False if you
+            will not use the kernel after running the chunks.
+        cacheable : None or callable, optional
+            Callable accepting a chunk, and returning True if we should get
+            and store outputs for this chunk.  Chunks that are not cacheable
+            still extend the cache keys for later chunks.  None means chunks
+            with the knitr option ``cache=TRUE`` are cacheable.
+        """
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not exists(cache_dir):
+            makedirs(cache_dir)
+        self.deterministic = ((lambda chunk: True) if deterministic is None
+                              else deterministic)
+        self.restore_state = restore_state
+        self.cacheable = ((lambda chunk: chunk.is_cached) if cacheable is None
+                          else cacheable)
+        self._store = {}
+        self.hits = 0
+        self.misses = 0
+
+    def start_key(self, kernel_name, setup_code=None):
+        """ Return key for empty sequence of chunks in kernel `kernel_name`
+
+        `setup_code`, if not None, is code run in the kernel before the
+        chunks.
+        """
+        start = (kernel_name if setup_code is None
+                 else f'{kernel_name}\0{setup_code}')
+        return sha1(start.encode('utf8')).hexdigest()
+
+    def extend_key(self, key, chunk):
+        """ Return key for chunks giving `key`, followed by `chunk`
+        """
+        return sha1(f'{key}\0{chunk.content_hash}'.encode('ascii')
+                   ).hexdigest()
+
+    def iter_keys(self, chunks, kernel_name):
+        """ Yield keys for deterministic chunks at start of `chunks`
+        """
+        key = self.start_key(kernel_name)
+        for chunk in chunks:
+            if not self.deterministic(chunk):
+                return
+            key = self.extend_key(key, chunk)
+            yield key
+
+    def _fname(self, key):
+        return pjoin(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """ Return outputs for `key`, or None if not in cache """
+        if key in self._store:
+            self.hits += 1
+            return self._store[key]
+        if self.cache_dir is not None and exists(self._fname(key)):
+            with open(self._fname(key), 'rb') as fobj:
+                self._store[key] = pickle.load(fobj)
+            self.hits += 1
+            return self._store[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, outputs):
+        """ Store `outputs` for `key` """
+        self._store[key] = outputs
+        if self.cache_dir is not None:
+            with open(self._fname(key), 'wb') as fobj:
+                pickle.dump(outputs, fobj)
+
+    def prefix_report(self, chunk_sequences, kernel_name='ir'):
+        """ Report chunk prefixes shared between notebooks
+
+        Use as a pre-flight check, to see how much a cohort of notebooks
+        could share cached outputs.
+
+        Parameters
+        ----------
+        chunk_sequences : sequence
+            Sequence where elements are sequences of chunks, one element per
+            notebook.
+        kernel_name : str, optional
+            Kernel name for cache keys.
+
+        Returns
+        -------
+        report : DataFrame
+            One row for each sequence of starting chunks shared by more than
+            one notebook, with columns "depth" (number of chunks),
+            "n_notebooks" (number of notebooks sharing these chunks), and
+            "code" (the code of the last chunk).
+        """
+        counts = Counter()
+        codes = {}
+        for chunks in chunk_sequences:
+            for depth, (chunk, key) in enumerate(
+                zip(chunks, self.iter_keys(chunks, kernel_name))):
+                counts[key] += 1
+                codes[key] = (depth + 1, chunk.code)
+        rows = [(codes[key][0], count, codes[key][1])
+                for key, count in counts.items() if count > 1]
+        return pd.DataFrame(rows, columns=['depth', 'n_notebooks', 'code']
+                           ).sort_values(['depth', 'n_notebooks'],
+                                         ascending=[True, False],
+                                         ignore_index=True)
+
+
+class ChunkJournal:
+    """ On-disk journal of evaluated chunks, for resuming interrupted runs
+
+    The runner appends each :class:`EvaluatedChunk` to the journal for the
+    notebook as it finishes, writing and syncing each record before going on
+    to the next chunk.  If the grading process or the kernel dies, a new run
+    of the same notebook reloads the finished chunks, and continues from the
+    chunk that was running when the previous run died.
+
+    The key for a notebook is a hash of the kernel name and the code and
+    header options of all its chunks, so the journal for a notebook lapses
+    when the notebook changes.
+    """
+
+    def __init__(self, journal_dir, restore_state=True):
+        """ Initialize chunk journal
+
+        Parameters
+        ----------
+        journal_dir : str
+            Directory in which to store journals.
+        restore_state : {True, False}, optional
+            If True, run reloaded chunks silently in the kernel, before
+            running the next chunk, or at the end of the notebook, so the
+            kernel state is as if we had run all chunks.  Set to False if you
+            will not use the kernel after a fully reloaded notebook.
+        """
+        self.journal_dir = journal_dir
+        if not exists(journal_dir):
+            makedirs(journal_dir)
+        self.restore_state = restore_state
+
+    def key(self, chunks, kernel_name):
+        """ Return journal key for `chunks` run in kernel `kernel_name` """
+        hasher = sha1(kernel_name.encode('utf8'))
+        for chunk in chunks:
+            options = chunk.options.encode('utf8')
+            hasher.update(b'\0%s\0%d\0%s' % (
+                chunk.content_hash.encode('ascii'), len(options), options))
+        return hasher.hexdigest()
+
+    def _fname(self, key):
+        return pjoin(self.journal_dir, key + '.journal')
+
+    def load(self, key):
+        """ Load journal for `key`
+
+        Returns
+        -------
+        ev_chunks : list of :class:`EvaluatedChunk`
+            Evaluated chunks finished in order from the first chunk.
+        died_at : None or int
+            Index of chunk that was running when the run stopped, or None if
+            there was no chunk running.
+        finished : bool
+            True if the journal records a finished run.
+        """
+        done, started, finished = {}, None, False
+        if exists(self._fname(key)):
+            with open(self._fname(key), 'rb') as fobj:
+                for record in _iter_records(fobj):
+                    if record[0] == 'start':
+                        started = record[1]
+                    elif record[0] == 'done':
+                        done[record[1]] = record[2]
+                        started = None
+                    elif record[0] == 'finish':
+                        finished = True
+        ev_chunks = []
+        while len(ev_chunks) in done:
+            ev_chunks.append(done[len(ev_chunks)])
+        return ev_chunks, started, finished
+
+    def _append(self, key, record):
+        with open(self._fname(key), 'ab') as fobj:
+            pickle.dump(record, fobj)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+    def start(self, key, index):
+        """ Record that chunk at `index` has started running """
+        self._append(key, ('start', index))
+
+    def add(self, key, index, ev_chunk):
+        """ Record :class:`EvaluatedChunk` `ev_chunk` for chunk at `index` """
+        self._append(key, ('done', index, ev_chunk))
+
+    def finish(self, key):
+        """ Record that run has finished """
+        self._append(key, ('finish',))
+
+    def clear(self, key):
+        """ Delete journal for `key` """
+        if exists(self._fname(key)):
+            os.unlink(self._fname(key))
+
+
+def _iter_records(fobj):
+    """ Yield pickled records from `fobj`, stopping at a truncated record
+    """
+    while True:
+        try:
+            yield pickle.load(fobj)
+        except (EOFError, pickle.UnpicklingError):
+            return
 
 
 class ChunkRunner(object):
 
-    def __init__(self, chunks, kernel='ir', stop_on_error=True):
+    kernel_cls = JupyterKernel
+
+    def __init__(self, chunks, kernel='ir', stop_on_error=True,
+                 pipeline=False, cache=None, lazy=False, journal=None,
+                 skip=(), setup_code=None):
         """ Initialize notebook runner
 
         Parameters
@@ -27,22 +325,83 @@ class ChunkRunner(object):
             Can be string giving kernel name, or kernel instance.
         stop_on_error : {True, False}, optional
             Whether to stop evaluating chunks at first error.
+        pipeline : {False, True}, optional
+            If True, send all chunks to the kernel at once, rather than
+            waiting for each chunk to finish before sending the next.  With
+            `stop_on_error`, the kernel aborts the chunks after the first
+            error.  The kernel must implement ``run_codes``.  Pipelined
+            chunks have no per-chunk time or resource use.
+        cache : None or :class:`ChunkCache`, optional
+            If not None, take outputs for chunks from this cache where
+            possible, and store outputs for new chunks.  We still run the
+            cached chunks in the kernel, silently, as one batch, before we
+            next need to run a chunk in the kernel.  Cannot be used with `pipeline`.
+        lazy : {False, True}, optional
+            If False, run all chunks now.  If True, run chunks on demand, as
+            :meth:`iter_results` asks for them, or when asking for
+            :attr:`results`, :attr:`outcome` or :attr:`message`.
+        journal : None or :class:`ChunkJournal`, optional
+            If not None, record each evaluated chunk in this journal as it
+            finishes, and start by reloading chunks that a previous run of
+            these chunks finished.  Cannot be used with `pipeline`.
+        skip : sequence of int, optional
+            Indices of chunks not to run.  These chunks have results of None.
+            We also do not run chunks with knitr option ``eval=FALSE``.
+        setup_code : None or str, optional
+            Code already run in the kernel before the chunks, for example by
+            :meth:`rnbgrader.grader.NBRunner.pre_run`.  If not None, the
+            cache keys for the chunks depend on this code.
 
         Attributes
         ----------
         chunks : as above
         stop_on_error : as above
+        pipeline : as above
+        cache : as above
+        lazy : as above
+        journal : as above
+        skip : as above
+        setup_code : as above
+        n_resumed : int
+            Number of chunks reloaded from the journal in the last run.
+        died_at : None or int
+            Index of the chunk that was running when a previous run, recorded
+            in the journal, died.  None if no previous run died.
         results : sequence of EvaluatedChunk, property
         outcome : {'ok', 'error'}, property
         messages : None or str, property
+        wall_time : None or float, property
+        cpu_time : None or float, property
+        peak_rss : None or int, property
         """
+        self._init_state(chunks, kernel, stop_on_error, pipeline, cache,
+                         lazy, journal, skip, setup_code)
+        if not lazy:
+            self._execute()
+
+    def _init_state(self, chunks, kernel='ir', stop_on_error=True,
+                    pipeline=False, cache=None, lazy=False, journal=None,
+                    skip=(), setup_code=None):
+        """ Set attributes from parameters; see :meth:`__init__` """
+        if pipeline and cache is not None:
+            raise ValueError('Cannot use cache with pipeline')
+        if pipeline and journal is not None:
+            raise ValueError('Cannot use journal with pipeline')
         self.chunks = chunks
         self._init_kernel(kernel)
         self.stop_on_error = stop_on_error
+        self.pipeline = pipeline
+        self.cache = cache
+        self.lazy = lazy
+        self.journal = journal
+        self.skip = frozenset(skip)
+        self.setup_code = setup_code
+        self.n_resumed = 0
+        self.died_at = None
         self._results = None
         self._outcome = None
         self._message = None
-        self._execute()
+        self._run_gen = None
 
     def __del__(self):
         if self._own_kernel:
@@ -62,17 +421,23 @@ class ChunkRunner(object):
 
     def _init_kernel(self, kernel):
         self._own_kernel = not hasattr(kernel, 'run_code')
-        self._kernel = JupyterKernel(kernel) if self._own_kernel else kernel
+        self._kernel = self.kernel_cls(kernel) if self._own_kernel else kernel
+
+    def _ensure_run(self):
+        if self.lazy and self._results is None:
+            self._execute()
 
     @property
     def results(self):
         """ Sequence of :class:`EvaluatedChunk` """
+        self._ensure_run()
         return self._results
 
     @property
     def outcome(self):
         """ 'ok' if all chunks evaluated without error, 'error' otherwise.
         """
+        self._ensure_run()
         return self._outcome
 
     @property
@@ -81,14 +446,109 @@ class ChunkRunner(object):
 
         String contains all error messages, if `stop_if_error` is False.
         """
+        self._ensure_run()
         return self._message
 
+    def _sum_usage(self, name):
+        values = [getattr(r, name) for r in self._results or ()]
+        values = [v for v in values if v is not None]
+        return sum(values) if values else None
+
+    @property
+    def wall_time(self):
+        """ Total seconds of elapsed time running chunks """
+        return self._sum_usage('wall_time')
+
+    @property
+    def cpu_time(self):
+        """ Total seconds of kernel CPU time running chunks
+
+        None if kernel CPU time not available.
+        """
+        return self._sum_usage('cpu_time')
+
+    @property
+    def peak_rss(self):
+        """ Maximum peak kernel resident memory in bytes over all chunks
+
+        None if kernel memory use not available.
+        """
+        values = [r.peak_rss for r in self._results or ()
+                  if r.peak_rss is not None]
+        return max(values) if values else None
+
     def _report_errors(self, chunk, errors):
         return 'Errors for chunk at line no {}:\n----{}\n---\n{}\n'.format(
             chunk.start_line + 1,
             chunk.code,
             'Error:\n{}'.join(e['content'] for e in errors))
 
+    def iter_results(self):
+        """ Yield :class:`EvaluatedChunk` for each chunk, running as needed
+
+        Yield results already run first, then run remaining chunks, yielding
+        each result as it finishes.  If you stop iterating early, the next
+        call to this method continues where the last stopped.  Call
+        :meth:`stop` to finish without running the remaining chunks.
+
+        In pipeline mode, we run all chunks before yielding the first.
+        """
+        if self._results is not None:
+            yield from self._results
+            return
+        if self._run_gen is None:
+            self._start_run()
+            self._run_gen = self._iter_run()
+        yield from list(self._run_results)
+        # Not "yield from", because closing this generator would then close
+        # the run generator, and we could not resume.
+        for ev_chunk in self._run_gen:
+            yield ev_chunk
+
+    def stop(self):
+        """ Finish run, recording remaining chunks as not run
+
+        The journal only records the chunks that did run, and does not
+        record a finished run, so a later full run runs the remaining chunks.
+        """
+        if self._results is not None:
+            return
+        if self._run_gen is None:
+            self._start_run()
+        self._run_gen = None
+        for chunk in self.chunks[len(self._run_results):]:
+            self._run_results.append(EvaluatedChunk(chunk))
+        if self._restore_state():
+            self._run_deferred()
+        self._finish_run(complete=False)
+
+    def run_chunks(self, indices):
+        """ Run chunks at `indices` that a stopped run did not run
+
+        Use after :meth:`stop`, to run chunks that later code needs.  We run
+        the chunks in order, replacing their results, and updating
+        :attr:`outcome` and :attr:`message`.  With `stop_on_error`, we do not
+        run chunks after an error.
+
+        Parameters
+        ----------
+        indices : sequence of int
+            Indices of chunks to run.
+        """
+        if self._results is None:
+            raise RuntimeError('Call stop before running more chunks')
+        self._run_deferred()
+        for i in sorted(indices):
+            if self._any_error and self.stop_on_error:
+                break
+            chunk = self.chunks[i]
+            self._start_usage()
+            outputs = self._kernel.run_code(chunk.code,
+                                            stop_on_error=self.stop_on_error)
+            self._add_result(chunk, outputs, **self._end_usage())
+            self._run_results[i] = self._run_results.pop()
+        self._finish_run(complete=False)
+
     def _execute(self, force=False):
         """ Execute code chunks, filling results
 
@@ -100,21 +560,274 @@ class ChunkRunner(object):
         """
         if not force and self._results is not None:
             return
-        results = []
-        any_error = False
-        messages = []
-        for chunk in self.chunks:
-            if any_error and self.stop_on_error:
-                results.append(EvaluatedChunk(chunk))
+        if force:
+            self._results = None
+            self._run_gen = None
+            if self.journal is not None:
+                self.journal.clear(self._journal_key())
+        for ev_chunk in self.iter_results():
+            pass
+
+    def _iter_run(self):
+        """ Run chunks, yielding each result, finally filling results
+        """
+        if self.pipeline:
+            self._execute_pipelined()
+            yield from list(self._run_results)
+        else:
+            for i, chunk in enumerate(self.chunks):
+                if self._from_journal(i):
+                    yield self._run_results[-1]
+                    continue
+                if not (self._skip_chunk(chunk, i) or
+                        self._from_cache(chunk)):
+                    self._run_deferred()
+                    if self.journal is not None:
+                        self.journal.start(self._jkey, i)
+                    self._start_usage()
+                    outputs = self._kernel.run_code(
+                        chunk.code,
+                        stop_on_error=self.stop_on_error)
+                    self._add_result(chunk, outputs, **self._end_usage())
+                    self._to_cache(outputs)
+                self._to_journal()
+                yield self._run_results[-1]
+            if self._restore_state():
+                self._run_deferred()
+        self._run_gen = None
+        self._finish_run()
+
+    def _from_cache(self, chunk):
+        """ Add result for `chunk` from cache, return True if found
+
+        Set key for storing outputs, if not found.
+        """
+        self._miss_key = None
+        self._advance_cache_key(chunk)
+        if self._cache_key is None or not self.cache.cacheable(chunk):
+            return False
+        outputs = self.cache.get(self._cache_key)
+        if outputs is None:
+            self._miss_key = self._cache_key
+            return False
+        self._add_result(chunk, outputs)
+        self._run_results[-1].cached = True
+        self._deferred.append(
+            (chunk, any(p['type'] == 'error' for p in outputs)))
+        return True
+
+    def _advance_cache_key(self, chunk):
+        """ Extend cache key with `chunk`, or end keys at `chunk` """
+        if self._cache_key is None:
+            return
+        self._cache_key = (self.cache.extend_key(self._cache_key, chunk)
+                           if self.cache.deterministic(chunk) else None)
+
+    def _to_cache(self, outputs):
+        if self._miss_key is not None:
+            self.cache.put(self._miss_key, outputs)
+
+    def _journal_key(self):
+        return self.journal.key(self.chunks, self._kernel_name())
+
+    def _from_journal(self, index):
+        """ Add result for chunk at `index` from journal, return True if found
+        """
+        if index >= len(self._journaled):
+            return False
+        ev_chunk = self._journaled[index]
+        ev_chunk.resumed = True
+        self._advance_cache_key(ev_chunk.chunk)
+        self._add_evaluated(ev_chunk)
+        if ev_chunk.results is not None:
+            self._deferred.append(
+                (ev_chunk.chunk,
+                 any(p['type'] == 'error' for p in ev_chunk.results)))
+        return True
+
+    def _to_journal(self):
+        """ Record last result in journal, if using journal """
+        if self.journal is not None:
+            self.journal.add(self._jkey, len(self._run_results) - 1,
+                             self._run_results[-1])
+
+    def _restore_state(self):
+        """ True if we should run deferred chunks at end of run """
+        return any(source is not None and source.restore_state
+                   for source in (self.cache, self.journal))
+
+    def _run_deferred(self):
+        """ Run code for cached chunks, to set kernel state
+
+        Run cached chunks silently, in batches ending at chunks that gave an
+        error.
+        """
+        batch = []
+        for chunk, had_error in self._deferred:
+            batch.append(chunk.code if chunk.code.endswith('\n')
+                         else chunk.code + '\n')
+            if had_error:
+                self._run_silent(''.join(batch))
+                batch = []
+        if batch:
+            self._run_silent(''.join(batch))
+        self._deferred = []
+
+    def _run_silent(self, code):
+        self._kernel.run_code(code, silent=True,
+                              stop_on_error=self.stop_on_error)
+
+    def _execute_pipelined(self):
+        """ Queue all chunks in kernel, then fill results from replies
+        """
+        to_run = [i for i, chunk in enumerate(self.chunks)
+                  if i not in self.skip and chunk.is_evaluated]
+        all_outputs = dict(zip(to_run, self._kernel.run_codes(
+            [self.chunks[i].code for i in to_run],
+            stop_on_error=self.stop_on_error)))
+        for i, chunk in enumerate(self.chunks):
+            if self._skip_chunk(chunk, i):
                 continue
-            outputs = self._kernel.run_code(
-                chunk.code,
-                stop_on_error=self.stop_on_error)
-            results.append(EvaluatedChunk(chunk, outputs))
-            errors = [p for p in outputs if p['type'] == 'error']
-            if len(errors) != 0:
-                messages.append(self._report_errors(chunk, errors))
-                any_error = True
-        self._results = tuple(results)
-        self._outcome = "error" if any_error else 'ok'
+            outputs = all_outputs[i]
+            if outputs is None:  # Aborted by kernel.
+                self._run_results.append(EvaluatedChunk(chunk))
+                continue
+            self._add_result(chunk, outputs)
+
+    def _kernel_usage(self, reset_peak=False):
+        get_usage = getattr(self._kernel, 'resource_usage', None)
+        return (None, None) if get_usage is None else get_usage(reset_peak)
+
+    def _start_usage(self):
+        """ Record starting time and kernel resource use for chunk """
+        self._usage0 = perf_counter(), self._kernel_usage(reset_peak=True)[0]
+
+    def _end_usage(self):
+        """ Return time and kernel resource use since :meth:`_start_usage`
+        """
+        t0, cpu0 = self._usage0
+        wall_time = perf_counter() - t0
+        cpu1, peak_rss = self._kernel_usage()
+        cpu_time = None if None in (cpu0, cpu1) else cpu1 - cpu0
+        return dict(wall_time=wall_time, cpu_time=cpu_time,
+                    peak_rss=peak_rss)
+
+    def _start_run(self):
+        self._run_results = []
+        self._run_messages = []
+        self._any_error = False
+        self._deferred = []
+        self._miss_key = None
+        self._cache_key = (None if self.cache is None else
+                           self.cache.start_key(self._kernel_name(),
+                                                self.setup_code))
+        self._journaled = []
+        self.died_at = None
+        if self.journal is not None:
+            self._jkey = self._journal_key()
+            self._journaled, self.died_at, _ = self.journal.load(self._jkey)
+        self.n_resumed = len(self._journaled)
+
+    def _kernel_name(self):
+        return getattr(self._kernel, 'kernel_name', type(self._kernel).__name__)
+
+    def _skip_chunk(self, chunk, index):
+        """ Record empty result and return True if we should not run `chunk`
+
+        `index` is the index of `chunk` in the chunks.  Chunks with knitr
+        option ``eval=FALSE`` do not change the kernel state, so they do not
+        change the cache key.
+        """
+        if index in self.skip:
+            # Later chunks no longer have the same code before them.
+            self._cache_key = None
+        elif chunk.is_evaluated and not (self._any_error and
+                                         self.stop_on_error):
+            return False
+        self._run_results.append(EvaluatedChunk(chunk))
+        return True
+
+    def _add_result(self, chunk, outputs, **usage):
+        self._add_evaluated(EvaluatedChunk(chunk, outputs, **usage))
+
+    def _add_evaluated(self, ev_chunk):
+        self._run_results.append(ev_chunk)
+        if ev_chunk.results is None:
+            return
+        errors = [p for p in ev_chunk.results if p['type'] == 'error']
+        if len(errors) != 0:
+            self._run_messages.append(
+                self._report_errors(ev_chunk.chunk, errors))
+            self._any_error = True
+
+    def _finish_run(self, complete=True):
+        if complete and self.journal is not None:
+            self.journal.finish(self._jkey)
+        messages = self._run_messages
+        self._results = tuple(self._run_results)
+        self._outcome = "error" if self._any_error else 'ok'
         self._message = '\n\n'.join(messages) if len(messages) > 0 else None
+
+
+class AsyncChunkRunner(ChunkRunner):
+    """ Chunk runner for :class:`AsyncJupyterKernel` kernels
+
+    Unlike :class:`ChunkRunner`, initializing the runner does not run the
+    chunks; run them with ``await runner.execute()``.  One event loop can run
+    many of these runners at the same time, for example with
+    ``asyncio.gather``.
+    """
+
+    kernel_cls = AsyncJupyterKernel
+
+    def __init__(self, chunks, kernel='ir', stop_on_error=True):
+        """ Initialize async notebook runner
+
+        Parameters
+        ----------
+        chunks : sequence of chunks
+            Sequence of notebook code chunk instances.
+        kernel : string or kernel instance, optional
+            Can be string giving kernel name, or :class:`AsyncJupyterKernel`
+            instance.  If a string, we start the kernel at the beginning of
+            :meth:`execute`, and shut it down at the end.
+        stop_on_error : {True, False}, optional
+            Whether to stop evaluating chunks at first error.
+        """
+        self._init_state(chunks, kernel, stop_on_error)
+
+    def __del__(self):
+        pass
+
+    async def execute(self, force=False):
+        """ Execute code chunks, filling and returning results
+
+        Parameters
+        ----------
+        force : {False, True}
+            If False, and the results are already present, return without
+            action. Otherwise, rerun the chunks and fill the results.
+
+        Returns
+        -------
+        results : tuple of :class:`EvaluatedChunk`
+        """
+        if not force and self._results is not None:
+            return self._results
+        if self._own_kernel:
+            await self._kernel.start()
+        try:
+            self._start_run()
+            for i, chunk in enumerate(self.chunks):
+                if self._skip_chunk(chunk, i):
+                    continue
+                self._start_usage()
+                outputs = await self._kernel.run_code(
+                    chunk.code,
+                    stop_on_error=self.stop_on_error)
+                self._add_result(chunk, outputs, **self._end_usage())
+            self._finish_run()
+        finally:
+            if self._own_kernel:
+                await self._kernel.shutdown()
+        return self._results
@@ -10,19 +10,22 @@ from glob import glob
 from collections import defaultdict
 from hashlib import sha1
 from tempfile import TemporaryDirectory
-import re
+from contextlib import contextmanager
 
 import pandas as pd
 
 from rnbgrader import load as nb_load, JupyterKernel, ChunkRunner
-from rnbgrader.grids import full_grid, max_multi
+from rnbgrader.nbparser import MARK_MARKUP_RE
+from rnbgrader.kernels import KernelPool
+from rnbgrader.chunkrunner import ChunkCache
+from rnbgrader.rdeps import dead_chunks, dead_chunk_report, needed_chunks
+from rnbgrader.grids import (full_grid, max_multi, MaxMultiTracker,
+                             CohortGrid)
 from rnbgrader.answers import ImgAnswer
 
 
 OPTIONAL_PROMPT = r'^\s*(?:\[\d+\] )?'
 
-MARK_MARKUP_RE = re.compile(r'^\s*#\s*M\s*:\s*([-+]?[.0-9]+)\s*$', re.M)
-
 
 class NotebookError(Exception):
     """ Error running notebook """
@@ -31,6 +34,23 @@ class NotebookError(Exception):
 class NBRunner:
 
     chunk_cls = ChunkRunner
+    # Set to :class:`ChunkCache` instance to share chunk outputs across
+    # notebooks.  Cached chunks still run in the kernel.
+    chunk_cache = None
+    # Set to :class:`ChunkJournal` instance to record evaluated chunks as they
+    # finish, and resume interrupted runs.
+    chunk_journal = None
+    # If True, do not run chunks that show no output, and define nothing later
+    # chunks use.  See :mod:`rnbgrader.rdeps`.
+    skip_dead_chunks = False
+    # Report of dead chunks from last :meth:`find_dead_chunks`.
+    skip_report = None
+    # Set to :class:`rnbgrader.nbparser.NotebookCache` instance, such as
+    # ``rnbgrader.nbparser.NOTEBOOK_CACHE``, to share parsed notebooks
+    # between grading stages.  Notebooks from the cache share their chunks,
+    # so :meth:`process_chunks` must not modify chunks in place.  None means
+    # parse notebooks each time.
+    notebook_cache = None
 
     def process_chunks(self, chunks):
         """ Process chunks
@@ -39,14 +59,43 @@ class NBRunner:
         -----
         You can use this function to process chunks you don't want to run, or
         want to modify.  For example, you might want to swap out a chunk that
-        downloads data from a URL, replacing with a local load.
+        downloads data from a URL, replacing with a local load.  If using
+        ``notebook_cache``, the chunks come from the notebook cache, so
+        replace chunks, rather than modifying them in place.
         """
         return chunks
 
+    def load_notebook(self, fileish):
+        """ Return parsed notebook for `fileish`, using notebook cache """
+        if self.notebook_cache is None:
+            return nb_load(fileish, keep_str=False)
+        return self.notebook_cache.load(fileish)
+
     def get_chunks(self, fileish):
-        nb = nb_load(fileish)
+        nb = self.load_notebook(fileish)
         return self.process_chunks(nb.chunks)
 
+    def keep_chunk(self, chunk):
+        """ Return True if we must run `chunk`, even if it appears dead
+
+        Notes
+        -----
+        Override to keep chunks that :func:`rnbgrader.rdeps.dead_chunks`
+        would skip, when using ``skip_dead_chunks``.
+        """
+        return False
+
+    def find_dead_chunks(self, chunks):
+        """ Return indices of `chunks` we need not run
+
+        Set ``skip_report`` to report the dead chunks.  We keep the dead
+        chunks in the chunks to run, so chunk numbers stay the same, but the
+        evaluated dead chunks have results of None.
+        """
+        dead = dead_chunks(chunks, self.keep_chunk)
+        self.skip_report = dead_chunk_report(chunks, dead)
+        return dead
+
     def pre_run(self, rk):
         """ Run pre-loading etc code.
 
@@ -54,7 +103,9 @@ class NBRunner:
         -----
         You can use this function to run code to initialize the notebook.
         Examples might be setting variables used in marking, or redefining
-        functions to restrict complexity or disable them.
+        functions to restrict complexity or disable them.  When using
+        ``chunk_cache``, the code that this method runs with ``rk.run_code``
+        becomes part of the cache keys.
         """
         pass
 
@@ -68,10 +119,45 @@ class NBRunner:
         """
         pass
 
-    def run(self, fileish, rk):
+    def run(self, fileish, rk, stop_check=None, keep_chunk=None):
+        """ Run notebook `fileish` in kernel `rk`, return evaluated chunks
+
+        Parameters
+        ----------
+        fileish : str or file-like
+            Filename or file-like object implementing ``read``.
+        rk : kernel
+            Kernel in which to run chunks.
+        stop_check : None or callable, optional
+            If not None, callable accepting an evaluated chunk, and returning
+            True if we can stop running the notebook after this chunk.
+            Chunks after stopping have results of None, unless `keep_chunk`
+            says we should run them.
+        keep_chunk : None or callable, optional
+            If not None, callable accepting a chunk, and returning True if we
+            should still run the chunk after `stop_check` returned True.  We
+            also run the chunks these chunks need; see
+            :func:`rnbgrader.rdeps.needed_chunks`.
+        """
         chunks = self.get_chunks(fileish)
-        self.pre_run(rk)
-        runner = self.chunk_cls(chunks, rk)
+        kwargs = {}
+        if self.chunk_cache is None:
+            self.pre_run(rk)
+        else:
+            # Outputs depend on the pre-run code, so it goes in the cache key.
+            recorder = _CodeRecorder(rk)
+            self.pre_run(recorder)
+            kwargs['cache'] = self.chunk_cache
+            kwargs['setup_code'] = '\0'.join(recorder.codes)
+        if self.chunk_journal is not None:
+            kwargs['journal'] = self.chunk_journal
+        if self.skip_dead_chunks:
+            kwargs['skip'] = self.find_dead_chunks(chunks)
+        if stop_check is None:
+            runner = self.chunk_cls(chunks, rk, **kwargs)
+        else:
+            runner = self.chunk_cls(chunks, rk, lazy=True, **kwargs)
+            self._run_until(runner, stop_check, keep_chunk)
         results = runner.results
         if runner.outcome != 'ok':
             raise NotebookError(
@@ -79,6 +165,43 @@ class NBRunner:
         self.post_run(rk)
         return results
 
+    def _run_until(self, runner, stop_check, keep_chunk):
+        """ Run chunks until `stop_check` returns True, then run kept chunks
+        """
+        for ev_chunk in runner.iter_results():
+            if stop_check(ev_chunk):
+                break
+        runner.stop()
+        if keep_chunk is None or runner.outcome != 'ok':
+            return
+        chunks = [ev_chunk.chunk for ev_chunk in runner.results]
+        not_run = [i for i, ev_chunk in enumerate(runner.results)
+                   if ev_chunk.results is None and ev_chunk.chunk.is_evaluated]
+        kept = [i for i in not_run if keep_chunk(chunks[i])]
+        if kept:
+            # Also run chunks defining symbols that kept chunks use.
+            runner.run_chunks(needed_chunks(chunks, kept, not_run))
+
+
+class _CodeRecorder:
+    """ Kernel wrapper recording code run with ``run_code`` or ``run_codes``
+    """
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        self.codes = []
+
+    def run_code(self, code, *args, **kwargs):
+        self.codes.append(code)
+        return self._kernel.run_code(code, *args, **kwargs)
+
+    def run_codes(self, codes, *args, **kwargs):
+        self.codes.extend(codes)
+        return self._kernel.run_codes(codes, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._kernel, name)
+
 
 def get_fname(fileish):
     """ Return filename from `fileish`
@@ -123,7 +246,7 @@ def _read_reset(fobj):
 class CachedBuiltNotebook:
 
     def __init__(self, notebook_fileish, runner, cache_dir=None,
-                 timeout=30):
+                 timeout=30, keep_messages=True):
         """ Initialize cached, built notebook object
 
         Parameters
@@ -137,6 +260,9 @@ class CachedBuiltNotebook:
             directory.
         timeout : int, optional
             Timeout for running individual cells.
+        keep_messages : {True, False}, optional
+            If False, do not keep raw Jupyter messages in the solution
+            outputs.
         """
         if hasattr(notebook_fileish, 'read'):  # file object.
             self.notebook_text = _read_reset(notebook_fileish)
@@ -152,6 +278,7 @@ class CachedBuiltNotebook:
             cache_dir = self._tmp.name
         self.out_dir = pjoin(abspath(cache_dir), self._nb_froot + '.built')
         self.timeout = timeout
+        self.keep_messages = keep_messages
         self.pkl_fname = pjoin(self.out_dir, 'solution.pkl')
         self._solution = None
 
@@ -171,7 +298,8 @@ class CachedBuiltNotebook:
         # Rebuild solution notebooks
         if not isdir(self.out_dir):
             makedirs(self.out_dir)
-        with JupyterKernel('ir', timeout=self.timeout) as rk:
+        with JupyterKernel('ir', timeout=self.timeout,
+                           keep_messages=self.keep_messages) as rk:
             solution = self.runner.run(StringIO(self.notebook_text), rk)
         self._store_solution(solution)
         return solution
@@ -195,11 +323,22 @@ class Grader:
     cacher = CachedBuiltNotebook
     run_maker = NBRunner
     total = 100
+    # Number of pre-started kernels to use when grading many notebooks.  0
+    # means start a fresh kernel for each notebook.
+    pool_size = 0
+    # If True, stop running a notebook once all answers have their maximum
+    # marks.  See :meth:`adjustment_chunk`.
+    early_exit = False
+    # If False, kernels do not keep raw Jupyter messages in the outputs,
+    # saving memory and pickle size when grading does not use them.
+    keep_messages = True
 
     def __init__(self):
         self.runner = self.run_maker()
+        self.kernel_pool = None
         self._solution_nbs = tuple(
-            self.cacher(nb, self.runner) for nb in self.solution_rmds)
+            self.cacher(nb, self.runner, keep_messages=self.keep_messages)
+            for nb in self.solution_rmds)
         self.rebuild()
 
     def rebuild(self):
@@ -309,23 +448,138 @@ class Grader:
         """
         return 0
 
-    def grade_notebook(self, fileish, answers=None):
-        answers = self.make_check_answers() if answers is None else answers
-        with JupyterKernel('ir') as rk:
-            ev_chunks = self.runner.run(fileish, rk)
+    def adjustment_chunk(self, chunk):
+        """ Return True if :meth:`calc_adjustments` needs `chunk` to have run
+
+        With :attr:`early_exit` set, we still run these chunks after all
+        answers have their maximum marks.  Override to select chunks.
+        """
+        return False
+
+    def _make_stop_check(self, answers):
+        """ Return callable returning True when `answers` all have full marks
+        """
+        tracker = MaxMultiTracker(answers)
+
+        def stop_check(ev_chunk):
+            if not self.chunk_is_answer(ev_chunk):
+                return tracker.complete
+            return tracker.add(ev_chunk)
+
+        return stop_check
+
+    def start_pool(self, n_kernels=None):
+        """ Start pool of kernels to use for grading notebooks
+
+        Parameters
+        ----------
+        n_kernels : None or int, optional
+            Number of kernels in pool.  None means use ``self.pool_size``.
+        """
+        n_kernels = self.pool_size if n_kernels is None else n_kernels
+        self.stop_pool()
+        self.kernel_pool = KernelPool('ir', n_kernels, watchdog=True,
+                                      keep_messages=self.keep_messages)
+
+    def stop_pool(self):
+        """ Shutdown pool of kernels, if running """
+        if self.kernel_pool is not None:
+            self.kernel_pool.shutdown()
+            self.kernel_pool = None
+
+    def kernel_context(self):
+        """ Context manager giving kernel to grade one notebook
+
+        Kernel comes from the kernel pool, if running, else it is a fresh
+        kernel.  Kernels have the watchdog on, so a chunk running past the
+        timeout gives an error, rather than stopping the grading run.  Kernels
+        keep raw messages in the outputs unless :attr:`keep_messages` is
+        False.
+        """
+        if self.kernel_pool is None:
+            return JupyterKernel('ir', watchdog=True,
+                                 keep_messages=self.keep_messages)
+        return self.kernel_pool.kernel()
+
+    def notebook_grid(self, fileish, answers):
+        """ Run notebook `fileish`, return grid, adjustments and markups
+
+        The grid is the :func:`full_grid` of `answers` against the evaluated
+        chunks of the notebook.
+        """
+        kwargs = (dict(stop_check=self._make_stop_check(answers),
+                       keep_chunk=self.adjustment_chunk)
+                  if self.early_exit else {})
+        with self.kernel_context() as rk:
+            ev_chunks = self.runner.run(fileish, rk, **kwargs)
             adjustments = self.calc_adjustments(rk)
         # Remove any not-answer chunks
         ev_chunks = self.clear_not_answers(ev_chunks)
         # Get adjustments from markup
         markups = sum(self.mark_markups(fileish))
-        grid = full_grid(answers, ev_chunks)
+        return full_grid(answers, ev_chunks), adjustments, markups
+
+    def grade_notebook(self, fileish, answers=None):
+        answers = self.make_check_answers() if answers is None else answers
+        grid, adjustments, markups = self.notebook_grid(fileish, answers)
         names = [a.name if a.name else 'unnamed' for a in answers]
         names += ['adjustments', 'markups']
         return pd.Series(list(max_multi(grid)) + [adjustments, markups], names)
 
+    def grade_cohort(self, submissions, answers=None):
+        """ Grade `submissions`, return :class:`CohortGrid`
+
+        Use ``grade_cohort(submissions).scores()`` for a DataFrame of scores,
+        with one row per submission, one column per answer, and columns for
+        adjustments and markups.  Submissions giving a
+        :class:`NotebookError` are reported, and left out.
+
+        Parameters
+        ----------
+        submissions : sequence of str
+            Filenames of submissions.
+        answers : None or sequence, optional
+            Answers to grade.  None means use :meth:`make_check_answers`.
+        """
+        answers = self.make_check_answers() if answers is None else answers
+        grids, names, extras = [], [], []
+        with self._own_pool():
+            for submission in submissions:
+                try:
+                    grid, adjustments, markups = self.notebook_grid(
+                        abspath(submission), answers)
+                except NotebookError as nbe:
+                    print(str(nbe))
+                    continue
+                grids.append(grid)
+                names.append(submission)
+                extras.append((adjustments, markups))
+        return CohortGrid(
+            grids, names,
+            [a.name if a.name else 'unnamed' for a in answers],
+            pd.DataFrame(extras, columns=['adjustments', 'markups']))
+
+    @contextmanager
+    def _own_pool(self):
+        """ Context with kernel pool, if ``pool_size`` > 0 and none running
+        """
+        own_pool = self.kernel_pool is None and self.pool_size > 0
+        if own_pool:
+            self.start_pool()
+        try:
+            yield
+        finally:
+            if own_pool:
+                self.stop_pool()
+
     def grade_all_notebooks(self, submission_dir, show_answers=False):
         answers = self.make_check_answers()
-        for submission in self.get_submissions(submission_dir):
+        submissions = self.get_submissions(submission_dir)
+        with self._own_pool():
+            self._grade_notebooks(submissions, answers, show_answers)
+
+    def _grade_notebooks(self, submissions, answers, show_answers):
+        for submission in submissions:
             try:
                 marks = self.grade_notebook(abspath(submission), answers)
             except NotebookError as nbe:
@@ -336,6 +590,27 @@ class Grader:
                 continue
             print(submission, marks, sum(marks))
 
+    def prefix_report(self, submission_dir, cache=None):
+        """ Report starting chunks shared between submissions
+
+        See :meth:`ChunkCache.prefix_report`.
+
+        Parameters
+        ----------
+        submission_dir : str
+            Directory containing submissions.
+        cache : None or :class:`ChunkCache`, optional
+            Cache giving deterministic chunks.  None means use
+            ``self.runner.chunk_cache``, or a default cache if that is None.
+        """
+        if cache is None:
+            cache = self.runner.chunk_cache
+        if cache is None:
+            cache = ChunkCache()
+        return cache.prefix_report(
+            [self.runner.get_chunks(s)
+             for s in self.get_submissions(submission_dir)])
+
     def print_solution(self, solution_no=0):
         for i, s in enumerate(self.solutions[solution_no]):
             content = s.results[0]['content'] if s.results else '[None]'
@@ -350,11 +625,8 @@ class Grader:
     def mark_markups(self, fileish):
         """ Return marks from mark markup lines
         """
-        nb = nb_load(fileish)
-        markups = []
-        for chunk in nb.chunks:
-            markups += MARK_MARKUP_RE.findall(chunk.code)
-        return tuple(float(m) for m in markups)
+        nb = self.runner.load_notebook(fileish)
+        return tuple(float(m) for m in nb.markups)
 
     def raise_for_markup(self, submissions):
         """ Check submissions for markup
@@ -378,12 +650,23 @@ class Grader:
         return
 
     def get_submissions(self, submission_dir):
-        """ Return filenames of submissions """
-        submissions = []
+        """ Return filenames of submissions
+
+        Submissions are R Markdown files, and ``.ipynb`` notebooks without
+        an R Markdown file of the same name, such as a paired notebook.
+        """
+        submissions, notebooks, rmd_roots = [], [], set()
         for submission in sorted(glob(pjoin(submission_dir, '*'))):
-            if not splitext(submission)[1].lower().startswith('.rmd'):
-                continue
-            submissions.append(submission)
+            root, ext = splitext(submission)
+            ext = ext.lower()
+            if ext.startswith('.rmd'):
+                submissions.append(submission)
+                rmd_roots.add(root)
+            elif ext == '.ipynb':
+                notebooks.append(submission)
+        submissions = sorted(
+            submissions +
+            [nb for nb in notebooks if splitext(nb)[0] not in rmd_roots])
         self.check_submissions(submissions)
         return submissions
 
@@ -432,6 +715,10 @@ def store_images(solution, out_dir):
             if result['type'] != 'image':
                 continue
             out_fname = pjoin(out_dir, 'chunk-{}_item-{}.png'.format(i, j))
+            if hasattr(result, 'png_bytes'):  # Write PNG without decoding.
+                with open(out_fname, 'wb') as fobj:
+                    fobj.write(result.png_bytes)
+                continue
             result['content'].save(out_fname)
 
 
@@ -11,6 +11,37 @@ association of (chunk, result).
 """
 
 import numpy as np
+import pandas as pd
+
+
+def output_type_index(evaluated_chunks):
+    """ Index `evaluated_chunks` by the types of their outputs
+
+    Parameters
+    ----------
+    evaluated_chunks : length P sequence of evaluated chunks
+        Sequence of EvaluatedChunk instances.
+
+    Returns
+    -------
+    index : dict
+        Dictionary with output types (such as 'text' or 'image') as keys, and
+        lists of indices of evaluated chunks with outputs of that type as
+        values.
+    """
+    index = {}
+    for j, ev_chunk in enumerate(evaluated_chunks):
+        for out_type in {result['type'] for result in ev_chunk.results or ()}:
+            index.setdefault(out_type, []).append(j)
+    return index
+
+
+def _accepted_columns(output_types, index):
+    """ Sorted indices of chunks with outputs in `output_types` """
+    columns = set()
+    for out_type in output_types:
+        columns.update(index.get(out_type, ()))
+    return sorted(columns)
 
 
 def full_grid(answers, evaluated_chunks):
@@ -26,7 +57,12 @@ def full_grid(answers, evaluated_chunks):
     ----------
     answers : length N sequence of callables.
         Sequence of callable objects, returning marks for given evaluated chunk
-        (see below).
+        (see below).  If an answer has a ``grade_many`` method, we call this
+        method once with the evaluated chunks, to get the row of marks for this
+        answer.  If an answer has an ``output_types`` attribute that is not
+        None, the answer can only give marks for chunks with outputs of these
+        types.  We only grade these chunks, and set marks for other chunks to
+        0, or NaN for chunks that have not run.
     evaluated_chunks : length P sequence of evaluated chunks
         Sequence of EvaluatedChunk instances.
 
@@ -39,9 +75,30 @@ def full_grid(answers, evaluated_chunks):
     N = len(answers)
     P = len(evaluated_chunks)
     grid = np.zeros((N, P))
+    index = None
+    # Columns and chunks for each set of output types.
+    type_columns = {None: (slice(None), evaluated_chunks)}
+    not_run = np.array([ev_chunk.results is None
+                        for ev_chunk in evaluated_chunks], dtype=bool)
     for i, answer in enumerate(answers):
-        for j, ev_chunk in enumerate(evaluated_chunks):
-            grid[i, j] = answer(ev_chunk)
+        output_types = getattr(answer, 'output_types', None)
+        if output_types is not None:
+            output_types = frozenset(output_types)
+            grid[i, not_run] = np.nan
+        if output_types not in type_columns:
+            if index is None:
+                index = output_type_index(evaluated_chunks)
+            columns = _accepted_columns(output_types, index)
+            type_columns[output_types] = (
+                columns, [evaluated_chunks[j] for j in columns])
+        columns, row_chunks = type_columns[output_types]
+        if len(row_chunks) == 0:
+            continue
+        grade_many = getattr(answer, 'grade_many', None)
+        if grade_many is not None:
+            grid[i, columns] = grade_many(row_chunks)
+        else:
+            grid[i, columns] = [answer(ev_chunk) for ev_chunk in row_chunks]
     return grid
 
 
@@ -66,3 +123,163 @@ def max_multi(grid):
     grid = np.array(grid)
     grid[np.isnan(grid)] = 0
     return np.max(grid, axis=1)
+
+
+class MaxMultiTracker:
+    """ Track :func:`max_multi` scores as evaluated chunks arrive
+
+    Use to score evaluated chunks as they come from a running notebook, and
+    find when no further chunk can raise the scores.
+
+    Parameters
+    ----------
+    answers : length N sequence of callables.
+        Sequence of callable objects, returning marks for given evaluated chunk
+        (see :func:`full_grid`).  We take the maximum mark for each answer from
+        its ``mark`` attribute.  Answers without a ``mark`` attribute are never
+        complete.
+    """
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.max_marks = np.array([getattr(a, 'mark', np.inf)
+                                   for a in answers], dtype=float)
+        self.scores = np.zeros(len(answers))
+        self._typed = any(getattr(a, 'output_types', None) is not None
+                          for a in answers)
+
+    def add(self, ev_chunk):
+        """ Add scores for `ev_chunk`, return True if all answers complete
+
+        Skip answers with ``output_types`` that `ev_chunk` does not have.
+        """
+        chunk_types = (None if not self._typed else
+                       {result['type'] for result in ev_chunk.results or ()})
+        column = np.array([
+            answer(ev_chunk) if _can_score(answer, chunk_types) else 0
+            for answer in self.answers], dtype=float)
+        column[np.isnan(column)] = 0
+        np.maximum(self.scores, column, out=self.scores)
+        return self.complete
+
+    @property
+    def complete(self):
+        """ True if all answers have their maximum mark
+        """
+        return bool(np.all(self.scores >= self.max_marks))
+
+
+def _can_score(answer, chunk_types):
+    """ True if `answer` may give marks to chunk with `chunk_types` outputs
+
+    `chunk_types` of None means the chunk may have any output type.
+    """
+    output_types = getattr(answer, 'output_types', None)
+    return (output_types is None or chunk_types is None or
+            not chunk_types.isdisjoint(output_types))
+
+
+class CohortGrid:
+    """ Grids for a cohort of submissions, stacked in one 3D array
+
+    Parameters
+    ----------
+    grids : length S sequence of arrays
+        Grids from :func:`full_grid`, one per submission.  All grids have the
+        same N rows (answers), but can have different numbers of columns
+        (evaluated chunks).
+    names : None or length S sequence, optional
+        Names of submissions.  None means use 0 through S-1.
+    answer_names : None or length N sequence, optional
+        Names of answers.  None means use 0 through N-1.
+    extras : None or DataFrame, optional
+        Other marks for submissions, such as adjustments, with one row per
+        submission, in the order of `grids`.  We add these columns to the
+        scores.
+
+    Attributes
+    ----------
+    grid : ndarray shape (S, N, P)
+        Stacked grids, where P is the maximum number of evaluated chunks
+        over submissions.  Grids with fewer chunks are padded with NaN.
+    n_chunks : ndarray shape (S,)
+        Number of evaluated chunks for each submission.
+    """
+
+    def __init__(self, grids, names=None, answer_names=None, extras=None):
+        grids = [np.asarray(grid, dtype=float) for grid in grids]
+        n_answers = {grid.shape[0] for grid in grids}
+        if len(n_answers) > 1:
+            raise ValueError('All grids must have the same number of answers')
+        N = n_answers.pop() if n_answers else len(answer_names or ())
+        self.n_chunks = np.array([grid.shape[1] for grid in grids], dtype=int)
+        P = self.n_chunks.max() if len(grids) else 0
+        self.grid = np.full((len(grids), N, P), np.nan)
+        for grid, row, n_chunks in zip(grids, self.grid, self.n_chunks):
+            row[:, :n_chunks] = grid
+        self.names = list(range(len(grids)) if names is None else names)
+        self.answer_names = list(range(N) if answer_names is None
+                                 else answer_names)
+        self.extras = (None if extras is None else
+                       pd.DataFrame(extras).set_axis(self.names))
+        self._best = None
+
+    @classmethod
+    def from_evaluated(cls, answers, cohort_chunks, names=None,
+                       extras=None):
+        """ Make cohort grid from `answers` and evaluated chunks
+
+        Parameters
+        ----------
+        answers : length N sequence of callables.
+            Answers, as for :func:`full_grid`.  Answer names come from the
+            ``name`` attribute of the answers, if present.
+        cohort_chunks : length S sequence
+            Sequence where elements are sequences of evaluated chunks, one
+            element per submission.
+        names : None or length S sequence, optional
+            Names of submissions.
+        extras : None or DataFrame, optional
+            See class docstring.
+        """
+        answer_names = [getattr(a, 'name', None) or 'unnamed'
+                        for a in answers]
+        return cls([full_grid(answers, ev_chunks)
+                    for ev_chunks in cohort_chunks],
+                   names, answer_names, extras)
+
+    @property
+    def best(self):
+        """ Array shape (S, N) with best mark over chunks for each answer
+
+        As for :func:`max_multi` on each submission grid, treating NaN as 0.
+        """
+        if self._best is None:
+            best = np.fmax.reduce(self.grid, axis=2, initial=np.nan)
+            best[np.isnan(best)] = 0
+            self._best = best
+        return self._best
+
+    def scores(self, weights=None):
+        """ Return scores for each submission and answer as DataFrame
+
+        Parameters
+        ----------
+        weights : None or length N sequence, optional
+            Factors by which to multiply the scores for each answer.  For
+            example, to change the mark for an answer from 2 to 3, use a
+            weight of 1.5 for this answer.  None means all weights are 1.
+
+        Returns
+        -------
+        scores : DataFrame
+            One row per submission, one column per answer, followed by any
+            columns in `extras`.
+        """
+        best = (self.best if weights is None else
+                self.best * np.asarray(weights, dtype=float))
+        scores = pd.DataFrame(best, index=self.names,
+                              columns=self.answer_names)
+        if self.extras is None:
+            return scores
+        return pd.concat([scores, self.extras], axis=1)
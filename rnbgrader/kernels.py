@@ -12,12 +12,27 @@ http://jupyter-client.readthedocs.io/en/stable/index.html
 # Distributed under the terms of the Modified BSD License.
 
 import io
+import os
+import re
 import inspect
+import pickle
 from base64 import decodebytes
-from queue import Empty
+from queue import Empty, Queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic
+from collections import deque
+from collections.abc import Mapping
+from tempfile import NamedTemporaryFile
 
+import zmq
+import zmq.asyncio
 from PIL import Image
 from jupyter_client.manager import start_new_kernel
+try:  # jupyter_client >= 6.1
+    from jupyter_client.manager import start_new_async_kernel
+except ImportError:
+    start_new_async_kernel = None
 
 # https://github.com/jupyter/jupyter_console/pull/244
 import jupyter_client
@@ -43,7 +58,613 @@ class ValidationError(Exception):
     pass
 
 
-class JupyterKernel:
+VM_HWM_RE = re.compile(r'^VmHWM:\s+(\d+)\s+kB', re.M)
+
+
+def proc_usage(pid):
+    """ Return CPU time and peak resident memory for process `pid`
+
+    Read values from the Linux ``/proc`` filesystem.
+
+    Parameters
+    ----------
+    pid : int
+        Process id.
+
+    Returns
+    -------
+    cpu_time : None or float
+        User plus system CPU time in seconds for process and waited-for
+        children.  None if not available.
+    peak_rss : None or int
+        Peak resident set size in bytes.  None if not available.
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'rt') as fobj:
+            stat = fobj.read()
+        with open(f'/proc/{pid}/status', 'rt') as fobj:
+            status = fobj.read()
+    except OSError:
+        return None, None
+    # Fields after the command name, in parentheses, start at field 3.
+    # utime, stime, cutime, cstime are fields 14 through 17.
+    fields = stat.rsplit(')', 1)[1].split()
+    ticks = sum(int(f) for f in fields[11:15])
+    cpu_time = ticks / os.sysconf('SC_CLK_TCK')
+    match = VM_HWM_RE.search(status)
+    peak_rss = None if match is None else int(match.group(1)) * 1024
+    return cpu_time, peak_rss
+
+
+def reset_peak_rss(pid):
+    """ Reset peak resident set size for process `pid`, return True if done
+    """
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'wt') as fobj:
+            fobj.write('5')
+    except OSError:
+        return False
+    return True
+
+
+class MessageCollector:
+    """ Collect shell and iopub messages replying to one execute request
+
+    Messages belong to the request if their parent header has the request
+    message id.  Kernels aborting queued requests after an error may not send
+    an idle status for the aborted requests, so an aborted reply is enough to
+    finish.
+
+    If there is an output limit, and the stream output goes past the limit,
+    keep only the head and tail of the stream output, each up to half the
+    limit, with a stream message marking the truncation in between.
+    """
+
+    def __init__(self, msg_id, code=None, output_limit=None, spill_dir=None,
+                 interrupt_limit=None, budget=None):
+        """ Initialize collector
+
+        Parameters
+        ----------
+        msg_id : str
+            Message id of execute request.
+        code : None or str, optional
+            Code for execute request.  If not None, check against code in
+            ``execute_input`` message.
+        output_limit : None or int, optional
+            Maximum number of bytes of stream output to keep.  None means no
+            limit.
+        spill_dir : None or str, optional
+            If not None, and the stream output goes past `output_limit`,
+            write all the stream output to a temporary file in this
+            directory.
+        interrupt_limit : None or int, optional
+            If not None, number of bytes of stream output after which
+            :attr:`flooding` becomes True.
+        budget : None or object, optional
+            If not None, object with attributes ``total_output_limit`` and
+            ``output_bytes``, such as a kernel, shared between the collectors
+            for a kernel.  When the stream output for this request starts, we
+            lower `output_limit` to the bytes left in the total limit, and we
+            add the stream bytes we keep to ``output_bytes`` as they arrive.
+            Requests queued together then share one total limit.
+        """
+        self.msg_id = msg_id
+        self.code = code
+        self.output_limit = output_limit
+        self.spill_dir = spill_dir
+        self.interrupt_limit = interrupt_limit
+        self.budget = budget
+        self.reply = None
+        self.idle = False
+        self.interrupted = False
+        # Set by kernel watchdog; see :meth:`JupyterKernel.collect_watched`.
+        self.timed_out = False
+        self.restarted = False
+        self.stream_bytes = 0
+        self.dropped_bytes = 0
+        self.spill_fname = None
+        self._msgs = []
+        self._dropped_msgs = []
+        self._tail = deque()
+        self._tail_bytes = 0
+        # Stream message split between head and tail, and whether the head
+        # got any of it, for undoing the split if nothing gets dropped.
+        self._split = None
+        self._spill = None
+
+    @property
+    def aborted(self):
+        """ True if the kernel aborted this request """
+        return (self.reply is not None and
+                self.reply['content'].get('status') == 'aborted')
+
+    @property
+    def done(self):
+        """ True when we have the execute reply and the idle status
+
+        Kernels can drop the execute reply when an interrupt arrives as the
+        code finishes, so after we interrupt the kernel, the idle status is
+        enough.
+        """
+        if self.reply is None:
+            return self.idle and (self.interrupted or self.timed_out)
+        return self.idle or self.aborted
+
+    @property
+    def flooding(self):
+        """ True if stream output is past interrupt limit, before interrupt
+
+        Only True while the code is still running; after the idle status,
+        the rest of the output is already on its way.
+        """
+        return (self.interrupt_limit is not None and
+                not self.interrupted and
+                not self.idle and
+                self.stream_bytes > self.interrupt_limit)
+
+    @property
+    def output_msgs(self):
+        """ List of output messages, with truncated stream output """
+        if self.dropped_bytes == 0:
+            if self._split is None:
+                return self._msgs + list(self._tail)
+            msg, in_head = self._split
+            head = self._msgs[:-1] if in_head else self._msgs
+            return head + [msg] + list(self._tail)[1:]
+        return (self._msgs + self._dropped_msgs +
+                [self._truncation_msg()] + list(self._tail))
+
+    def _truncation_msg(self):
+        where = ('' if self.spill_fname is None else
+                 f'; full output in {self.spill_fname}')
+        text = (f'\n[... {self.dropped_bytes} bytes of output '
+                f'truncated{where} ...]\n')
+        return dict(msg_type='stream',
+                    header=dict(msg_type='stream'),
+                    parent_header=dict(msg_id=self.msg_id),
+                    metadata={},
+                    content=dict(name='stdout', text=text))
+
+    def add(self, channel_name, msg):
+        """ Add message `msg` from channel named `channel_name`
+        """
+        if channel_name == 'shell':
+            self.reply = msg
+            self._check_done()
+            return
+        msg_type = msg['msg_type']
+        if msg_type == 'status':
+            if msg['content']['execution_state'] == 'idle':
+                self.idle = True
+                self._check_done()
+            return
+        if msg_type == 'execute_input':
+            assert self.code is None or msg['content']['code'] == self.code
+            return
+        if msg_type == 'stream':
+            self._add_stream(msg)
+        elif self._tail:
+            self._tail.append(msg)
+        else:
+            self._msgs.append(msg)
+
+    def _add_stream(self, msg):
+        if self.budget is None:
+            self._keep_stream(msg)
+            return
+        total = self.budget.total_output_limit
+        if self.stream_bytes == 0 and total is not None:
+            remaining = max(total - self.budget.output_bytes, 0)
+            self.output_limit = (remaining if self.output_limit is None
+                                 else min(self.output_limit, remaining))
+        kept = self.stream_bytes - self.dropped_bytes
+        self._keep_stream(msg)
+        self.budget.output_bytes += (self.stream_bytes - self.dropped_bytes
+                                     - kept)
+
+    def _keep_stream(self, msg):
+        text = msg['content']['text']
+        n_bytes = _n_bytes(text)
+        self.stream_bytes += n_bytes
+        if self._spill is not None:
+            self._spill.write(text)
+        limit = self.output_limit
+        head_limit = None if limit is None else limit // 2
+        if limit is None or (not self._tail and
+                             self.stream_bytes <= head_limit):
+            self._msgs.append(msg)
+            return
+        if not self._tail:  # Head fills up with this message.
+            if self.spill_dir is not None:
+                self._start_spill(text)
+            self._split = (msg, False)
+            head_text = _head_bytes(
+                text, head_limit - (self.stream_bytes - n_bytes))
+            if head_text:
+                self._msgs.append(_with_text(msg, head_text))
+                self._split = (msg, True)
+            text = text[len(head_text):]
+            msg = _with_text(msg, text)
+            n_bytes = _n_bytes(text)
+        self._tail.append(msg)
+        self._tail_bytes += n_bytes
+        self._trim_tail(limit - head_limit)
+
+    def _trim_tail(self, tail_limit):
+        while self._tail_bytes > tail_limit:
+            msg = self._tail.popleft()
+            if msg['msg_type'] != 'stream':  # Keep non-stream messages.
+                self._dropped_msgs.append(msg)
+                continue
+            text = msg['content']['text']
+            n_bytes = _n_bytes(text)
+            excess = self._tail_bytes - tail_limit
+            if n_bytes > excess:  # Drop start of text, keep the rest.
+                kept = _tail_bytes(text, n_bytes - excess)
+                self._tail.appendleft(_with_text(msg, kept))
+                n_bytes -= _n_bytes(kept)
+            self._tail_bytes -= n_bytes
+            self.dropped_bytes += n_bytes
+
+    def _start_spill(self, text):
+        """ Write stream output so far, ending with `text`, to spill file
+        """
+        self._spill = NamedTemporaryFile('wt', encoding='utf8',
+                                         prefix='rnbg-output-',
+                                         suffix='.txt',
+                                         dir=self.spill_dir,
+                                         delete=False)
+        self.spill_fname = self._spill.name
+        for msg in self._msgs:
+            if msg['msg_type'] == 'stream':
+                self._spill.write(msg['content']['text'])
+        self._spill.write(text)
+
+    def _check_done(self):
+        if not self.done or self._spill is None:
+            return
+        self._spill.close()
+        self._spill = None
+        if self.dropped_bytes == 0:  # Nothing truncated; don't need file.
+            os.unlink(self.spill_fname)
+            self.spill_fname = None
+
+
+def _n_bytes(text):
+    return len(text.encode('utf8'))
+
+
+def _head_bytes(text, n_bytes):
+    """ Return start of `text`, up to `n_bytes` when encoded """
+    return text.encode('utf8')[:n_bytes].decode('utf8', 'ignore')
+
+
+def _tail_bytes(text, n_bytes):
+    """ Return end of `text`, up to `n_bytes` when encoded """
+    encoded = text.encode('utf8')
+    return encoded[len(encoded) - n_bytes:].decode('utf8', 'ignore')
+
+
+def _with_text(msg, text):
+    """ Copy of stream message `msg`, with new `text` """
+    return dict(msg, content=dict(msg['content'], text=text))
+
+
+class Output(Mapping):
+    """ Record for one processed kernel output
+
+    Read-only mapping with keys ``type``, ``content`` and, where kept,
+    ``message``, so ``output['type']`` and ``output['content']`` work as for
+    a dictionary.  Attribute access also works, as in ``output.content``.
+
+    Parameters
+    ----------
+    type : str
+        Output type, such as 'text', 'stdout', 'stderr', 'error' or 'image'.
+    content : object
+        Output content.
+    message : None or dict, optional
+        Raw Jupyter message for the output.  None where the kernel dropped
+        the message, or there was no message.
+    """
+
+    __slots__ = ('type', 'content', 'message')
+
+    _keys = ('type', 'content', 'message')
+
+    def __init__(self, type, content, message=None):
+        self.type = type
+        self.content = content
+        self.message = message
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __delitem__(self, key):
+        # Allow dropping message, as for output dictionaries.
+        if key != 'message':
+            raise KeyError(key)
+        self.message = None
+
+    def __iter__(self):
+        yield 'type'
+        yield 'content'
+        if self.message is not None:
+            yield 'message'
+
+    def __len__(self):
+        return 2 if self.message is None else 3
+
+    def __contains__(self, key):
+        return key in ('type', 'content') or (
+            key == 'message' and self.message is not None)
+
+    def __reduce__(self):
+        return (self.__class__, (self.type, self.content, self.message))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(type={self.type!r}, '
+                f'content={self.content!r})')
+
+
+class LazyImageOutput(Output):
+    """ Image output record, decoding the PNG image on first use
+
+    The record keeps the compressed PNG bytes, and only opens the image,
+    as ``output['content']`` or ``output.content``, when first asked.
+    """
+
+    __slots__ = ('png_bytes', '_image')
+
+    def __init__(self, png_bytes, message=None):
+        self.type = 'image'
+        self.message = message
+        self.png_bytes = png_bytes
+        self._image = None
+
+    @property
+    def content(self):
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.png_bytes))
+        return self._image
+
+    def __reduce__(self):
+        # Pickle compressed bytes rather than decoded image.
+        return (self.__class__, (self.png_bytes, self.message))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(<{len(self.png_bytes)} PNG '
+                'bytes>)')
+
+
+STREAM_TYPES = ('stdout', 'stderr')
+
+
+def coalesce_streams(outputs):
+    """ Merge adjacent stream outputs with the same stream name
+
+    Kernels can split the output of one print into several stream messages.
+
+    Parameters
+    ----------
+    outputs : sequence of dict
+        Processed outputs, as from :meth:`JupyterKernel.run_code`.
+
+    Returns
+    -------
+    coalesced : list of dict
+        Outputs where runs of adjacent outputs of the same stream type
+        (``stdout`` or ``stderr``) have become one output, with the
+        concatenated contents.
+    """
+    coalesced = []
+    for output in outputs:
+        if (coalesced and
+            output['type'] in STREAM_TYPES and
+            coalesced[-1]['type'] == output['type']):
+            coalesced[-1] = _merge_streams(coalesced[-1], output)
+            continue
+        coalesced.append(output)
+    return coalesced
+
+
+def _merge_streams(first, second):
+    content = first['content'] + second['content']
+    message = first.get('message')
+    if message is not None:
+        message = _with_text(message, content)
+    if isinstance(first, Output):
+        return Output(first['type'], content, message)
+    merged = dict(first, content=content)
+    if 'message' in first:
+        merged['message'] = message
+    return merged
+
+
+def _route_msg(by_id, pending, channel_name, msg):
+    """ Add `msg` to collector in `by_id` for parent message id
+
+    Remove message id from `pending` set when the collector is done.  Drop
+    messages with no matching collector.  Return True if this message
+    finished a pending collector.
+    """
+    collector = by_id.get(msg['parent_header'].get('msg_id'))
+    if collector is None:
+        return False
+    collector.add(channel_name, msg)
+    if collector.done and collector.msg_id in pending:
+        pending.discard(collector.msg_id)
+        return True
+    return False
+
+
+class _KernelBase:
+    """ Message processing shared by sync and async kernel classes """
+
+    timeout = DEFAULT_TIMEOUT
+    # Output budget; see :meth:`_init_budget`.
+    output_limit = None
+    total_output_limit = None
+    spill_dir = None
+    output_bytes = 0
+    # Interrupt the kernel when the stream output for one execute request is
+    # more than this factor times the output limit.
+    interrupt_factor = 10
+    # If True, merge adjacent outputs from the same stream.
+    coalesce = False
+    # If False, do not keep raw Jupyter messages in outputs.
+    keep_messages = True
+
+    def _init_budget(self, output_limit, total_output_limit, spill_dir):
+        """ Set output budget
+
+        Parameters
+        ----------
+        output_limit : None or int
+            Maximum number of bytes of stream output to keep for each execute
+            request.  Past this limit, keep only the head and tail of the
+            output.  None means no limit.
+        total_output_limit : None or int
+            Maximum number of bytes of stream output over all execute
+            requests, until the next call to :meth:`reset_output_budget`.
+            None means no limit.
+        spill_dir : None or str
+            If not None, directory in which to write the full stream output
+            for requests that go past the output limit.
+        """
+        self.output_limit = output_limit
+        self.total_output_limit = total_output_limit
+        self.spill_dir = spill_dir
+        self.reset_output_budget()
+
+    def reset_output_budget(self):
+        """ Reset count of stream output bytes for total output limit """
+        self.output_bytes = 0
+
+    def _make_collector(self, msg_id, code):
+        """ Collector for request `msg_id`, counting output in the budget
+        """
+        base_limit = (self.total_output_limit if self.output_limit is None
+                      else self.output_limit)
+        return MessageCollector(
+            msg_id,
+            code,
+            output_limit=self.output_limit,
+            spill_dir=self.spill_dir,
+            interrupt_limit=(None if base_limit is None else
+                             base_limit * self.interrupt_factor),
+            budget=self)
+
+    @property
+    def pid(self):
+        """ Process id of kernel, or None if not available """
+        provisioner = getattr(self.manager, 'provisioner', None)
+        process = (getattr(self.manager, 'kernel', None) if provisioner is None
+                   else getattr(provisioner, 'process', None))
+        return getattr(process, 'pid', None)
+
+    def resource_usage(self, reset_peak=False):
+        """ Return CPU time and peak resident memory for kernel process
+
+        Parameters
+        ----------
+        reset_peak : {False, True}, optional
+            If True, reset the peak resident memory after reading, so the
+            next reading gives the peak since this call.
+
+        Returns
+        -------
+        cpu_time : None or float
+            CPU time in seconds, None if not available.
+        peak_rss : None or int
+            Peak resident memory in bytes, None if not available.
+        """
+        pid = self.pid
+        if pid is None:
+            return None, None
+        usage = proc_usage(pid)
+        if reset_peak:
+            reset_peak_rss(pid)
+        return usage
+
+    def _channels(self):
+        return (('shell', self.client.shell_channel),
+                ('iopub', self.client.iopub_channel))
+
+    def _timeout_error(self, timeout):
+        return Empty(f'Timeout after {timeout} seconds waiting for kernel '
+                     'messages')
+
+    def validate_message(self, msg, msg_type):
+        if msg["header"]["msg_type"] != msg_type:
+            return ValidationError(
+                f'Expecting "{msg_type}" but got {msg}')
+
+    def _process_output(self, msg):
+        content = msg['content']
+        msg_type = msg['msg_type']
+        if msg_type.startswith('comm_') or msg_type == 'clear_output':
+            return
+        message = msg if self.keep_messages else None
+        if msg_type == 'error':
+            return Output('error', content['evalue'], message)
+        if msg_type == 'stream':
+            return Output(content['name'], content['text'], message)
+        if msg_type not in  ('display_data',
+                             'execute_result'):
+            raise RuntimeError("Don't recognize message type " +
+                               msg['msg_type'])
+        data = msg['content']['data']
+        if 'image/png' in data:
+            img_bytes = decodebytes(data['image/png'].encode('ascii'))
+            return LazyImageOutput(img_bytes, message)
+        if 'text/plain' in data:
+            return Output('text', data['text/plain'], message)
+        if 'text/html' in data:
+            return
+        raise RuntimeError("Don't recognize data {}".format(data))
+
+    def _process_reply(self, reply, output_msgs):
+        """ Check `reply`, return list of processed `output_msgs`
+
+        `reply` can be None where the kernel restarted before replying.
+        """
+        msg_type = 'execute_reply' if reply is None else (
+            reply['header']['msg_type'])
+        if not  msg_type == 'execute_reply':
+            raise ValueError('Expected "execute_reply" message '
+                             f'but got "{msg_type}"')
+        outputs = [self._process_output(msg) for msg in output_msgs]
+        outputs = [p for p in outputs if p]
+        return coalesce_streams(outputs) if self.coalesce else outputs
+
+    def _collector_outputs(self, collector, timeout):
+        """ Processed outputs for `collector`, with any timeout error
+        """
+        outputs = self._process_reply(collector.reply, collector.output_msgs)
+        if collector.timed_out:
+            action = 'restarted' if collector.restarted else 'interrupted'
+            outputs.append(Output(
+                'error',
+                (f'Timeout: no reply after {timeout} seconds; '
+                 f'kernel {action}')))
+        return outputs
+
+    def _collectors_outputs(self, collectors, timeout):
+        """ Processed outputs for each of `collectors`, as for ``run_codes``
+
+        None for requests the kernel aborted, and for requests that had not
+        run when the watchdog restarted the kernel.
+        """
+        return [None if c.aborted or (c.restarted and not c.timed_out) else
+                self._collector_outputs(c, timeout)
+                for c in collectors]
+
+
+class JupyterKernel(_KernelBase):
     r""" Helper class to instantiate and use a Jupyter kernel
 
     Examples
@@ -56,7 +677,14 @@ class JupyterKernel:
     '[1] 1'
     """
 
-    def __init__(self, kernel_name, timeout=DEFAULT_TIMEOUT, **kwargs):
+    # Seconds to wait for kernel to respond to interrupt from watchdog,
+    # before restarting.
+    interrupt_timeout = 5
+
+    def __init__(self, kernel_name, timeout=DEFAULT_TIMEOUT,
+                 output_limit=None, total_output_limit=None, spill_dir=None,
+                 watchdog=False, coalesce=False, record=False,
+                 keep_messages=True, **kwargs):
         r""" Initialize Jupyter kernel object
 
         Parameters
@@ -66,14 +694,47 @@ class JupyterKernel:
             https://irkernel.github.io/docs/IRkernel).
         timeout : float, optional
             Default timeout in seconds.
+        output_limit : None or int, optional
+            Maximum number of bytes of stream output to keep for each code
+            string.  Past this limit, keep only the head and tail of the
+            output.  We interrupt the kernel when the output goes on past
+            ``interrupt_factor`` times this limit.  None means no limit.
+        total_output_limit : None or int, optional
+            Maximum number of bytes of stream output to keep over all code
+            strings, until the next call to :meth:`reset_output_budget`.
+            None means no limit.
+        spill_dir : None or str, optional
+            If not None, directory in which to write the full stream output
+            for code strings going past the output limit.
+        watchdog : {False, True}, optional
+            If False, raise ``queue.Empty`` when code runs past the timeout.
+            If True, interrupt the kernel, and restart it if it does not
+            respond to the interrupt.  The outputs for the code then end with
+            an error output reporting the timeout.
+        coalesce : {False, True}, optional
+            If True, merge adjacent outputs from the same stream (``stdout``
+            or ``stderr``) into one output.
+        record : {False, True}, optional
+            If True, record the reply and output messages for each code
+            string in the ``recording`` attribute, for later replay with
+            :class:`ReplayKernel`.
+        keep_messages : {True, False}, optional
+            If True, keep the raw Jupyter message for each output, as the
+            output's ``message``.  False saves memory and pickle size.
         \*\*kwargs : dict
             Arguments to pass to `start_new_kernel`. `cwd='some/path'` is one
             example.
         """
+        self.kernel_name = kernel_name
         self.manager, self.client = start_new_kernel(
             kernel_name=kernel_name,
             **kwargs)
         self.timeout = timeout
+        self.watchdog = watchdog
+        self.coalesce = coalesce
+        self.recording = {} if record else None
+        self.keep_messages = keep_messages
+        self._init_budget(output_limit, total_output_limit, spill_dir)
 
     def shutdown(self):
         """ Shutdown the kernel """
@@ -87,28 +748,127 @@ class JupyterKernel:
     def __del__(self):
         self.shutdown()
 
+    def _get_msg(self, channel):
+        try:
+            return ensure_sync(channel.get_msg)(timeout=0)
+        except TypeError:
+            return channel.get_msg(timeout=0)
+
     def flush_channels(self):
-        """ Flush all kernel channels """
-        for channel in (self.client.shell_channel, self.client.iopub_channel):
+        """ Flush all kernel channels
+
+        Discard messages already waiting on the channels, without waiting for
+        more.
+        """
+        for name, channel in self._channels():
             while True:
                 try:
-                    ensure_sync(channel.get_msg)(timeout=0.1)
-                except TypeError:
-                    channel.get_msg(timeout=0.1)
+                    self._get_msg(channel)
                 except Empty:
                     break
 
+    def collect(self, collectors, timeout=None, until=None):
+        """ Read shell and iopub messages until all `collectors` are done
+
+        Wait on both channels at once, and route each message to the collector
+        with matching parent message id.  Drop messages for other requests.
+
+        Parameters
+        ----------
+        collectors : sequence of :class:`MessageCollector`
+            Collectors for requests sent to the kernel.
+        timeout : None or float, optional
+            Timeout in seconds waiting for the next collector to finish.  If
+            None, use default timeout.
+        until : None or sequence of :class:`MessageCollector`, optional
+            If not None, return when these collectors from `collectors` are
+            done, rather than waiting for all `collectors`.  We still route
+            messages to all `collectors`.
+
+        Raises
+        ------
+        Empty
+            If no further collector finishes before the timeout.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        by_id = {c.msg_id: c for c in collectors}
+        pending = {c.msg_id for c in (collectors if until is None else until)
+                   if not c.done}
+        poller = zmq.Poller()
+        by_socket = {}
+        for name, channel in self._channels():
+            poller.register(channel.socket, zmq.POLLIN)
+            by_socket[channel.socket] = (name, channel)
+        while pending:
+            remaining = deadline - monotonic()
+            events = poller.poll(max(remaining, 0) * 1000)
+            if not events:
+                raise self._timeout_error(timeout)
+            for socket, _ in events:
+                name, channel = by_socket[socket]
+                try:
+                    msg = self._get_msg(channel)
+                except Empty:
+                    continue
+                if _route_msg(by_id, pending, name, msg):
+                    deadline = monotonic() + timeout
+            for collector in collectors:
+                if collector.flooding:
+                    self.manager.interrupt_kernel()
+                    collector.interrupted = True
+
+    def collect_watched(self, collectors, timeout=None):
+        """ Collect messages as for :meth:`collect`, recovering from timeout
+
+        If the watchdog is on, and the kernel does not finish the next
+        collector before the timeout, interrupt the kernel, and mark the
+        collector as timed out.  If the kernel does not respond to the
+        interrupt, restart the kernel.  Collectors not done after the restart
+        have their ``restarted`` attribute set.  We only allow the shorter
+        interrupt timeout for the interrupted collector; the collectors after
+        it get the full timeout again.
+
+        Parameters
+        ----------
+        collectors : sequence of :class:`MessageCollector`
+            Collectors for requests sent to the kernel.
+        timeout : None or float, optional
+            Timeout in seconds.  If None, use default timeout.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        while True:
+            try:
+                self.collect(collectors, timeout)
+                return
+            except Empty:
+                if not self.watchdog:
+                    raise
+            stuck = [c for c in collectors if not c.done]
+            stuck[0].timed_out = True
+            self.manager.interrupt_kernel()
+            try:
+                self.collect(collectors, self.interrupt_timeout,
+                             until=stuck[:1])
+            except Empty:
+                break
+        self.restart()
+        for collector in collectors:
+            if not collector.done:
+                collector.restarted = True
+
+    def restart(self):
+        """ Restart kernel, losing kernel state, and wait until ready """
+        self.manager.restart_kernel(now=True)
+        self.client.wait_for_ready(timeout=self.timeout)
+        self.flush_channels()
+
     def get_non_kernel_info_reply(self, timeout=None):
         while True:
             reply = self.client.get_shell_msg(timeout=timeout)
             if reply["header"]["msg_type"] != "kernel_info_reply":
                 return reply
 
-    def validate_message(self, msg, msg_type):
-        if msg["header"]["msg_type"] != msg_type:
-            return ValidationError(
-                f'Expecting "{msg_type}" but got {msg}')
-
     def raw_run(self, code, timeout=None,
                  silent=False, store_history=True,
                  stop_on_error=True):
@@ -131,70 +891,41 @@ class JupyterKernel:
 
         Returns
         -------
-        reply : str
+        reply : None or str
             Message dictionary giving kernel reply to code execute message.
+            None if the watchdog restarted the kernel before the reply, or
+            the kernel dropped the reply after an interrupt.
         output_msgs : list
             List of other message dictionaries resulting from code execute message.
         """
-        timeout = self.timeout if timeout is None else timeout
-
-        kc = self.client
-
-        _ = kc.execute(code=code, silent=silent,
-                       store_history=store_history,
-                       stop_on_error=stop_on_error)
+        collector = self._run_collector(code, timeout, silent, store_history,
+                                        stop_on_error)
+        return collector.reply, collector.output_msgs
 
-        reply = self.get_non_kernel_info_reply(timeout=timeout)
-        self.validate_message(reply, 'execute_reply')
+    def _run_collector(self, code, timeout=None,
+                       silent=False, store_history=True,
+                       stop_on_error=True):
+        msg_id = self.client.execute(code=code, silent=silent,
+                                     store_history=store_history,
+                                     stop_on_error=stop_on_error)
+        collector = self._make_collector(msg_id, code)
+        self.collect_watched([collector], timeout)
+        self._record(collector)
+        return collector
 
-        busy_msg = ensure_sync(kc.iopub_channel.get_msg)(timeout=1)
-        self.validate_message(reply, 'status')
-        assert busy_msg['content']['execution_state'] == 'busy'
+    def _record(self, collector):
+        if self.recording is not None:
+            self.recording.setdefault(collector.code, []).append(
+                (collector.reply,
+                 collector.output_msgs,
+                 collector.timed_out,
+                 collector.restarted))
 
-        output_msgs = []
-        while True:
-            msg = ensure_sync(kc.iopub_channel.get_msg)(timeout=0.1)
-            if msg["msg_type"] == "status":
-                assert msg["content"]["execution_state"] == "idle"
-                break
-            elif msg["msg_type"] == "execute_input":
-                assert msg["content"]["code"] == code
-                continue
-            output_msgs.append(msg)
-
-        return reply, output_msgs
-
-    def _process_output(self, msg):
-        content = msg['content']
-        msg_type = msg['msg_type']
-        if msg_type.startswith('comm_') or msg_type == 'clear_output':
-            return
-        if msg_type == 'error':
-            return dict(type='error',
-                        message=msg,
-                        content=content['evalue'])
-        if msg_type == 'stream':
-            return dict(type=content['name'],
-                        message=msg,
-                        content=content['text'])
-        if msg_type not in  ('display_data',
-                             'execute_result'):
-            raise RuntimeError("Don't recognize message type " +
-                               msg['msg_type'])
-        data = msg['content']['data']
-        if 'image/png' in data:
-            img_bytes = decodebytes(data['image/png'].encode('ascii'))
-            png = Image.open(io.BytesIO(img_bytes))
-            return dict(type='image',
-                        message=msg,
-                        content=png)
-        if 'text/plain' in data:
-            return dict(type='text',
-                        message=msg,
-                        content=data['text/plain'])
-        if 'text/html' in data:
-            return {}
-        raise RuntimeError("Don't recognize data {}".format(data))
+    def save_recording(self, fname):
+        """ Save recorded messages to file `fname`, for :class:`ReplayKernel`
+        """
+        with open(fname, 'wb') as fobj:
+            pickle.dump(self.recording, fobj)
 
     def run_code(self, code, timeout=None,
                  silent=False, store_history=True,
@@ -220,16 +951,483 @@ class JupyterKernel:
         -------
         outputs : list
             List of output dictionaries, one per output.  The outputs have been
-            processed to convert mime types to text, images.
+            processed to convert mime types to text, images.  If the watchdog
+            stopped the code, the last output is an error output reporting
+            the timeout.
         """
-        reply, output_msgs = self.raw_run(code, timeout, silent, store_history,
-                                          stop_on_error)
-        msg_type = reply['header']['msg_type']
-        if not  msg_type == 'execute_reply':
-            raise ValueError('Expected "execute_reply" message '
-                             f'but got "{msg_type}"')
-        outputs = [self._process_output(msg) for msg in output_msgs]
-        return [p for p in outputs if p]
+        timeout = self.timeout if timeout is None else timeout
+        collector = self._run_collector(code, timeout, silent, store_history,
+                                        stop_on_error)
+        return self._collector_outputs(collector, timeout)
+
+    def run_codes(self, codes, timeout=None, stop_on_error=True):
+        """ Queue all code strings at once, return processed results for each
+
+        Send all execute requests before waiting for replies, to avoid a round
+        trip to the kernel for each code string.
+
+        Parameters
+        ----------
+        codes : sequence of str
+            Code strings in the kernel's language.
+        timeout : None or float, optional
+            Timeout in seconds for each code string.  If None, use default
+            timeout.
+        stop_on_error: bool, optional (default True)
+            If True, the kernel aborts the rest of the queued code strings
+            after an error.
+
+        Returns
+        -------
+        outputs_seq : list
+            List with one element per code string in `codes`.  Elements are
+            lists of output dictionaries (see :meth:`run_code`), or None where
+            the kernel aborted the code string, or the watchdog restarted the
+            kernel before the code string ran.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        collectors = []
+        for code in codes:
+            msg_id = self.client.execute(code=code,
+                                         stop_on_error=stop_on_error)
+            collectors.append(self._make_collector(msg_id, code))
+        self.collect_watched(collectors, timeout)
+        for collector in collectors:
+            self._record(collector)
+        return self._collectors_outputs(collectors, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        return False
+
+
+class AsyncJupyterKernel(_KernelBase):
+    r""" Jupyter kernel driven from an asyncio event loop
+
+    One event loop can drive many of these kernels at the same time.
+
+    Examples
+    --------
+    >>> async def run(code):
+    ...     async with AsyncJupyterKernel("ir") as kernel:
+    ...         return await kernel.run_code(code)
+    >>> outputs = asyncio.run(run('a = 1\na'))
+    >>> outputs[0]['content']
+    '[1] 1'
+    """
+
+    def __init__(self, kernel_name, timeout=DEFAULT_TIMEOUT,
+                 output_limit=None, total_output_limit=None, spill_dir=None,
+                 coalesce=False, keep_messages=True, **kwargs):
+        r""" Initialize async Jupyter kernel object
+
+        Start the kernel with ``await kernel.start()``, or by using the object
+        as an async context manager.
+
+        Parameters
+        ----------
+        kernel_name : str
+            Name of kernel.  For R, this is likely to be "ir" (see
+            https://irkernel.github.io/docs/IRkernel).
+        timeout : float, optional
+            Default timeout in seconds.
+        output_limit : None or int, optional
+            See :class:`JupyterKernel`.
+        total_output_limit : None or int, optional
+            See :class:`JupyterKernel`.
+        spill_dir : None or str, optional
+            See :class:`JupyterKernel`.
+        coalesce : {False, True}, optional
+            See :class:`JupyterKernel`.
+        keep_messages : {True, False}, optional
+            See :class:`JupyterKernel`.
+        \*\*kwargs : dict
+            Arguments to pass to `start_new_async_kernel`. `cwd='some/path'`
+            is one example.
+        """
+        self.kernel_name = kernel_name
+        self.timeout = timeout
+        self.coalesce = coalesce
+        self.keep_messages = keep_messages
+        self._init_budget(output_limit, total_output_limit, spill_dir)
+        self.kwargs = kwargs
+        self.manager = self.client = None
+
+    async def start(self):
+        """ Start kernel, if not already started, return self """
+        if start_new_async_kernel is None:
+            raise RuntimeError('Async kernels need jupyter_client >= 6.1')
+        if self.manager is None:
+            self.manager, self.client = await start_new_async_kernel(
+                kernel_name=self.kernel_name,
+                **self.kwargs)
+        return self
+
+    async def shutdown(self):
+        """ Shutdown the kernel """
+        if self.client is None:
+            return
+        self.client.stop_channels()
+        if self.manager.has_kernel:
+            await self.manager.shutdown_kernel()
+        self.manager = self.client = None
+
+    async def flush_channels(self):
+        """ Flush all kernel channels
+
+        Discard messages already waiting on the channels, without waiting for
+        more.
+        """
+        for name, channel in self._channels():
+            while True:
+                try:
+                    await channel.get_msg(timeout=0)
+                except Empty:
+                    break
+
+    async def collect(self, collectors, timeout=None):
+        """ Read shell and iopub messages until all `collectors` are done
+
+        See :meth:`JupyterKernel.collect` for parameters.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        by_id = {c.msg_id: c for c in collectors}
+        pending = {c.msg_id for c in collectors if not c.done}
+        poller = zmq.asyncio.Poller()
+        by_socket = {}
+        for name, channel in self._channels():
+            poller.register(channel.socket, zmq.POLLIN)
+            by_socket[channel.socket] = (name, channel)
+        while pending:
+            remaining = deadline - monotonic()
+            events = await poller.poll(max(remaining, 0) * 1000)
+            if not events:
+                raise self._timeout_error(timeout)
+            for socket, _ in events:
+                name, channel = by_socket[socket]
+                try:
+                    msg = await channel.get_msg(timeout=0)
+                except Empty:
+                    continue
+                if _route_msg(by_id, pending, name, msg):
+                    deadline = monotonic() + timeout
+            for collector in collectors:
+                if collector.flooding:
+                    await self.manager.interrupt_kernel()
+                    collector.interrupted = True
+
+    async def raw_run(self, code, timeout=None,
+                      silent=False, store_history=True,
+                      stop_on_error=True):
+        """ Run code string, return reply and other output messages
+
+        See :meth:`JupyterKernel.raw_run` for parameters.
+        """
+        msg_id = self.client.execute(code=code, silent=silent,
+                                     store_history=store_history,
+                                     stop_on_error=stop_on_error)
+        collector = self._make_collector(msg_id, code)
+        await self.collect([collector], timeout)
+        return collector.reply, collector.output_msgs
+
+    async def run_code(self, code, timeout=None,
+                       silent=False, store_history=True,
+                       stop_on_error=True):
+        """ Run code string, return list of processed results
+
+        See :meth:`JupyterKernel.run_code` for parameters.
+        """
+        reply, output_msgs = await self.raw_run(
+            code, timeout, silent, store_history, stop_on_error)
+        return self._process_reply(reply, output_msgs)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args):
+        await self.shutdown()
+        return False
+
+
+class ReplayKernel(_KernelBase):
+    r""" Kernel replaying messages recorded from a :class:`JupyterKernel`
+
+    Use for testing and benchmarking without a running kernel.  Each run of a
+    code string replays the next recording for that code string, repeating
+    the last recording once all have been used.
+
+    Examples
+    --------
+    >>> with JupyterKernel("ir", record=True) as kernel:
+    ...     outputs = kernel.run_code('a = 1\na')
+    ...     kernel.save_recording('recording.pkl')
+    >>> replay = ReplayKernel('recording.pkl')
+    >>> replay.run_code('a = 1\na')[0]['content']
+    '[1] 1'
+    """
+
+    manager = None
+    kernel_name = 'replay'
+
+    def __init__(self, recording, timeout=DEFAULT_TIMEOUT, coalesce=False,
+                 keep_messages=True):
+        """ Initialize replay kernel
+
+        Parameters
+        ----------
+        recording : str or dict
+            Filename of recording saved by
+            :meth:`JupyterKernel.save_recording`, or the ``recording``
+            attribute of a recording :class:`JupyterKernel`.
+        timeout : float, optional
+            Default timeout in seconds, for use in timeout messages.
+        coalesce : {False, True}, optional
+            See :class:`JupyterKernel`.
+        keep_messages : {True, False}, optional
+            See :class:`JupyterKernel`.
+        """
+        if isinstance(recording, str):
+            with open(recording, 'rb') as fobj:
+                recording = pickle.load(fobj)
+        self.recording = recording
+        self.timeout = timeout
+        self.coalesce = coalesce
+        self.keep_messages = keep_messages
+        self.reset_replay()
+
+    def reset_replay(self):
+        """ Restart replay from first recording of each code string """
+        self._counts = {}
+
+    def _collector(self, code):
+        if code not in self.recording:
+            raise KeyError(f'No recording for code:\n{code}')
+        records = self.recording[code]
+        count = self._counts.get(code, 0)
+        self._counts[code] = count + 1
+        reply, output_msgs, timed_out, restarted = records[
+            min(count, len(records) - 1)]
+        collector = MessageCollector(
+            None if reply is None else reply['parent_header']['msg_id'],
+            code)
+        collector.reply = reply
+        collector._msgs = list(output_msgs)
+        collector.timed_out = timed_out
+        collector.restarted = restarted
+        return collector
+
+    def flush_channels(self):
+        """ Nothing to flush for replay kernel """
+
+    def shutdown(self):
+        """ Nothing to shut down for replay kernel """
+
+    def raw_run(self, code, timeout=None,
+                silent=False, store_history=True,
+                stop_on_error=True):
+        """ Replay recorded reply and output messages for `code`
+
+        See :meth:`JupyterKernel.raw_run` for parameters.
+        """
+        collector = self._collector(code)
+        return collector.reply, collector.output_msgs
+
+    def run_code(self, code, timeout=None,
+                 silent=False, store_history=True,
+                 stop_on_error=True):
+        """ Return processed results from recording for `code`
+
+        See :meth:`JupyterKernel.run_code` for parameters.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return self._collector_outputs(self._collector(code), timeout)
+
+    def run_codes(self, codes, timeout=None, stop_on_error=True):
+        """ Return processed results from recordings for `codes`
+
+        See :meth:`JupyterKernel.run_codes` for parameters.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return self._collectors_outputs(
+            [self._collector(code) for code in codes], timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class KernelPool:
+    r""" Pool of pre-started Jupyter kernels for reuse across notebooks
+
+    Kernels start in background threads.  When a kernel starts, we record its
+    options, working directory, search path and random number state.  When a
+    kernel comes back to the pool with :meth:`release`, we reset its state,
+    restoring the recorded state, and check that the reset worked; kernels
+    that have died, or that we cannot reset, get replaced with a fresh kernel.
+
+    Examples
+    --------
+    >>> pool = KernelPool("ir", 2)
+    >>> with pool.kernel() as rk:
+    ...     outputs = rk.run_code('a = 1\na')
+    >>> outputs[0]['content']
+    '[1] 1'
+    >>> pool.shutdown()
+    """
+
+    # Code to record kernel state, run on kernel start.  We store the state
+    # outside the global environment, so the reset does not remove it.
+    snapshot_code = """\
+assign('.rnbgrader_state', list(
+    options = options(),
+    wd = getwd(),
+    search = search(),
+    seed = get0('.Random.seed', envir = globalenv(), inherits = FALSE)),
+  envir = baseenv())"""
+    # Code to clear kernel state, run on kernel return to pool.
+    reset_code = """\
+rm(list = ls(all.names = TRUE, envir = globalenv()), envir = globalenv())
+graphics.off()
+local({
+  state <- get('.rnbgrader_state', envir = baseenv())
+  for (name in rev(setdiff(search(), state$search))) {
+    try(detach(pos = match(name, search())), silent = TRUE)
+  }
+  added <- setdiff(names(options()), names(state$options))
+  options(setNames(vector('list', length(added)), added))
+  options(state$options)
+  setwd(state$wd)
+  if (!is.null(state$seed)) assign('.Random.seed', state$seed, globalenv())
+})"""
+    # Code to check kernel state after reset.
+    check_code = """\
+local({
+  state <- get('.rnbgrader_state', envir = baseenv())
+  seed <- get0('.Random.seed', envir = globalenv(), inherits = FALSE)
+  length(setdiff(ls(all.names = TRUE, envir = globalenv()),
+                 '.Random.seed')) == 0 &&
+    identical(options(), state$options) &&
+    identical(getwd(), state$wd) &&
+    identical(search(), state$search) &&
+    identical(seed, state$seed)
+})"""
+    # Expected output contents from `check_code` for clean kernel.
+    check_output = '[1] TRUE'
+
+    def __init__(self, kernel_name='ir', n_kernels=2,
+                 timeout=DEFAULT_TIMEOUT, **kwargs):
+        r""" Initialize pool, start kernels in background
+
+        Parameters
+        ----------
+        kernel_name : str, optional
+            Name of kernel.  For R, this is likely to be "ir".
+        n_kernels : int, optional
+            Number of kernels to keep running in the pool.
+        timeout : float, optional
+            Default timeout in seconds for kernels in pool.
+        \*\*kwargs : dict
+            Arguments to pass to :class:`JupyterKernel`.
+        """
+        self.kernel_name = kernel_name
+        self.n_kernels = n_kernels
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self._executor = ThreadPoolExecutor(max_workers=n_kernels)
+        # Queue of futures, each resolving to a ready kernel.
+        self._ready = Queue()
+        # Set by :meth:`shutdown`; kernels released after are shut down.
+        self._closed = False
+        for i in range(n_kernels):
+            self._ready.put(self._executor.submit(self._start_kernel))
+
+    def _start_kernel(self):
+        kernel = JupyterKernel(self.kernel_name,
+                               timeout=self.timeout,
+                               **self.kwargs)
+        try:
+            kernel.run_code(self.snapshot_code)
+        except BaseException:
+            kernel.shutdown()
+            raise
+        return kernel
+
+    def is_clean(self, kernel):
+        """ True if `kernel` is alive and has clean state
+        """
+        if not kernel.manager.is_alive():
+            return False
+        outputs = kernel.run_code(self.check_code)
+        return (len(outputs) == 1 and
+                outputs[0]['type'] == 'text' and
+                outputs[0]['content'] == self.check_output)
+
+    def _recycle(self, kernel):
+        """ Reset `kernel` and return, or return replacement kernel
+        """
+        try:
+            if kernel.manager.is_alive():
+                kernel.flush_channels()
+                kernel.run_code(self.reset_code)
+                if self.is_clean(kernel):
+                    kernel.reset_output_budget()
+                    return kernel
+        except Exception:
+            # Any failure to reset means we cannot trust the kernel.
+            pass
+        kernel.shutdown()
+        return self._start_kernel()
+
+    def acquire(self):
+        """ Return next ready kernel, waiting for one if necessary
+
+        If the kernel failed to start, start another in its place, so the
+        pool keeps its size, and raise the error.
+        """
+        future = self._ready.get()
+        try:
+            return future.result()
+        except Exception:
+            self._ready.put(self._executor.submit(self._start_kernel))
+            raise
+
+    def release(self, kernel):
+        """ Return `kernel` to pool, for reset or replacement in background
+
+        If the pool has shut down, shut down `kernel` instead.
+        """
+        if not self._closed:
+            try:
+                self._ready.put(self._executor.submit(self._recycle, kernel))
+                return
+            except RuntimeError:  # Pool shut down since the check.
+                pass
+        kernel.shutdown()
+
+    @contextmanager
+    def kernel(self):
+        """ Context manager giving kernel from pool, returned to pool on exit
+        """
+        kernel = self.acquire()
+        try:
+            yield kernel
+        finally:
+            self.release(kernel)
+
+    def shutdown(self):
+        """ Shutdown all kernels in pool """
+        self._closed = True
+        self._executor.shutdown(wait=True)
+        while not self._ready.empty():
+            future = self._ready.get()
+            if future.exception() is None:
+                future.result().shutdown()
 
     def __enter__(self):
         return self
@@ -6,6 +6,12 @@ Extract code chunks from notebook.
 """
 
 import re
+import sys
+import json
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
+from hashlib import sha1
 
 
 def read_file(file_ish, encoding='utf8', errors='replace'):
@@ -33,6 +39,16 @@ def read_file(file_ish, encoding='utf8', errors='replace'):
 
 
 class Chunk(object):
+    """ Code chunk from notebook
+
+    The chunk code can be a string, or a view into a notebook string shared
+    between chunks (see :meth:`from_buffer`).  Views build the code string
+    when asked, so the notebook text is only held once.  Pickling or copying a
+    chunk gives a chunk with its own code string.
+    """
+
+    __slots__ = ('_code', '_buffer', '_start', '_stop', '_hash', 'language',
+                 'start_line', 'end_line', 'classes', 'options', 'id', 'kvs')
 
     def __init__(self, code, language,
                  start_line,
@@ -41,7 +57,7 @@ class Chunk(object):
                  options='',
                  id='',
                  kvs=None):
-        self.code = code
+        self._code, self._buffer, self._hash = code, None, None
         self.language = language
         # line numbers are 0-based.
         self.start_line = start_line
@@ -52,17 +68,192 @@ class Chunk(object):
         self.id = id
         self.kvs = {} if kvs is None else kvs
 
+    @classmethod
+    def from_buffer(cls, buffer, start, stop, language, start_line, end_line,
+                    **kwargs):
+        """ Return chunk with code ``buffer[start:stop]``, as view on `buffer`
+
+        Other parameters as for :meth:`__init__`.
+        """
+        chunk = cls('', language, start_line, end_line, **kwargs)
+        chunk._buffer, chunk._start, chunk._stop = buffer, start, stop
+        return chunk
+
+    @property
+    def code(self):
+        if self._buffer is None:
+            return self._code
+        return self._buffer[self._start:self._stop]
+
+    @code.setter
+    def code(self, code):
+        self._code = code
+        self._buffer = None
+        self._hash = None
+
+    @property
+    def content_hash(self):
+        """ SHA1 hex digest of chunk code, calculated once """
+        if self._hash is None:
+            self._hash = sha1(self.code.encode('utf8', 'surrogateescape')
+                             ).hexdigest()
+        return self._hash
+
+    def _fields(self):
+        return (self.code, self.language, self.start_line, self.end_line,
+                self.classes, self.options, self.id, self.kvs)
+
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Chunk):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (self.__class__, self._fields())
+
+    def __setstate__(self, state):
+        # Pickles from before chunks had slots have the instance dictionary.
+        state = dict(state)
+        self.__init__(state.pop('code'), **state)
+
+    @property
+    def is_evaluated(self):
+        """ False if knitr option ``eval=FALSE`` says not to run the chunk """
+        return self.kvs.get('eval', True) is not False
+
+    @property
+    def is_cached(self):
+        """ True if knitr option ``cache=TRUE`` allows caching the outputs """
+        return self.kvs.get('cache', False) is True
+
+
+# R literals in chunk options, and their Python values.
+R_LITERALS = {'TRUE': True, 'T': True, 'FALSE': False, 'F': False,
+              'NULL': None}
+
+
+def _split_options(options):
+    """ Split chunk header `options` at commas outside strings and brackets
+    """
+    items, start, depth, quote = [], 0, 0, None
+    for i, char in enumerate(options):
+        if quote is not None:
+            if char == quote and options[i - 1] != '\\':
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(options[start:i])
+            start = i + 1
+    items.append(options[start:])
+    return [item.strip() for item in items if item.strip()]
+
+
+def _option_value(value):
+    """ Return Python value for R literal `value`, or `value` string
+
+    Return strings that are not simple literals, such as R expressions,
+    unchanged.
+    """
+    if value in R_LITERALS:
+        return R_LITERALS[value]
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    for converter in (int, float):
+        try:
+            return converter(value[:-1] if value.endswith('L') else value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_options(options):
+    """ Parse knitr chunk header `options` string
+
+    Parameters
+    ----------
+    options : str
+        Chunk header after the language, such as ``setup, include=FALSE``.
+
+    Returns
+    -------
+    id : str
+        Chunk label, from first option without a value, or from ``label``
+        option.  Empty string if no label.
+    kvs : dict
+        Other options, with R literals ``TRUE``, ``FALSE``, ``NULL``, numbers
+        and strings converted to Python values.  Other values, such as R
+        expressions, are strings with the R code.
+    """
+    id, items = _parse_options(options)
+    return id, dict(items)
+
+
+# Chunk headers often repeat, within and across notebooks.
+@lru_cache(maxsize=1024)
+def _parse_options(options):
+    """ Return id and tuple of (key, value) pairs for `options`
+
+    See :func:`parse_options`.
+    """
+    id, items = '', []
+    for i, item in enumerate(_split_options(options)):
+        key, eq, value = item.partition('=')
+        if not eq:
+            if i == 0:
+                id = _option_value(item)
+            continue
+        # Keys repeat across chunks; share one copy of each.
+        key, value = sys.intern(key.strip()), _option_value(value.strip())
+        if key == 'label':
+            id = value
+        else:
+            items.append((key, value))
+    return id, tuple(items)
+
+
+def _make_chunk(code, language, options, start_line, end_line, buffer=None):
+    """ Return :class:`Chunk`, with parsed header `options`
+
+    If `code` is a tuple, it is (start, stop) offsets for a view on string
+    `buffer`.
+    """
+    id, kvs = parse_options(options)
+    language = sys.intern(language)
+    if isinstance(code, tuple):
+        return Chunk.from_buffer(buffer, *code, language, start_line,
+                                 end_line, options=options, id=id, kvs=kvs)
+    return Chunk(code, language, start_line, end_line, options=options,
+                 id=id, kvs=kvs)
 
 
 RMD_HEADER_RE = re.compile(r'^(\s*)```\s*{(\w+)(?:[, ]*)(.*?)}\s*$')
 
+# Mark markup lines in chunks, giving adjustments to the grade.
+MARK_MARKUP_RE = re.compile(r'^\s*#\s*M\s*:\s*([-+]?[.0-9]+)\s*$', re.M)
+
 
-def _parse_chunks(nb_str):
+def _parse_chunks(lines, markups=None, buffer=None):
+    """ Parse chunks from iterable `lines`
+
+    Each element of `lines` is one line of the notebook, with its line ending.
+    We make one pass through `lines`, so `lines` can be an open file.  If
+    `markups` is a list, append the values from mark markup lines in chunks
+    (see ``MARK_MARKUP_RE``).  If `buffer` is not None, it is the string
+    that `lines` came from, and chunks without indent are views on `buffer`.
+    """
     state = 'markdown'
     chunks = []
-    for line_no, line in enumerate(nb_str.splitlines(keepends=True)):
+    offset = 0
+    for line_no, line in enumerate(lines):
+        line_start = offset
+        offset += len(line)
         if state == 'markdown':
             match = RMD_HEADER_RE.match(line)
             if match is not None:
@@ -70,58 +261,431 @@ def _parse_chunks(nb_str):
                 start_line = line_no + 1
                 state = 'chunk'
                 code = []
+                chunk_markups = []
+                code_start = offset
             continue
         elif state == 'chunk':
             if line.rstrip() != indent + '```':
                 if line.startswith(indent):
                     line = line[len(indent):]
-                code.append(line)
+                if buffer is None or indent:
+                    code.append(line)
+                if markups is not None:
+                    chunk_markups += MARK_MARKUP_RE.findall(line)
                 continue
-            chunks.append(Chunk(''.join(code),
-                                language,
-                                start_line,
-                                line_no -1))
+            # Only closed chunks give markups.
+            if markups is not None:
+                markups += chunk_markups
+            if buffer is None or indent:
+                code = ''.join(code)
+            else:
+                code = (code_start, line_start)
+            chunks.append(_make_chunk(code,
+                                      language,
+                                      options,
+                                      start_line,
+                                      line_no -1,
+                                      buffer))
             state = 'markdown'
     return chunks
 
 
+# Header and code of chunk, to closing fence with the same indent.  If there
+# is no closing fence, the "rest" group has the rest of the notebook.
+FENCE_RE = re.compile(r"""
+    ^(?P<indent>[^\S\n]*)```[^\S\n]*
+    \{(?P<language>\w+)[, ]*(?P<options>[^\n]*?)\}[^\S\n]*(?:\n|\Z)
+    (?:(?P<code>.*?)^(?P=indent)```[^\S\n]*$
+    |(?P<rest>.*))
+    """, re.M | re.S | re.X)
+
+# Line separators other than \n, \r\n and \r.  ``str.splitlines`` splits on
+# these, but :data:`FENCE_RE` does not.
+OTHER_SEPS = '\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+
+def _has_other_seps(nb_str):
+    """ True if `nb_str` has line separators other than \\n or \\r\\n """
+    if any(sep in nb_str for sep in OTHER_SEPS):
+        return True
+    # Counting is slow, so only count if there are any \r characters.
+    return '\r' in nb_str and nb_str.count('\r') != nb_str.count('\r\n')
+
+
+def _newline_index(nb_str):
+    """ Return list of offsets of newlines in `nb_str` """
+    offsets = []
+    offset = nb_str.find('\n')
+    while offset != -1:
+        offsets.append(offset)
+        offset = nb_str.find('\n', offset + 1)
+    return offsets
+
+
+def _iter_fences(nb_str):
+    """ Yield :data:`FENCE_RE` matches for chunks in `nb_str`
+
+    Only try the regular expression at the start of lines containing
+    backticks, to skip quickly over long lines without chunks.  Searching for
+    a single backtick is much faster than searching for three.
+    """
+    pos = nb_str.find('`')
+    while pos != -1:
+        if not nb_str.startswith('```', pos):
+            pos = nb_str.find('`', pos + 1)
+            continue
+        match = FENCE_RE.match(nb_str, nb_str.rfind('\n', 0, pos) + 1)
+        if match is None:
+            pos = nb_str.find('`', pos + 3)
+            continue
+        yield match
+        pos = nb_str.find('`', match.end())
+
+
+def _parse_chunks_re(nb_str, views=False):
+    """ Parse chunks from string `nb_str` with regular expression scan
+
+    Gives the same chunks as :func:`_parse_chunks`.  Find fence pairs with
+    :data:`FENCE_RE`, and get line numbers from an index of newline offsets.
+    If `views` is True, chunks without indent are views on `nb_str`.
+    """
+    buffer = nb_str if views else None
+    if _has_other_seps(nb_str):
+        return _parse_chunks(nb_str.splitlines(keepends=True), buffer=buffer)
+    newlines = _newline_index(nb_str)
+    chunks = []
+    for match in _iter_fences(nb_str):
+        if match.group('rest') is not None:  # No closing fence.
+            break
+        indent = match.group('indent')
+        if indent:
+            code = ''.join(
+                line[len(indent):] if line.startswith(indent) else line
+                for line in match.group('code').splitlines(keepends=True))
+        else:
+            code = match.span('code') if views else match.group('code')
+        # Line number of offset is the number of newlines before offset.
+        chunks.append(_make_chunk(code,
+                                  match.group('language'),
+                                  match.group('options'),
+                                  bisect_left(newlines, match.start()) + 1,
+                                  bisect_left(newlines, match.end('code')) - 1,
+                                  buffer))
+    return chunks
+
+
+def _parse_string(nb_str, engine='lines', views=False):
+    """ Return chunks and markups from string `nb_str`, using `engine`
+
+    `engine` is 'lines' for :func:`_parse_chunks` or 'regex' for
+    :func:`_parse_chunks_re`.  The 'regex' engine does not collect markups,
+    and returns None for the markups.  If `views` is True, chunks are views
+    on `nb_str` where possible.
+    """
+    if engine == 'regex':
+        return _parse_chunks_re(nb_str, views), None
+    if engine != 'lines':
+        raise ValueError(f'Unknown parse engine "{engine}"')
+    markups = []
+    return _parse_chunks(nb_str.splitlines(keepends=True), markups,
+                         nb_str if views else None), markups
+
+
+def _split_lines(lines):
+    """ Yield lines from iterable `lines`, split as for ``str.splitlines``
+
+    Iterating over a file splits only at ``\n`` (and at ``\r\n`` or
+    ``\r`` with newline translation); split further, so we get the same lines
+    as for the whole notebook string.
+    """
+    for line in lines:
+        yield from line.splitlines(keepends=True)
+
+
+def _keeping(lines, kept):
+    """ Yield elements of `lines`, appending each to list `kept` """
+    for line in lines:
+        kept.append(line)
+        yield line
+
+
 class RNotebook(object):
     """ Object wrapping R Markdown notebook
 
     Properties: nb_str; chunks
     """
 
-    def __init__(self, nb_str):
+    def __init__(self, nb_str, chunks=None, markups=None, engine='lines'):
         """ Initialize object from string `nb_str`
+
+        Parameters
+        ----------
+        nb_str : None or str
+            Notebook contents.  None means we did not keep the contents; we
+            then need `chunks`.
+        chunks : None or sequence, optional
+            Chunks in notebook.  None means parse chunks from `nb_str`.
+        markups : None or sequence, optional
+            Values of mark markup lines in chunks, as strings.  None means
+            find from chunks.
+        engine : {'lines', 'regex'}, optional
+            Parser to use when parsing chunks from `nb_str`.  'lines' parses
+            line by line; 'regex' scans the whole string with one regular
+            expression.  Both give the same chunks.  Parsed chunks are views
+            on `nb_str`, where possible, so we hold the chunk text only once.
         """
         self.nb_str = nb_str
-        self._chunks = tuple(self._parse_chunks())
+        if chunks is None:
+            chunks, markups = _parse_string(nb_str, engine, views=True)
+        self._chunks = tuple(chunks)
+        self._markups = None if markups is None else tuple(markups)
 
-    def _parse_chunks(self):
-        return _parse_chunks(self.nb_str)
+    @property
+    def markups(self):
+        """ Values of mark markup lines in chunks, as strings """
+        if self._markups is None:
+            self._markups = tuple(m for chunk in self.chunks
+                                  for m in MARK_MARKUP_RE.findall(chunk.code))
+        return self._markups
 
     @property
     def chunks(self):
         return self._chunks
 
     @classmethod
-    def from_string(cls, in_str):
+    def from_string(cls, in_str, keep_str=True, engine='lines'):
         """ Initialize from string `nb_str`, return as Notebook object
+
+        If `keep_str` is False, do not keep `nb_str`; ``nb_str`` is then None,
+        and the chunks have their own code strings.  See :meth:`__init__` for
+        `engine`.
+        """
+        if keep_str:
+            return cls(in_str, engine=engine)
+        return cls(None, *_parse_string(in_str, engine))
+
+    @classmethod
+    def from_lines(cls, lines, keep_str=True):
+        """ Initialize from iterable of `lines`, return as Notebook object
+
+        Parameters
+        ----------
+        lines : iterable
+            Iterable returning lines of notebook, with their line endings,
+            such as an open text file.  We make one pass through `lines`, and
+            split lines as ``str.splitlines`` does for the whole notebook.
+        keep_str : {True, False}, optional
+            If False, do not keep the notebook contents as ``nb_str``, but
+            keep only the chunks.  ``nb_str`` is then None.
         """
-        return cls(in_str)
+        markups = []
+        if not keep_str:
+            return cls(None, _parse_chunks(_split_lines(lines), markups),
+                       markups)
+        kept = []
+        chunks = _parse_chunks(_split_lines(_keeping(lines, kept)), markups)
+        return cls(''.join(kept), chunks, markups)
 
     @classmethod
-    def from_file(cls, file_ish):
+    def from_file(cls, file_ish, keep_str=True):
         """ Initialize from contents of `file_ish`, return as Notebook object
+
+        Parameters
+        ----------
+        file_ish : str or file-like
+            String giving filename or file-like object implementing ``read``
+            method.
+        keep_str : {True, False}, optional
+            If False, parse the notebook in one pass through the lines of the
+            file, keeping only the chunks, and not the notebook contents.
+            ``nb_str`` is then None.
         """
-        return cls.from_string(read_file(file_ish))
+        if keep_str:
+            return cls.from_string(read_file(file_ish))
+        if hasattr(file_ish, 'read'):
+            return cls.from_lines(file_ish, keep_str=False)
+        with open(file_ish, 'rt', encoding='utf8', errors='replace') as fobj:
+            return cls.from_lines(fobj, keep_str=False)
 
     def __eq__(self, other):
         if not hasattr(other, 'nb_str'):
             return False
+        if self.nb_str is None or other.nb_str is None:
+            return self.chunks == other.chunks
         return self.nb_str == other.nb_str
 
 
-load = RNotebook.from_file
+def _parse_cells(nb_dict):
+    """ Return chunks for code cells in Jupyter notebook dict `nb_dict`
+
+    Line numbers for chunks are the indices of the cells in the notebook.
+    """
+    metadata = nb_dict.get('metadata', {})
+    language = (metadata.get('kernelspec', {}).get('language') or
+                metadata.get('language_info', {}).get('name') or
+                'python').lower()
+    chunks = []
+    for cell_no, cell in enumerate(nb_dict.get('cells', [])):
+        if cell['cell_type'] != 'code':
+            continue
+        source = cell['source']
+        code = source if isinstance(source, str) else ''.join(source)
+        # As for chunks in R Markdown, code lines end with a newline.
+        if code and not code.endswith('\n'):
+            code += '\n'
+        chunks.append(Chunk(code, language, cell_no, cell_no))
+    return chunks
+
+
+class IpynbNotebook(RNotebook):
+    """ Jupyter notebook, parsed directly from ``.ipynb`` JSON
+
+    Chunks are the code cells of the notebook, with the notebook kernel
+    language.  The start and end line of each chunk is the index of its cell
+    in the notebook cells.
+
+    Properties: nb_str; chunks
+    """
+
+    def __init__(self, nb_str, chunks=None, markups=None):
+        """ Initialize object from string `nb_str`
+
+        Parameters
+        ----------
+        nb_str : str
+            String containing notebook JSON.
+        chunks : None or sequence, optional
+            Chunks for notebook.  None means parse chunks from `nb_str`.
+        markups : None or sequence, optional
+            Values of mark markup lines in chunks, as strings.  None means
+            find from chunks.
+        """
+        self.nb_str = nb_str
+        if chunks is None:
+            chunks = _parse_cells(json.loads(nb_str))
+        self._chunks = tuple(chunks)
+        self._markups = None if markups is None else tuple(markups)
+
+    @classmethod
+    def from_string(cls, in_str, keep_str=True):
+        """ Initialize from string `nb_str`, return as Notebook object
+
+        If `keep_str` is False, do not keep `nb_str`; ``nb_str`` is then None.
+        """
+        nb = cls(in_str)
+        if not keep_str:
+            nb.nb_str = None
+        return nb
+
+    @classmethod
+    def from_lines(cls, lines, keep_str=True):
+        """ Initialize from iterable of `lines`, return as Notebook object
+        """
+        return cls.from_string(''.join(lines), keep_str)
+
+    @classmethod
+    def from_file(cls, file_ish, keep_str=True):
+        """ Initialize from contents of `file_ish`, return as Notebook object
+        """
+        return cls.from_string(read_file(file_ish), keep_str)
+
+
+def notebook_class(file_ish):
+    """ Return notebook class for filename or file-like `file_ish`
+
+    Return :class:`IpynbNotebook` for filenames ending in ``.ipynb``, and
+    :class:`RNotebook` for other filenames.  For file-like objects without a
+    filename, such as ``StringIO`` objects, return :class:`IpynbNotebook` if
+    the contents start with ``{``, as for notebook JSON, and
+    :class:`RNotebook` otherwise.  We check the contents without changing
+    the file position.
+    """
+    fname = (file_ish if isinstance(file_ish, str)
+             else getattr(file_ish, 'name', None))
+    if isinstance(fname, str):
+        return (IpynbNotebook if fname.lower().endswith('.ipynb')
+                else RNotebook)
+    return IpynbNotebook if _starts_json(file_ish) else RNotebook
+
+
+def _starts_json(fobj):
+    """ True if seekable file-like `fobj` contents start with ``{``
+    """
+    if not (hasattr(fobj, 'seekable') and fobj.seekable()):
+        return False
+    pos = fobj.tell()
+    start = fobj.read(1024)
+    fobj.seek(pos)
+    return start.lstrip().startswith('{')
+
+
+class NotebookCache:
+    """ Cache of parsed notebooks, keyed on hash of notebook contents
+
+    Keep up to `max_size` notebooks, dropping the least recently used.  The
+    cached notebooks do not keep the notebook contents, so ``nb_str`` is None.
+    Notebooks from the cache share their chunks, so do not modify these
+    chunks in place.
+    """
+
+    def __init__(self, max_size=256):
+        """ Initialize notebook cache
+
+        Parameters
+        ----------
+        max_size : int, optional
+            Maximum number of notebooks to keep.
+        """
+        self.max_size = max_size
+        self._store = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, file_ish):
+        """ Return notebook for `file_ish`, from cache if present
+
+        See :func:`notebook_class` for the notebook class.
+        """
+        nb_class = notebook_class(file_ish)
+        return self.loads(read_file(file_ish), nb_class)
+
+    def loads(self, in_str, nb_class=RNotebook):
+        """ Return notebook for string `in_str`, from cache if present
+
+        `nb_class` is the notebook class with which to parse `in_str`.
+        """
+        key = (nb_class.__name__,
+               sha1(in_str.encode('utf8', 'surrogateescape')).hexdigest())
+        if key in self._store:
+            self.hits += 1
+            self._store.move_to_end(key)
+            return self._store[key]
+        self.misses += 1
+        nb = nb_class.from_string(in_str, keep_str=False)
+        self._store[key] = nb
+        if len(self._store) > self.max_size:
+            self._store.popitem(last=False)
+        return nb
+
+    def clear(self):
+        """ Empty cache """
+        self._store.clear()
+
+    def __len__(self):
+        return len(self._store)
+
+
+# Cache to share between grading stages; see ``NBRunner.notebook_cache``.
+NOTEBOOK_CACHE = NotebookCache()
+
+
+def load(file_ish, keep_str=True):
+    """ Load notebook from `file_ish`
+
+    Load filenames ending in ``.ipynb`` as :class:`IpynbNotebook`, and others
+    as :class:`RNotebook`.  See :meth:`RNotebook.from_file` for parameters.
+    """
+    return notebook_class(file_ish).from_file(file_ish, keep_str)
+
 
 loads = RNotebook.from_string
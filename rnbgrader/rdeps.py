@@ -0,0 +1,472 @@
+""" Approximate static dependency analysis for chunks of R code
+
+Find the R symbols each chunk defines and uses, and whether the chunk can
+show output or change state in ways we cannot follow.  Use these to find
+chunks we do not need to run: chunks that show no output, and define nothing
+that later chunks use.
+
+The analysis is approximate, and errs towards running chunks.  It
+over-estimates the symbols that chunks define and use, and it treats a chunk
+as unsure when the chunk refers to functions that work on symbols by name,
+such as ``get`` or ``eval``.  We must run unsure chunks, and all chunks
+before them that define symbols.
+
+The analysis cannot know whether a chunk would give an error, so skipping a
+chunk also skips any error it would have given.
+"""
+
+import re
+
+import pandas as pd
+
+
+TOKEN_RE = re.compile(r"""
+    (?P<comment>\#[^\n]*)
+    |(?P<raw>[rR](?P<q>["'])(?P<dashes>-*)(?P<open>[\[({])
+        .*?[\])}](?P=dashes)(?P=q))
+    |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    |(?P<backtick>`(?:[^`\\]|\\.)*`)
+    |(?P<number>0[xX][0-9a-fA-F]+L?
+        |(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?[Li]?)
+    |(?P<name>(?:[A-Za-z]|\.(?![0-9]))[\w.]*|\.)
+    |(?P<op><<-|->>|<-|->|<=|>=|==|!=|&&|\|\||:::|::|%[^%\n]*%|\|>
+        |[-+*/^~!&|=<>$@:?,;(){}\[\]\\])
+    |(?P<newline>\n)
+    |(?P<space>[ \t\r\f]+)
+    |(?P<other>.)
+    """, re.X | re.S)
+
+RESERVED = {'if', 'else', 'repeat', 'while', 'function', 'for', 'in', 'next',
+            'break', 'TRUE', 'FALSE', 'NULL', 'Inf', 'NaN', 'NA',
+            'NA_integer_', 'NA_real_', 'NA_character_', 'NA_complex_', 'T',
+            'F'}
+
+ASSIGN_LEFT = {'<-', '<<-', '='}
+ASSIGN_RIGHT = {'->', '->>'}
+OPENERS = {'(': ')', '[': ']', '{': '}'}
+CLOSERS = {v: k for k, v in OPENERS.items()}
+# Tokens that can end an expression; a newline after these at the top level
+# ends a statement.
+ENDS_EXPR = {'name', 'number', 'string', 'raw', 'backtick'}
+
+# Functions that work on symbols by name, or on environments.  Chunks
+# referring to these may use or define any symbol.
+UNSURE_NAMES = {
+    'get', 'get0', 'mget', 'exists', 'eval', 'evalq', 'parse', 'source',
+    'sys.source', 'do.call', 'match.fun', 'ls', 'objects', 'environment',
+    'globalenv', 'parent.frame', 'sys.function', 'as.environment', 'local',
+    'with', 'within', 'attach', 'ls.str', 'apropos', 'list2env',
+    'sys.call'}
+
+# Functions changing state other than by assigning symbols, including the
+# random number generator, graphics devices and files.
+SIDE_EFFECT_NAMES = {
+    'library', 'require', 'requireNamespace', 'loadNamespace', 'data',
+    'load', 'assign', 'rm', 'remove', 'set.seed', 'RNGkind', 'sample',
+    'sample.int', 'options', 'par', 'layout', 'setwd', 'sink', 'png', 'pdf',
+    'jpeg', 'bmp', 'tiff', 'svg', 'graphics.off', 'unlink', 'download.file',
+    'install.packages', 'readline', 'ggsave', 'on.exit', 'detach',
+    'Sys.sleep'}
+SIDE_EFFECT_PREFIXES = ('write', 'save', 'dev.', 'Sys.set', 'file.', 'dir.')
+# Random number generators, as in ``rnorm``, ``runif``.
+RNG_RE = re.compile(r'^r(?:norm|unif|binom|pois|t|chisq|gamma|beta|exp|geom|'
+                    r'hyper|logis|lnorm|nbinom|weibull|cauchy|multinom|'
+                    r'signrank|wilcox|f)$')
+
+# Functions showing output, even when not at the top level.
+OUTPUT_NAMES = {
+    'print', 'cat', 'message', 'warning', 'stop', 'str', 'show', 'View',
+    'writeLines', 'format.print', 'hist', 'barplot', 'boxplot', 'lines',
+    'points', 'abline', 'curve', 'pie', 'image', 'contour', 'persp',
+    'pairs', 'matplot', 'matlines', 'matpoints', 'legend', 'text', 'title',
+    'axis', 'mtext', 'polygon', 'segments', 'arrows', 'rect', 'box',
+    'qqnorm', 'qqline', 'qqplot', 'coplot', 'dotchart', 'stripchart',
+    'mosaicplot', 'heatmap', 'smoothScatter', 'sunflowerplot', 'symbols',
+    'stars', 'grid.draw', 'browser', 'stopifnot', 'print.default'}
+OUTPUT_PREFIXES = ('plot', 'print')
+
+# Calls that return invisibly at the top level.
+INVISIBLE_CALLS = {'invisible', 'library', 'require', 'set.seed', 'rm',
+                   'suppressPackageStartupMessages'}
+
+
+class ChunkDeps:
+    """ Symbols a chunk defines and uses, and other effects of the chunk
+
+    Attributes
+    ----------
+    defines : set
+        Symbols the chunk may define or modify.
+    uses : set
+        Symbols the chunk may read.
+    calls : set
+        Names of functions the chunk calls.
+    shows_output : bool
+        True if the chunk may show output.
+    side_effects : bool
+        True if the chunk may change state other than by defining symbols.
+    sure : bool
+        False if the analysis could not follow the chunk, so the chunk may
+        use or define any symbol.
+    """
+
+    def __init__(self, defines=(), uses=(), calls=(), shows_output=False,
+                 side_effects=False, sure=True):
+        self.defines = set(defines)
+        self.uses = set(uses)
+        self.calls = set(calls)
+        self.shows_output = shows_output
+        self.side_effects = side_effects
+        self.sure = sure
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(defines={sorted(self.defines)}, '
+                f'uses={sorted(self.uses)}, '
+                f'shows_output={self.shows_output}, '
+                f'side_effects={self.side_effects}, sure={self.sure})')
+
+
+def tokenize(code):
+    """ Return list of (kind, text) tokens for R `code`
+
+    Drop comments and spaces, but keep newlines.
+    """
+    tokens = []
+    for match in TOKEN_RE.finditer(code):
+        kind = match.lastgroup
+        if kind in ('q', 'dashes', 'open'):  # Inner groups of raw string.
+            kind = 'raw'
+        if kind in ('comment', 'space'):
+            continue
+        tokens.append((kind, match.group()))
+    return tokens
+
+
+def _match_brackets(tokens):
+    """ Return dict mapping bracket token indices to matching indices
+
+    Return None if the brackets do not match.
+    """
+    matches = {}
+    stack = []
+    for i, (kind, text) in enumerate(tokens):
+        if kind != 'op':
+            continue
+        if text in OPENERS:
+            stack.append(i)
+        elif text in CLOSERS:
+            if not stack or tokens[stack[-1]][1] != CLOSERS[text]:
+                return None
+            j = stack.pop()
+            matches[i], matches[j] = j, i
+    return None if stack else matches
+
+
+def _symbol(kind, text):
+    """ Symbol name for name, backtick or string token, else None """
+    if kind == 'name':
+        return None if text in RESERVED else text
+    if kind in ('backtick', 'string'):
+        return text[1:-1]
+    return None
+
+
+def _is_member(tokens, i):
+    """ True if token `i` comes after ``$`` or ``@`` """
+    return i > 0 and tokens[i - 1] in (('op', '$'), ('op', '@'))
+
+
+def _lhs_start(tokens, i, matches):
+    """ Index of first token of assignment target ending before token `i`
+    """
+    j = i - 1
+    while j >= 0:
+        kind, text = tokens[j]
+        if kind == 'op' and text in CLOSERS:
+            j = matches[j] - 1
+        elif (kind in ('name', 'backtick', 'string') and
+              text not in RESERVED):
+            j -= 1
+        elif kind == 'op' and text in ('$', '@', '::', ':::'):
+            j -= 1
+        else:
+            break
+    return j + 1
+
+
+def _rhs_stop(tokens, i, matches):
+    """ Index after last token of assignment target starting after token `i`
+    """
+    j = i + 1
+    while j < len(tokens):
+        kind, text = tokens[j]
+        if kind == 'op' and text in OPENERS:
+            j = matches[j] + 1
+        elif (kind in ('name', 'backtick', 'string') and
+              text not in RESERVED):
+            j += 1
+        elif kind == 'op' and text in ('$', '@', '::', ':::'):
+            j += 1
+        else:
+            break
+    return j
+
+
+def _inner_brackets(tokens, matches):
+    """ List giving innermost open bracket for each token, or None """
+    inner = []
+    stack = []
+    for i, (kind, text) in enumerate(tokens):
+        if kind == 'op' and text in CLOSERS:
+            stack.pop()
+        inner.append(stack[-1] if stack else None)
+        if kind == 'op' and text in OPENERS:
+            stack.append(text)
+    return inner
+
+
+def _is_side_effect(name):
+    return (name in SIDE_EFFECT_NAMES or
+            name.startswith(SIDE_EFFECT_PREFIXES) or
+            RNG_RE.match(name) is not None)
+
+
+def _is_output(name):
+    return name in OUTPUT_NAMES or name.startswith(OUTPUT_PREFIXES)
+
+
+def _statements(tokens):
+    """ Split `tokens` into lists of top-level statement tokens
+    """
+    statements = []
+    current = []
+    depth = 0
+    for kind, text in tokens:
+        if kind == 'op' and text in OPENERS:
+            depth += 1
+        elif kind == 'op' and text in CLOSERS:
+            depth -= 1
+        if depth == 0 and (text == ';' or kind == 'newline'):
+            last = current[-1] if current else None
+            if text == ';' or last is None or (
+                last[0] in ENDS_EXPR or last[1] in CLOSERS):
+                if current:
+                    statements.append(current)
+                current = []
+            continue
+        if kind != 'newline':
+            current.append((kind, text))
+    if current:
+        statements.append(current)
+    return statements
+
+
+def _statement_visible(statement):
+    """ True if top-level `statement` may show its value """
+    kind, text = statement[0]
+    if text in ('if', 'for', 'while', 'repeat', '{'):  # Could show anything.
+        return True
+    depth = 0
+    for kind, text in statement:
+        if kind == 'op' and text in OPENERS:
+            depth += 1
+        elif kind == 'op' and text in CLOSERS:
+            depth -= 1
+        elif depth == 0 and kind == 'op' and (
+            text in ASSIGN_LEFT or text in ASSIGN_RIGHT):
+            return False
+    kind, text = statement[0]
+    if (kind == 'name' and text in INVISIBLE_CALLS and len(statement) > 1 and
+        statement[1] == ('op', '(')):
+        return False
+    return True
+
+
+def _assignments(tokens, matches, inner):
+    """ Return list of token index ranges giving assignment targets """
+    spans = []
+    for i, (kind, text) in enumerate(tokens):
+        if kind != 'op':
+            continue
+        if text in ('<-', '<<-') or text == '=' and inner[i] in (None, '{'):
+            spans.append(range(_lhs_start(tokens, i, matches), i))
+        elif text in ASSIGN_RIGHT:
+            spans.append(range(i + 1, _rhs_stop(tokens, i, matches)))
+    return spans
+
+
+def analyze_code(code):
+    """ Return :class:`ChunkDeps` for string of R `code`
+    """
+    tokens = tokenize(code)
+    matches = _match_brackets(tokens)
+    if matches is None or any(kind == 'other' for kind, _ in tokens):
+        return ChunkDeps(shows_output=True, side_effects=True, sure=False)
+    inner = _inner_brackets(tokens, matches)
+    deps = ChunkDeps()
+    targets = set()
+    for span in _assignments(tokens, matches, inner):
+        names = {_symbol(*tokens[j]) for j in span
+                 if not _is_member(tokens, j)} - {None}
+        deps.defines |= names
+        if len(span) == 1:  # Plain assignment to symbol.
+            targets.update(span)
+        else:  # Modifying existing object; also uses the object.
+            deps.uses |= names
+    for i, (kind, text) in enumerate(tokens):
+        if (i in targets or kind not in ('name', 'backtick') or
+            _is_member(tokens, i)):
+            continue
+        name = _symbol(kind, text)
+        if name is None:
+            continue
+        next_token = tokens[i + 1] if i + 1 < len(tokens) else None
+        if next_token == ('op', '=') and inner[i] == '(':  # Argument name.
+            continue
+        deps.uses.add(name)
+        if name in UNSURE_NAMES:
+            deps.sure = False
+        if next_token != ('op', '('):
+            continue
+        deps.calls.add(name)
+        if _is_side_effect(name):
+            deps.side_effects = True
+        if _is_output(name):
+            deps.shows_output = True
+    if any(_statement_visible(s) for s in _statements(tokens)):
+        deps.shows_output = True
+    if not deps.sure:
+        deps.side_effects = True
+    return deps
+
+
+def chunk_deps(chunk):
+    """ Return :class:`ChunkDeps` for `chunk`
+
+    We cannot analyze chunks in languages other than R.  Chunks with knitr
+    option ``eval=FALSE`` do nothing.
+    """
+    if not chunk.is_evaluated:
+        return ChunkDeps()
+    if chunk.language.lower() != 'r':
+        return ChunkDeps(shows_output=True, side_effects=True, sure=False)
+    return analyze_code(chunk.code)
+
+
+def dead_chunks(chunks, keep=None):
+    """ Return indices of chunks we need not run
+
+    A chunk is dead if it shows no output, has no side effects, and defines
+    no symbol that a later live chunk uses.  Functions the notebook defines
+    can use any symbol, and can have any effect, so a chunk calling one of
+    these functions is live, and keeps all chunks defining symbols before it.
+
+    Parameters
+    ----------
+    chunks : sequence of chunks
+        Notebook code chunk instances.
+    keep : None or callable, optional
+        Callable accepting a chunk, returning True if we must run the chunk.
+
+    Returns
+    -------
+    dead : list of int
+        Indices into `chunks` of chunks we need not run.
+    """
+    all_deps = [chunk_deps(chunk) for chunk in chunks]
+    notebook_defines = set().union(*(d.defines for d in all_deps))
+    needed = set()
+    needs_all = False
+    dead = []
+    for i in range(len(chunks) - 1, -1, -1):
+        deps = all_deps[i]
+        calls_notebook = bool(deps.calls & notebook_defines)
+        live = (deps.shows_output or
+                deps.side_effects or
+                calls_notebook or
+                (keep is not None and keep(chunks[i])) or
+                (bool(deps.defines) and needs_all) or
+                bool(deps.defines & needed))
+        if not live:
+            dead.append(i)
+            continue
+        needed |= deps.uses
+        needs_all = needs_all or not deps.sure or calls_notebook
+    return dead[::-1]
+
+
+def needed_chunks(chunks, targets, candidates=None):
+    """ Return indices of chunks to run, so chunks at `targets` can run
+
+    A candidate chunk before a needed chunk is needed if it defines a symbol
+    that a later needed chunk uses, or if it may change state in ways we
+    cannot follow.  As for :func:`dead_chunks`, a needed chunk calling a
+    function the notebook defines needs all chunks defining symbols before
+    it.
+
+    Parameters
+    ----------
+    chunks : sequence of chunks
+        Notebook code chunk instances.
+    targets : sequence of int
+        Indices into `chunks` of chunks we must run.
+    candidates : None or sequence of int, optional
+        Indices into `chunks` of chunks we can run to satisfy `targets`, for
+        example, chunks we have not yet run.  None means all chunks.
+
+    Returns
+    -------
+    needed : list of int
+        Sorted indices into `chunks` of `targets`, and of the candidate
+        chunks they need.
+    """
+    all_deps = [chunk_deps(chunk) for chunk in chunks]
+    notebook_defines = set().union(*(d.defines for d in all_deps))
+    targets = set(targets)
+    candidates = (set(range(len(chunks))) if candidates is None
+                  else set(candidates))
+    needed_symbols = set()
+    needs_all = False
+    needed = []
+    for i in range(max(targets, default=-1), -1, -1):
+        deps = all_deps[i]
+        calls_notebook = bool(deps.calls & notebook_defines)
+        if i not in targets:
+            if i not in candidates:
+                continue
+            if not (deps.side_effects or
+                    calls_notebook or
+                    (bool(deps.defines) and needs_all) or
+                    bool(deps.defines & needed_symbols)):
+                continue
+        needed.append(i)
+        needed_symbols |= deps.uses
+        needs_all = needs_all or not deps.sure or calls_notebook
+    return needed[::-1]
+
+
+def dead_chunk_report(chunks, dead):
+    """ Report on dead chunks
+
+    Parameters
+    ----------
+    chunks : sequence of chunks
+        Notebook code chunk instances.
+    dead : sequence of int
+        Indices into `chunks` of dead chunks, as from :func:`dead_chunks`.
+
+    Returns
+    -------
+    report : DataFrame
+        One row per dead chunk, with columns "index" (index of chunk),
+        "start_line" (0-based first line of chunk code), "defines" (sorted
+        symbols the chunk defines, separated by spaces) and "code".
+    """
+    rows = []
+    for i in dead:
+        chunk = chunks[i]
+        rows.append((i, chunk.start_line,
+                     ' '.join(sorted(chunk_deps(chunk).defines)),
+                     chunk.code))
+    return pd.DataFrame(rows,
+                        columns=['index', 'start_line', 'defines', 'code'])
@@ -3,7 +3,14 @@
 
 import re
 
-from rnbgrader.answers import raw2regex
+import numpy as np
+from numpy.testing import assert_array_equal
+from PIL import Image
+
+from rnbgrader.chunkrunner import EvaluatedChunk
+from rnbgrader.answers import (raw2regex, Answer, TextAnswer, RegexAnswer,
+                               RawRegexAnswer, StrippedTextAnswer, ImgAnswer,
+                               BestOf)
 
 
 def test_raw2regex():
@@ -12,3 +19,70 @@ def test_raw2regex():
     assert re.search(raw2regex(raw), raw)
 
 
+def _same_marks(answer, ev_chunks):
+    expected = [answer(ev_chunk) for ev_chunk in ev_chunks]
+    assert_array_equal(answer.grade_many(ev_chunks), expected)
+    return expected
+
+
+def test_grade_many():
+    rng = np.random.default_rng(42)
+    img = Image.fromarray(rng.integers(0, 255, (20, 30, 3), dtype=np.uint8))
+    other = Image.fromarray(
+        rng.integers(0, 255, (20, 30, 3), dtype=np.uint8))
+    ev_chunks = [EvaluatedChunk(None, [dict(type=t, content=c)
+                                       for t, c in results])
+                 for results in (
+                     [('text', '[1] 10')],
+                     [('stdout', 'a'), ('text', '[1]  10 ')],
+                     [('image', other), ('image', img)],
+                     [('image', other), ('error', '[1] 10')],
+                     [])]
+    ev_chunks.append(EvaluatedChunk(None))
+    assert _same_marks(TextAnswer(2, '[1] 10'), ev_chunks)[:5] == [
+        2, 0, 0, 0, 0]
+    assert _same_marks(TextAnswer(2, '[1]  10', strip=True),
+                       ev_chunks)[:5] == [0, 2, 0, 0, 0]
+    _same_marks(RegexAnswer(3, r'\s10'), ev_chunks)
+    _same_marks(RawRegexAnswer(3, '[1] 10'), ev_chunks)
+    _same_marks(StrippedTextAnswer(3, '[1] 10'), ev_chunks)
+    assert _same_marks(ImgAnswer(4, img), ev_chunks)[:5] == [0, 0, 4, 0, 0]
+    _same_marks(ImgAnswer(4, img, (5, 5, 15, 15)), ev_chunks)
+    _same_marks(BestOf([TextAnswer(2, '[1] 10'), ImgAnswer(4, img)]),
+                ev_chunks)
+    _same_marks(Answer(1, lambda ev: len(ev.results)), ev_chunks)
+    assert len(Answer(1, len).grade_many([])) == 0
+
+    # Overridden tester is still used.
+    class MyText(TextAnswer):
+
+        def tester(self, result):
+            return self.mark if result['type'] == 'stdout' else 0
+
+    assert _same_marks(MyText(1, ''), ev_chunks)[:2] == [0, 1]
+
+    # As is an overridden call.
+    class MyCall(TextAnswer):
+
+        def __call__(self, ev_chunk):
+            return 5
+
+    assert list(MyCall(1, '[1] 10').grade_many(ev_chunks)) == [5] * 6
+
+    # And overridden _grade.
+    class MyGrade(TextAnswer):
+
+        def _grade(self, ev_chunk):
+            return 7
+
+    class MyImgGrade(ImgAnswer):
+
+        def _grade(self, ev_chunk):
+            return 7
+
+    assert _same_marks(MyGrade(1, '[1] 10'), ev_chunks)[:2] == [7, 7]
+    assert _same_marks(MyImgGrade(1, img), ev_chunks)[:2] == [7, 7]
+
+    # Negative marks are never given.
+    assert _same_marks(TextAnswer(-1, '[1] 10'), ev_chunks)[:2] == [0, 0]
+    assert _same_marks(ImgAnswer(-1, img), ev_chunks)[:3] == [0, 0, 0]
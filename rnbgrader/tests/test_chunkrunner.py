@@ -2,9 +2,13 @@
 """
 
 from os.path import dirname, join as pjoin
+import asyncio
+import pickle
+import sys
 
 from rnbgrader import ChunkRunner, load, loads
-from rnbgrader.chunkrunner import EvaluatedChunk
+from rnbgrader.chunkrunner import (EvaluatedChunk, AsyncChunkRunner,
+                                   ChunkCache, ChunkJournal)
 
 DATA_DIR = pjoin(dirname(__file__), 'data')
 DEFAULT_NB = pjoin(DATA_DIR, 'default.Rmd')
@@ -40,3 +44,289 @@ b
     assert runner.results[1] == EvaluatedChunk(nb.chunks[1], None)
     assert runner.outcome == "error"
     assert runner.message.startswith('Errors for chunk at line no 2:\n')
+
+
+def test_async_chunkrunner():
+    nb = loads("""\
+```{r}
+a = 1
+a
+```
+
+```{r}
+b
+```
+
+```{r}
+c = 3
+```
+""")
+
+    async def run_all():
+        runners = [AsyncChunkRunner(nb.chunks) for i in range(3)]
+        assert runners[0].results is None
+        return runners, await asyncio.gather(*[r.execute() for r in runners])
+
+    runners, all_results = asyncio.run(run_all())
+    sync_runner = ChunkRunner(nb.chunks)
+    for runner, results in zip(runners, all_results):
+        assert results == runner.results
+        assert len(results) == 3
+        assert results[0].results[0]['content'] == '[1] 1'
+        assert results[1].results[0]['type'] == 'error'
+        assert results[2] == EvaluatedChunk(nb.chunks[2], None)
+        assert runner.outcome == 'error'
+        assert runner.message == sync_runner.message
+
+
+def _contents(ev_chunks):
+    return [None if e.results is None else
+            [(r['type'], r['content']) for r in e.results]
+            for e in ev_chunks]
+
+
+def test_pipeline():
+    nb = loads(''.join(f"```{{r}}\na{i} = {i}\na{i}\n```\n\n"
+                       for i in range(20)))
+    runner = ChunkRunner(nb.chunks, pipeline=True)
+    assert runner.outcome == 'ok'
+    assert _contents(runner.results) == _contents(
+        ChunkRunner(nb.chunks).results)
+    nb = loads("""\
+```{r}
+a = 1
+a
+```
+
+```{r}
+b
+```
+
+```{r}
+c = 3
+c
+```
+""")
+    for stop_on_error in (True, False):
+        runner = ChunkRunner(nb.chunks, stop_on_error=stop_on_error,
+                             pipeline=True)
+        serial = ChunkRunner(nb.chunks, stop_on_error=stop_on_error)
+        assert _contents(runner.results) == _contents(serial.results)
+        assert runner.outcome == serial.outcome == 'error'
+        assert runner.message == serial.message
+
+
+def test_resource_use():
+    nb = loads("""\
+```{r}
+Sys.sleep(0.5)
+```
+
+```{r}
+x <- sum(as.numeric(1:2e7))
+```
+
+```{r}
+b
+```
+
+```{r}
+c = 3
+```
+""")
+    runner = ChunkRunner(nb.chunks)
+    ev0, ev1, ev2, ev3 = runner.results
+    assert ev0.wall_time >= 0.5
+    for ev in (ev0, ev1, ev2):
+        assert ev.wall_time > 0
+    # Chunk not run.
+    assert ev3.wall_time is None
+    assert ev3 == EvaluatedChunk(nb.chunks[3])
+    assert runner.wall_time == sum(e.wall_time for e in (ev0, ev1, ev2))
+    if sys.platform.startswith('linux'):
+        assert ev1.cpu_time > ev0.cpu_time
+        assert runner.cpu_time >= ev1.cpu_time
+        assert runner.peak_rss == max(e.peak_rss for e in (ev0, ev1, ev2))
+
+
+TEMPLATE = """\
+```{r}
+x <- 10
+cat("loaded\\n")
+```
+
+```{r}
+x * 2
+```
+
+"""
+
+
+def test_prefix_report():
+    nbs = [loads(TEMPLATE + f"```{{r}}\ny <- x + {i}\n```\n")
+           for i in range(3)]
+    nbs.append(loads(TEMPLATE.replace('x * 2', 'x * 3')))
+    report = ChunkCache().prefix_report([nb.chunks for nb in nbs])
+    assert list(report['depth']) == [1, 2]
+    assert list(report['n_notebooks']) == [4, 3]
+    assert report['code'][1] == 'x * 2\n'
+    # Non-deterministic chunks stop the prefix.
+    cache = ChunkCache(deterministic=lambda c: 'x * 2' not in c.code)
+    report = cache.prefix_report([nb.chunks for nb in nbs])
+    assert list(report['depth']) == [1]
+    # Code run before the chunks changes the keys.
+    assert cache.start_key('ir') != cache.start_key('ir', 'x <- 1')
+
+
+def test_chunk_cache(tmp_path):
+    nbs = [loads(TEMPLATE + f"```{{r}}\ny <- x + {i}\ny\n```\n")
+           for i in range(3)]
+    cache = ChunkCache(str(tmp_path), cacheable=lambda c: True)
+    runners = [ChunkRunner(nb.chunks, cache=cache) for nb in nbs]
+    assert [[e.cached for e in r.results] for r in runners] == [
+        [False, False, False],
+        [True, True, False],
+        [True, True, False]]
+    for i, runner in enumerate(runners):
+        assert _contents(runner.results) == [
+            [('stdout', 'loaded\n')],
+            [('text', '[1] 20')],
+            [('text', f'[1] {10 + i}')]]
+    # Cache on disk works for new cache.
+    cache = ChunkCache(str(tmp_path), cacheable=lambda c: True)
+    runner = ChunkRunner(nbs[0].chunks, cache=cache)
+    assert [e.cached for e in runner.results] == [True, True, True]
+
+
+def test_iter_results():
+    nb = loads(''.join(f"```{{r}}\na{i} <- {i}\na{i}\n```\n\n"
+                       for i in range(4)) + "```{r}\nb\n```\n")
+    runner = ChunkRunner(nb.chunks, lazy=True)
+    kernel = runner.get_kernel()
+    # Nothing run yet.
+    assert kernel.run_code('exists("a0")')[0]['content'] == '[1] FALSE'
+    ev_chunks = []
+    for ev_chunk in runner.iter_results():
+        ev_chunks.append(ev_chunk)
+        if len(ev_chunks) == 2:
+            break
+    assert kernel.run_code('exists("a2")')[0]['content'] == '[1] FALSE'
+    # Resumes where we left off.
+    ev_chunks = list(runner.iter_results())
+    assert _contents(ev_chunks)[1:4] == [
+        [('text', '[1] 1')], [('text', '[1] 2')], [('text', '[1] 3')]]
+    assert runner.outcome == 'error'
+    assert tuple(ev_chunks) == runner.results
+    assert list(runner.iter_results()) == ev_chunks
+    # Stop early.
+    runner = ChunkRunner(nb.chunks, lazy=True)
+    next(runner.iter_results())
+    runner.stop()
+    assert [e.results is None for e in runner.results] == [
+        False, True, True, True, True]
+    assert runner.outcome == 'ok'
+    # Run more chunks after stopping.
+    runner.run_chunks([3, 4])
+    assert [e.results is None for e in runner.results] == [
+        False, True, True, False, False]
+    assert _contents(runner.results)[3] == [('text', '[1] 3')]
+    assert runner.outcome == 'error'
+    # Results property runs all chunks.
+    runner = ChunkRunner(nb.chunks, lazy=True)
+    assert len(runner.results) == 5
+    assert runner.outcome == 'error'
+
+
+def test_chunk_journal_load(tmp_path):
+    nb = loads(''.join(f"```{{r}}\na{i} <- {i}\n```\n\n" for i in range(3)))
+    journal = ChunkJournal(str(tmp_path / 'journal'))
+    key = journal.key(nb.chunks, 'ir')
+    assert key != journal.key(nb.chunks[:2], 'ir')
+    assert key != journal.key(nb.chunks, 'python3')
+    # Changing chunk options changes key.
+    nb2 = loads(''.join(f"```{{r, eval={i != 1}}}\na{i} <- {i}\n```\n\n"
+                        for i in range(3)))
+    assert key != journal.key(nb2.chunks, 'ir')
+    assert journal.load(key) == ([], None, False)
+    ev_chunks = [EvaluatedChunk(c, [dict(type='text', content=str(i))])
+                 for i, c in enumerate(nb.chunks)]
+    journal.start(key, 0)
+    assert journal.load(key) == ([], 0, False)
+    journal.add(key, 0, ev_chunks[0])
+    journal.start(key, 1)
+    journal.add(key, 1, ev_chunks[1])
+    journal.start(key, 2)
+    assert journal.load(key) == (ev_chunks[:2], 2, False)
+    # Truncated record, as from crash during write.
+    journal.add(key, 2, ev_chunks[2])
+    with open(journal._fname(key), 'ab') as fobj:
+        fobj.write(pickle.dumps(('done', 3, ev_chunks[0]))[:-3])
+    assert journal.load(key) == (ev_chunks, None, False)
+    journal.clear(key)
+    assert journal.load(key) == ([], None, False)
+    for i, ev_chunk in enumerate(ev_chunks):
+        journal.add(key, i, ev_chunk)
+    journal.finish(key)
+    assert journal.load(key) == (ev_chunks, None, True)
+
+
+def test_chunk_journal(tmp_path):
+    nb = loads(TEMPLATE + "```{r}\ny <- x + 1\ny\n```\n")
+    journal = ChunkJournal(str(tmp_path))
+    key = journal.key(nb.chunks, 'ir')
+    # Simulate run that died in second chunk.
+    runner = ChunkRunner(nb.chunks, journal=journal, lazy=True)
+    next(runner.iter_results())
+    journal.start(key, 1)
+    runner = ChunkRunner(nb.chunks, journal=journal)
+    assert runner.n_resumed == 1
+    assert runner.died_at == 1
+    assert [e.resumed for e in runner.results] == [True, False, False]
+    # Kernel state restored for chunks after resumed chunks.
+    assert _contents(runner.results) == [
+        [('stdout', 'loaded\n')],
+        [('text', '[1] 20')],
+        [('text', '[1] 11')]]
+    # Finished run reloads all chunks.
+    runner = ChunkRunner(nb.chunks, journal=journal)
+    assert runner.n_resumed == 3
+    assert runner.died_at is None
+    assert [e.resumed for e in runner.results] == [True, True, True]
+    assert _contents(runner.results)[2] == [('text', '[1] 11')]
+    assert runner.get_kernel().run_code('y')[0]['content'] == '[1] 11'
+    # Stopped run does not journal chunks it did not run.
+    journal.clear(key)
+    runner = ChunkRunner(nb.chunks, journal=journal, lazy=True)
+    next(runner.iter_results())
+    runner.stop()
+    assert journal.load(key) == (list(runner.results[:1]), None, False)
+    runner = ChunkRunner(nb.chunks, journal=journal)
+    assert runner.n_resumed == 1
+    assert _contents(runner.results)[2] == [('text', '[1] 11')]
+
+
+def test_skip():
+    nb = loads(TEMPLATE + "```{r}\ny <- x + 1\ny\n```\n")
+    runner = ChunkRunner(nb.chunks, skip=[1])
+    assert [e.results is None for e in runner.results] == [False, True, False]
+    assert _contents(runner.results)[2] == [('text', '[1] 11')]
+    assert runner.outcome == 'ok'
+
+
+def test_knitr_options(tmp_path):
+    nb = loads(TEMPLATE.replace('{r}\nx * 2', '{r, eval=FALSE}\nx * 2') +
+               "```{r, cache=TRUE}\ny <- x + 1\ny\n```\n")
+    runner = ChunkRunner(nb.chunks)
+    assert [e.results is None for e in runner.results] == [False, True, False]
+    assert _contents(runner.results)[2] == [('text', '[1] 11')]
+    # By default, cache only chunks with cache=TRUE.
+    cache = ChunkCache(str(tmp_path))
+    runner = ChunkRunner(nb.chunks, cache=cache)
+    assert [e.cached for e in runner.results] == [False, False, False]
+    assert len(list(tmp_path.glob('*.pkl'))) == 1
+    runner = ChunkRunner(nb.chunks, cache=ChunkCache(str(tmp_path)))
+    assert [e.cached for e in runner.results] == [False, False, True]
+    assert _contents(runner.results)[2] == [('text', '[1] 11')]
+    # Pipelined runs also skip eval=FALSE chunks.
+    runner = ChunkRunner(nb.chunks, pipeline=True)
+    assert [e.results is None for e in runner.results] == [False, True, False]
@@ -9,6 +9,7 @@ from glob import glob
 from copy import deepcopy
 
 import numpy as np
+from numpy.testing import assert_array_equal
 
 from rnbgrader import JupyterKernel
 from rnbgrader.grader import (OPTIONAL_PROMPT, MARK_MARKUP_RE, NBRunner,
@@ -86,6 +87,14 @@ def test_get_submissions():
     assert g.get_submissions(pth) == fnames
 
 
+def test_get_submissions_ipynb(tmp_path):
+    for fname in ('a.Rmd', 'a.ipynb', 'b.ipynb', 'c.txt'):
+        (tmp_path / fname).write_text('')
+    # Paired notebooks only graded once, from R Markdown.
+    assert Grader().get_submissions(str(tmp_path)) == [
+        str(tmp_path / 'a.Rmd'), str(tmp_path / 'b.ipynb')]
+
+
 def test_get_submissions_same_id():
     g = CanvasGrader()
     with pytest.raises(CanvasError):
@@ -208,6 +217,69 @@ def test_solutions_with_offsets():
     assert sum(G6().grade_notebook(soln_fname)) == 25
 
 
+def test_kernel_pool():
+    soln_fname = pjoin(DATA, 'solution.Rmd')
+
+    class PoolGrader(CarsGrader):
+        pool_size = 2
+
+    g = PoolGrader()
+    g.start_pool()
+    try:
+        assert sum(g.grade_notebook(soln_fname)) == 50
+        assert sum(g.grade_notebook(
+            pjoin(DATA, 'not_solution.Rmd'))) == 35
+        assert sum(g.grade_notebook(soln_fname)) == 50
+    finally:
+        g.stop_pool()
+    assert g.kernel_pool is None
+
+
+def test_early_exit(tmp_path):
+    with open(pjoin(DATA, 'solution.Rmd'), 'rt') as fobj:
+        soln = fobj.read()
+    # Chunks after the last answer.
+    nb_fname = str(tmp_path / 'extra.Rmd')
+    with open(nb_fname, 'wt') as fobj:
+        fobj.write(soln + """
+```{r}
+extra <- 1
+```
+
+```{r}
+extra_adjust <- 2
+```
+""")
+    runs = []
+
+    class RecordRunner(NBRunner):
+
+        def run(self, fileish, rk, **kwargs):
+            runs.append(super().run(fileish, rk, **kwargs))
+            return runs[-1]
+
+    class EarlyGrader(CarsGrader):
+        run_maker = RecordRunner
+        early_exit = True
+
+    g = EarlyGrader()
+    assert sum(g.grade_notebook(nb_fname)) == 50
+    # Extra chunks not run.
+    assert [e.results is None for e in runs[-1]] == [False] * 8 + [True] * 2
+    assert sum(g.grade_notebook(pjoin(DATA, 'not_solution.Rmd'))) == 35
+    assert all(e.results is not None for e in runs[-1])
+
+    class AdjustGrader(EarlyGrader):
+
+        def adjustment_chunk(self, chunk):
+            return 'extra_adjust' in chunk.code
+
+    g = AdjustGrader()
+    assert sum(g.grade_notebook(nb_fname)) == 50
+    assert [e.results is None for e in runs[-1]] == (
+        [False] * 8 + [True, False])
+
+
 def test_bit_bad():
     # This one has a couple of wrong answers
     assert sum(CARS_GRADER.grade_notebook(
@@ -252,6 +324,52 @@ b
             runner.run(nb, rk)
 
 
+def test_skip_dead_chunks():
+    nb_text = """
+```{r}
+a <- 1
+```
+
+```{r}
+b <- a * 2
+```
+
+```{r}
+a
+```
+"""
+
+    class SkipRunner(NBRunner):
+        skip_dead_chunks = True
+
+    runner = SkipRunner()
+    with JupyterKernel('ir') as rk:
+        ev_chunks = runner.run(StringIO(nb_text), rk)
+        assert rk.run_code('exists("b")')[0]['content'] == '[1] FALSE'
+    assert [e.results is None for e in ev_chunks] == [False, True, False]
+    assert runner.skip_report['index'].tolist() == [1]
+    # Default is to run all chunks.
+    with JupyterKernel('ir') as rk:
+        ev_chunks = NBRunner().run(StringIO(nb_text), rk)
+    assert [e.results is None for e in ev_chunks] == [False, False, False]
+
+
+def test_timeout_error():
+    nb = StringIO("""
+```{r}
+a <- 1
+```
+
+```{r}
+Sys.sleep(100)
+```
+""")
+    runner = NBRunner()
+    with JupyterKernel('ir', timeout=2, watchdog=True) as rk:
+        with pytest.raises(NotebookError):
+            runner.run(nb, rk)
+
+
 def test_mark_markup():
     assert MARK_MARKUP_RE.match('#M: -2.5').groups() == ('-2.5',)
     assert MARK_MARKUP_RE.match('#M:-2.5').groups() == ('-2.5',)
@@ -346,6 +464,23 @@ def test_markup_used():
     assert sum(g.grade_notebook(vr2)) == 40
 
 
+def test_grade_cohort():
+    g = CARS_GRADER
+    pth = pjoin(DATA, 'test_submissions_markup')
+    submissions = g.get_submissions(pth)
+    cohort = g.grade_cohort(submissions)
+    scores = cohort.scores()
+    assert list(scores.index) == submissions
+    assert list(scores.columns) == ['unnamed'] * 7 + ['adjustments',
+                                                      'markups']
+    for submission in submissions:
+        assert (list(scores.loc[submission]) ==
+                list(g.grade_notebook(submission)))
+    assert list(scores.sum(axis=1)) == [80, 40]
+    # Reweighting answers.
+    assert_array_equal(cohort.scores(np.zeros(7)).sum(axis=1), [40, 0])
+
+
 def test_cached_nb_file_like():
     # Test we can used file-likes for notebook caching
     nb_text = """
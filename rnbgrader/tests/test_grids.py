@@ -2,12 +2,17 @@
 """
 
 import numpy as np
+import pandas as pd
 
 from rnbgrader.chunkrunner import EvaluatedChunk
-from rnbgrader.grids import full_grid, max_multi
+from rnbgrader.grids import (full_grid, max_multi, MaxMultiTracker,
+                             output_type_index, CohortGrid)
+from rnbgrader.answers import Answer, BestOf, RegexAnswer, TextAnswer
 
 from numpy.testing import assert_array_equal
 
+import pytest
+
 
 def test_full_grid():
     # Test calculation of grid from results, answers. An answer returns marks
@@ -42,6 +47,92 @@ def test_full_grid():
                                          [0, 12, 0, 0],
                                          [0, 13, 13, 0],
                                          [0, 0, 0, 14]])
+    # Answers with grade_many method grade whole row at once.
+    class Batch:
+
+        def __init__(self):
+            self.calls = 0
+
+        def grade_many(self, evaluated_chunks):
+            self.calls += 1
+            return [len(e.results) for e in evaluated_chunks]
+
+    batch = Batch()
+    ev_chunks[1].results = [2, 2]
+    grid = full_grid([answers[0], batch], ev_chunks)
+    assert_array_equal(grid, [[11, 0, 0, 0], [1, 2, 1, 1]])
+    assert batch.calls == 1
+    # Answer instances give NaN for chunks not run.
+    ev_chunks[3].results = None
+    grid = full_grid([Answer(1, lambda e: 1)], ev_chunks)
+    assert_array_equal(grid, [[1, 1, 1, np.nan]])
+
+
+def _out_chunk(*types):
+    return EvaluatedChunk(None, [dict(type=t, content='1') for t in types])
+
+
+def test_output_type_index():
+    ev_chunks = [_out_chunk('text', 'image', 'text'), EvaluatedChunk(None),
+                 _out_chunk(), _out_chunk('image')]
+    assert output_type_index(ev_chunks) == {'text': [0], 'image': [0, 3]}
+    assert output_type_index([]) == {}
+
+
+class CountAnswer(Answer):
+
+    def __init__(self, output_types):
+        self.output_types = output_types
+        self.graded = []
+
+    def _grade(self, ev_chunk):
+        self.graded.append(ev_chunk)
+        types = {r['type'] for r in ev_chunk.results}
+        return int(self.output_types is None or
+                   not types.isdisjoint(self.output_types))
+
+
+def test_full_grid_output_types():
+    ev_chunks = [_out_chunk('text'), EvaluatedChunk(None), _out_chunk(),
+                 _out_chunk('image', 'stdout'), _out_chunk('image')]
+    image_answer = CountAnswer(frozenset(['image']))
+    any_answer = CountAnswer(None)
+    answers = [image_answer, any_answer, TextAnswer(2, '1'),
+               BestOf([TextAnswer(2, '1'), CountAnswer(frozenset(['html']))])]
+    grid = full_grid(answers, ev_chunks)
+    assert_array_equal(grid, [[0, np.nan, 0, 1, 1],
+                              [1, np.nan, 1, 1, 1],
+                              [2, np.nan, 0, 2, 0],
+                              [2, np.nan, 0, 2, 0]])
+    # Only chunks with accepted output types graded.
+    assert image_answer.graded == ev_chunks[3:]
+    assert len(any_answer.graded) == 4
+    # Same as grading every cell.
+    assert_array_equal(grid, [[a(e) for e in ev_chunks] for a in answers])
+
+
+class ErrorText(TextAnswer):
+
+    def tester(self, result):
+        return self.mark if result['type'] == 'error' else 0
+
+
+class AnyText(RegexAnswer):
+
+    def _test(self, source):
+        return True
+
+
+def test_full_grid_overridden_types():
+    ev_chunks = [_out_chunk('text'), _out_chunk('error')]
+    # Overridden tester can give marks for other output types.
+    answers = [ErrorText(2, '1'), TextAnswer(2, '1')]
+    assert answers[0].output_types is None
+    assert RegexAnswer(2, '1').output_types == {'text', 'stdout'}
+    assert AnyText(2, '1').output_types is None
+    grid = full_grid(answers, ev_chunks)
+    assert_array_equal(grid, [[0, 2], [2, 0]])
+    assert_array_equal(grid, [[a(e) for e in ev_chunks] for a in answers])
 
 
 def test_max_multi():
@@ -55,3 +146,64 @@ def test_max_multi():
                        [0, 6])
     assert_array_equal(max_multi(np.ones((4, 4))), np.ones((4,)))
     assert_array_equal(max_multi(np.ones((4, 4)) + np.nan), np.zeros((4,)))
+
+
+def test_max_multi_tracker():
+    answers = [Answer(2, lambda x : 2 if x.results == [1] else 0),
+               Answer(3, lambda x : x.results[0] if x.results else 0)]
+    ev_chunks = [EvaluatedChunk(*t) for t in (
+        (None, [2]), (None, None), (None, [1]), (None, [3]), (None, [4]))]
+    tracker = MaxMultiTracker(answers)
+    assert not tracker.complete
+    assert [tracker.add(e) for e in ev_chunks[:3]] == [False, False, False]
+    assert_array_equal(tracker.scores, [2, 2])
+    assert tracker.add(ev_chunks[3])
+    assert tracker.complete
+    for i in range(1, 6):
+        tracker = MaxMultiTracker(answers)
+        for e in ev_chunks[:i]:
+            tracker.add(e)
+        assert_array_equal(tracker.scores,
+                           max_multi(full_grid(answers, ev_chunks[:i])))
+    # Answers without mark attribute are never complete.
+    tracker = MaxMultiTracker([lambda x : 1])
+    assert not tracker.add(ev_chunks[0])
+    # BestOf has maximum mark of its answers.
+    best = BestOf([Answer(2, lambda x : 2), Answer(4, lambda x : 0)])
+    assert best.mark == 4
+    tracker = MaxMultiTracker([best])
+    assert not tracker.add(ev_chunks[0])
+
+
+def test_cohort_grid():
+    grids = [np.array([[1, np.nan, 3], [0, 2, np.nan]]),
+             np.array([[np.nan], [5]]),
+             np.zeros((2, 0))]
+    cohort = CohortGrid(grids, ['a', 'b', 'c'], ['q1', 'q2'])
+    assert cohort.grid.shape == (3, 2, 3)
+    assert_array_equal(cohort.n_chunks, [3, 1, 0])
+    assert_array_equal(cohort.grid[1], [[np.nan] * 3, [5, np.nan, np.nan]])
+    scores = cohort.scores()
+    assert list(scores.index) == ['a', 'b', 'c']
+    assert list(scores.columns) == ['q1', 'q2']
+    assert_array_equal(scores, [[3, 2], [0, 5], [0, 0]])
+    for grid, row in zip(grids[:2], scores.values):
+        assert_array_equal(max_multi(grid), row)
+    assert_array_equal(cohort.scores([2, 0.5]), [[6, 1], [0, 2.5], [0, 0]])
+    # Extra columns.
+    cohort = CohortGrid(grids, extras=pd.DataFrame({'adjustments': [1, 2, 3]}))
+    scores = cohort.scores()
+    assert list(scores.columns) == [0, 1, 'adjustments']
+    assert list(scores['adjustments']) == [1, 2, 3]
+    # From answers and evaluated chunks.
+    answers = [Answer(1, lambda e: e.results[0], name='first'),
+               Answer(1, lambda e: len(e.results))]
+    cohort_chunks = [[EvaluatedChunk(None, [4]), EvaluatedChunk(None)],
+                     [EvaluatedChunk(None, [2, 3])]]
+    cohort = CohortGrid.from_evaluated(answers, cohort_chunks)
+    assert list(cohort.scores().columns) == ['first', 'unnamed']
+    assert_array_equal(cohort.scores(), [[4, 1], [2, 2]])
+    # Empty cohort, and mismatched grids.
+    assert CohortGrid([], answer_names=['q1']).scores().shape == (0, 1)
+    with pytest.raises(ValueError):
+        CohortGrid([np.zeros((2, 1)), np.zeros((3, 1))])
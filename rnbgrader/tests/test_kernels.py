@@ -4,10 +4,18 @@
 import os
 import os.path as op
 import re
+import asyncio
+import pickle
+import sys
+from queue import Empty
+from types import SimpleNamespace
 
 import PIL
 
 from rnbgrader import JupyterKernel
+from rnbgrader.kernels import (KernelPool, MessageCollector,
+                               AsyncJupyterKernel, LazyImageOutput, Output,
+                               proc_usage, coalesce_streams, ReplayKernel)
 
 import pytest
 
@@ -93,3 +101,410 @@ def test_kwargs():
         output = _stripped(rk.run_code('getwd()')[0])
         pth = PROMPT_STR_RE.search(output['content']).groups()[0]
         assert op.realpath(pth) == op.realpath(data_path)
+
+
+def test_kernel_pool():
+    with KernelPool('ir', 2) as pool:
+        with pool.kernel() as rk:
+            output, = rk.run_code('a = 1\na')
+            assert _stripped(output) == dict(type='text', content='[1] 1')
+        # Kernel state reset on return to pool.
+        for i in range(3):
+            with pool.kernel() as rk:
+                output, = rk.run_code('a')
+                assert output['type'] == 'error'
+                assert pool.is_clean(rk)
+        # Dead kernels get replaced.
+        with pool.kernel() as rk:
+            rk.manager.shutdown_kernel(now=True)
+            assert not pool.is_clean(rk)
+        for i in range(2):
+            with pool.kernel() as rk:
+                output, = rk.run_code('b = 2\nb')
+                assert _stripped(output) == dict(type='text', content='[1] 2')
+        # Options, working directory, search path and seed restored.
+        with pool.kernel() as rk:
+            rk.run_code('options(digits = 3, rnbgrader.test = 1)\n'
+                        'setwd(tempdir())\n'
+                        'library(tools)\n'
+                        'set.seed(1)')
+            assert not pool.is_clean(rk)
+        for i in range(2):
+            with pool.kernel() as rk:
+                assert pool.is_clean(rk)
+                output, = rk.run_code('pi')
+                assert _stripped(output) == dict(type='text',
+                                                 content='[1] 3.141593')
+
+
+def test_kernel_pool_start_error():
+    with KernelPool('no-such-kernel', 1) as pool:
+        for i in range(2):
+            # Failed kernel replaced with new attempt.
+            with pytest.raises(Exception):
+                pool.acquire()
+        assert pool._ready.qsize() == 1
+
+
+class _StubKernel:
+
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.is_shutdown = False
+        self.manager = self
+
+    def is_alive(self):
+        return self.alive
+
+    def flush_channels(self):
+        raise KeyError('Unexpected failure')
+
+    def shutdown(self):
+        self.is_shutdown = True
+
+
+class _StubPool(KernelPool):
+
+    def _start_kernel(self):
+        return _StubKernel()
+
+
+def test_kernel_pool_recycle_error():
+    with _StubPool('stub', 1) as pool:
+        kernel = pool.acquire()
+        # Any error resetting the kernel gives a replacement.
+        pool.release(kernel)
+        new_kernel = pool.acquire()
+        assert kernel.is_shutdown
+        assert new_kernel is not kernel
+
+
+def test_kernel_pool_release_closed():
+    pool = _StubPool('stub', 1)
+    kernel = pool.acquire()
+    pool.shutdown()
+    # Release after shutdown shuts down the kernel.
+    pool.release(kernel)
+    assert kernel.is_shutdown
+    assert pool._ready.empty()
+
+
+def _msg(msg_type, parent_id, **content):
+    return dict(msg_type=msg_type,
+                header=dict(msg_type=msg_type),
+                parent_header=dict(msg_id=parent_id),
+                content=content)
+
+
+def test_message_collector():
+    collector = MessageCollector('an-id', 'a')
+    assert not collector.done
+    collector.add('iopub', _msg('status', 'an-id', execution_state='busy'))
+    collector.add('iopub', _msg('execute_input', 'an-id', code='a'))
+    output = _msg('stream', 'an-id', name='stdout', text='1')
+    collector.add('iopub', output)
+    collector.add('iopub', _msg('status', 'an-id', execution_state='idle'))
+    assert not collector.done
+    reply = _msg('execute_reply', 'an-id', status='ok')
+    collector.add('shell', reply)
+    assert collector.done
+    assert collector.reply == reply
+    assert collector.output_msgs == [output]
+
+
+def _stream_text(msgs):
+    return ''.join(m['content']['text'] for m in msgs
+                   if m['msg_type'] == 'stream')
+
+
+def test_collector_output_limit(tmp_path):
+    texts = [f'{i:03d}\n' * 10 for i in range(20)]
+    collector = MessageCollector('an-id', output_limit=100,
+                                 spill_dir=str(tmp_path),
+                                 interrupt_limit=500)
+    collector.add('iopub', _msg('display_data', 'an-id', data={}))
+    for text in texts[:10]:
+        collector.add('iopub', _msg('stream', 'an-id', name='stdout',
+                                    text=text))
+    collector.add('iopub', _msg('error', 'an-id', evalue='oops'))
+    assert not collector.flooding
+    for text in texts[10:]:
+        collector.add('iopub', _msg('stream', 'an-id', name='stdout',
+                                    text=text))
+    assert collector.flooding
+    collector.add('iopub', _msg('status', 'an-id', execution_state='idle'))
+    collector.add('shell', _msg('execute_reply', 'an-id', status='ok'))
+    full = ''.join(texts)
+    assert collector.stream_bytes == len(full)
+    assert collector.dropped_bytes == len(full) - 100
+    msgs = collector.output_msgs
+    # Non-stream messages kept.
+    assert [m['msg_type'] for m in msgs if m['msg_type'] != 'stream'] == [
+        'display_data', 'error']
+    out_text = _stream_text(msgs)
+    assert out_text.startswith(full[:50] + '\n[... 700 bytes')
+    assert out_text.endswith(full[-50:])
+    with open(collector.spill_fname, 'rt') as fobj:
+        assert fobj.read() == full
+    # Below limit, output unchanged, no spill file.
+    collector = MessageCollector('an-id', output_limit=len(full),
+                                 spill_dir=str(tmp_path))
+    for text in texts:
+        collector.add('iopub', _msg('stream', 'an-id', name='stdout',
+                                    text=text))
+    collector.add('iopub', _msg('status', 'an-id', execution_state='idle'))
+    collector.add('shell', _msg('execute_reply', 'an-id', status='ok'))
+    assert _stream_text(collector.output_msgs) == full
+    assert collector.spill_fname is None
+    assert len(list(tmp_path.iterdir())) == 1
+    # Output past half the limit, but under the limit, stays one stream.
+    collector = MessageCollector('an-id', output_limit=100,
+                                 spill_dir=str(tmp_path))
+    msg = _msg('stream', 'an-id', name='stdout', text='a' * 60)
+    collector.add('iopub', msg)
+    collector.add('iopub', _msg('status', 'an-id', execution_state='idle'))
+    collector.add('shell', _msg('execute_reply', 'an-id', status='ok'))
+    assert collector.output_msgs == [msg]
+    assert collector.spill_fname is None
+    # Collectors for queued requests share the total limit.
+    budget = SimpleNamespace(total_output_limit=100, output_bytes=10)
+    collectors = [MessageCollector(f'id{i}', budget=budget)
+                  for i in range(3)]
+    for collector in collectors:
+        collector.add('iopub', _msg('stream', collector.msg_id,
+                                    name='stdout', text='a' * 60))
+    assert [c.dropped_bytes for c in collectors] == [0, 30, 60]
+    assert budget.output_bytes == 100
+
+
+def test_collector_flood_finished(tmp_path):
+    # Output over interrupt limit arriving after the code finished.
+    collector = MessageCollector('an-id', output_limit=10,
+                                 interrupt_limit=100)
+    collector.add('iopub', _msg('status', 'an-id', execution_state='idle'))
+    collector.add('iopub', _msg('stream', 'an-id', name='stdout',
+                                text='a' * 200))
+    assert not collector.flooding
+    # Idle is enough to finish after interrupt, if kernel drops reply.
+    collector = MessageCollector('an-id', output_limit=10,
+                                 interrupt_limit=100)
+    collector.add('iopub', _msg('stream', 'an-id', name='stdout',
+                                text='a' * 200))
+    assert collector.flooding
+    collector.interrupted = True
+    collector.add('iopub', _msg('status', 'an-id', execution_state='idle'))
+    assert collector.done
+    assert 'bytes of output truncated' in _stream_text(collector.output_msgs)
+
+
+def test_flood_finished():
+    # Python kernel prints all output before the interrupt arrives.
+    with JupyterKernel('python3', output_limit=100, timeout=10,
+                       watchdog=True) as kernel:
+        for i in range(3):
+            outputs = kernel.run_code('for i in range(1000): print(i)')
+            text = ''.join(o['content'] for o in outputs)
+            assert text.startswith('0\n1\n')
+            assert 'bytes of output truncated' in text
+            output, = kernel.run_code('1 + 1')
+            assert output['content'] == '2'
+
+
+def test_output_limit():
+    with JupyterKernel('ir', output_limit=1000,
+                       total_output_limit=1500) as rk:
+        outputs = rk.run_code('for (i in 1:1000) cat(i, "\n")')
+        text = ''.join(o['content'] for o in outputs)
+        assert text.startswith('1 \n2 \n')
+        assert 'bytes of output truncated' in text
+        assert text.endswith('999 \n1000 \n')
+        assert rk.output_bytes == 1000
+        # Flood gets interrupted.
+        outputs = rk.run_code('while (TRUE) cat("flood\n")', timeout=10)
+        assert rk.output_bytes == 1500
+        rk.reset_output_budget()
+        output, = rk.run_code('a = 1\na')
+        assert _stripped(output) == dict(type='text', content='[1] 1')
+
+
+def test_timeout_recovery(rkernel):
+    with pytest.raises(Empty):
+        rkernel.run_code('Sys.sleep(3)', timeout=1)
+    # Messages from the timed-out request do not leak into the next.
+    output, = rkernel.run_code('a = 1\na', timeout=10)
+    assert _stripped(output) == dict(type='text', content='[1] 1')
+
+
+def test_async_kernel():
+
+    async def run_many(n):
+        kernels = [AsyncJupyterKernel('ir') for i in range(n)]
+        await asyncio.gather(*[k.start() for k in kernels])
+        try:
+            return await asyncio.gather(
+                *[k.run_code(f'a = {i}\na') for i, k in enumerate(kernels)])
+        finally:
+            await asyncio.gather(*[k.shutdown() for k in kernels])
+
+    for i, (output,) in enumerate(asyncio.run(run_many(3))):
+        assert _stripped(output) == dict(type='text', content=f'[1] {i}')
+
+
+def test_lazy_image(rkernel):
+    output, = rkernel.run_code('plot(cars)')
+    assert isinstance(output, LazyImageOutput)
+    assert output.png_bytes.startswith(b'\x89PNG')
+    # Not decoded until first use.
+    assert output._image is None
+    assert 'content' in output
+    img = output.content
+    assert isinstance(img, PIL.PngImagePlugin.PngImageFile)
+    assert output['content'] is img
+    # Pickle keeps compressed bytes, not decoded image.
+    unpickled = pickle.loads(pickle.dumps(output))
+    assert unpickled._image is None
+    assert unpickled.png_bytes == output.png_bytes
+    assert unpickled['content'].size == img.size
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='Needs /proc filesystem')
+def test_proc_usage(rkernel):
+    cpu_time, peak_rss = proc_usage(os.getpid())
+    assert cpu_time > 0
+    assert peak_rss > 0
+    cpu0, rss0 = rkernel.resource_usage()
+    rkernel.run_code('x <- sum(as.numeric(1:2e7))')
+    cpu1, rss1 = rkernel.resource_usage()
+    assert cpu1 > cpu0
+    assert rss1 >= rss0
+
+
+def test_watchdog():
+    with JupyterKernel('ir', timeout=2, watchdog=True) as rk:
+        rk.run_code('a = 1')
+        outputs = rk.run_code('Sys.sleep(100)')
+        assert outputs[-1]['type'] == 'error'
+        assert outputs[-1]['content'].startswith('Timeout')
+        # Kernel still usable, state intact after interrupt.
+        output, = rk.run_code('a')
+        assert _stripped(output) == dict(type='text', content='[1] 1')
+        # Chunks after the interrupted chunk get the full timeout.
+        rk.interrupt_timeout = 1
+        first, second = rk.run_codes(['Sys.sleep(100)', 'Sys.sleep(1.5)\na'],
+                                     stop_on_error=False)
+        assert first[-1]['content'].startswith('Timeout')
+        assert _stripped(second[0]) == dict(type='text', content='[1] 1')
+
+
+def test_output():
+    msg = _msg('stream', 'an-id', name='stdout', text='some text')
+    output = ReplayKernel({})._process_output(msg)
+    assert isinstance(output, Output)
+    assert output['type'] == output.type == 'stdout'
+    assert output['content'] == output.content == 'some text'
+    assert output['message'] is msg
+    assert output == dict(type='stdout', content='some text', message=msg)
+    assert dict(output) == dict(type='stdout', content='some text',
+                                message=msg)
+    with pytest.raises(KeyError):
+        output['foo']
+    assert output.get('foo') is None
+    # Can drop message.
+    del output['message']
+    assert output == dict(type='stdout', content='some text')
+    assert 'message' not in output
+    assert output.get('message') is None
+    # Or not keep it in the first place.
+    dropped = ReplayKernel({}, keep_messages=False)._process_output(msg)
+    assert dropped == output
+    assert dropped.message is None
+    assert pickle.loads(pickle.dumps(dropped)) == dropped
+    assert (len(pickle.dumps(dropped)) <
+            len(pickle.dumps(dict(type='stdout', content='some text',
+                                  message=msg))))
+    # Records have no instance dictionary.
+    assert not hasattr(output, '__dict__')
+
+
+def test_coalesce_streams():
+    outputs = [dict(type='stdout', content='a'),
+               dict(type='stdout', content='b'),
+               dict(type='stderr', content='c'),
+               dict(type='stderr', content='d'),
+               dict(type='text', content='e'),
+               dict(type='text', content='f'),
+               dict(type='stdout', content='g')]
+    assert coalesce_streams(outputs) == [
+        dict(type='stdout', content='ab'),
+        dict(type='stderr', content='cd'),
+        dict(type='text', content='e'),
+        dict(type='text', content='f'),
+        dict(type='stdout', content='g')]
+    assert coalesce_streams([]) == []
+    # Messages merged where present.
+    msgs = [_msg('stream', 'an-id', name='stdout', text=t) for t in 'ab']
+    merged, = coalesce_streams(
+        [dict(type='stdout', content=m['content']['text'], message=m)
+         for m in msgs])
+    assert merged['content'] == 'ab'
+    assert merged['message']['content']['text'] == 'ab'
+    outputs = [Output('stdout', 'a'), Output('stdout', 'b'),
+               Output('text', 'c')]
+    coalesced = coalesce_streams(outputs)
+    assert coalesced == [dict(type='stdout', content='ab'),
+                         dict(type='text', content='c')]
+    assert isinstance(coalesced[0], Output)
+
+
+def test_coalesce():
+    code = 'for (i in 1:3) { cat(i, "\n"); flush(stdout()) }\n1'
+    with JupyterKernel('ir', coalesce=True) as rk:
+        outputs = rk.run_code(code)
+    assert [o['type'] for o in outputs] == ['stdout', 'text']
+    assert outputs[0]['content'] == '1 \n2 \n3 \n'
+    assert outputs[0]['message']['content']['text'] == '1 \n2 \n3 \n'
+
+
+def test_replay_kernel():
+    reply = _msg('execute_reply', 'id1', status='ok')
+    recording = {
+        'a': [(reply, [_msg('stream', 'id1', name='stdout', text='1')],
+               False, False),
+              (reply, [_msg('stream', 'id1', name='stdout', text='2')],
+               False, False)],
+        'b': [(reply, [], True, True)],
+        'c': [(None, [], False, True)]}
+    with ReplayKernel(recording) as kernel:
+        assert _stripped(kernel.run_code('a')[0]) == dict(
+            type='stdout', content='1')
+        assert _stripped(kernel.run_code('a')[0]) == dict(
+            type='stdout', content='2')
+        # Repeats last recording.
+        assert kernel.run_code('a')[0]['content'] == '2'
+        kernel.reset_replay()
+        assert kernel.run_code('a')[0]['content'] == '1'
+        output, = kernel.run_code('b')
+        assert output['type'] == 'error'
+        assert output['content'].startswith('Timeout')
+        # Code not run before restart gives None, as for live kernel.
+        timed_out, not_run = kernel.run_codes(['b', 'c'])
+        assert timed_out[0]['content'].endswith('kernel restarted')
+        assert not_run is None
+        with pytest.raises(KeyError):
+            kernel.run_code('d')
+        with pytest.raises(KeyError):
+            kernel.run_code('d', silent=True)
+
+
+def test_record_replay(tmp_path):
+    codes = ['a = 1', 'a', 'print(a + 1)', 'plot(cars)', 'b']
+    with JupyterKernel('ir', record=True) as rk:
+        expected = [rk.run_code(code) for code in codes]
+        rec_fname = str(tmp_path / 'recording.pkl')
+        rk.save_recording(rec_fname)
+    replay = ReplayKernel(rec_fname)
+    for code, outputs in zip(codes, expected):
+        replayed = replay.run_code(code)
+        assert ([(o['type'], o['message']) for o in replayed] ==
+                [(o['type'], o['message']) for o in outputs])
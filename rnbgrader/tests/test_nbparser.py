@@ -3,8 +3,17 @@
 
 from os.path import dirname, join as pjoin
 from glob import glob
+from hashlib import sha1
+from copy import deepcopy
+from io import StringIO, BytesIO
+import pickle
+import copyreg
 
-from rnbgrader.nbparser import (read_file, load, loads, RMD_HEADER_RE, Chunk)
+import pytest
+
+from rnbgrader.nbparser import (read_file, load, loads, RMD_HEADER_RE, Chunk,
+                                RNotebook, NotebookCache, IpynbNotebook,
+                                parse_options)
 
 
 DATA_DIR = pjoin(dirname(__file__), 'data')
@@ -26,6 +35,7 @@ NB_DEFS = [dict(name='default',
                            )),
           ]
 NB_DEFAULT = pjoin(DATA_DIR, 'default.Rmd')
+PY_IPYNB = pjoin(DATA_DIR, 'py_solution.ipynb')
 ALL_NBS = glob(pjoin(DATA_DIR, '*.Rmd'))
 
 
@@ -46,6 +56,38 @@ def test_load_loads():
         assert nb_direct == nb_via_str
 
 
+def test_streaming():
+    for nb_fname in ALL_NBS:
+        nb = load(nb_fname)
+        streamed = load(nb_fname, keep_str=False)
+        assert streamed.nb_str is None
+        assert streamed.chunks == nb.chunks
+        assert streamed == nb
+        with open(nb_fname, 'rt', encoding='utf8') as fobj:
+            from_fobj = load(fobj, keep_str=False)
+        assert from_fobj.chunks == nb.chunks
+        with open(nb_fname, 'rt', encoding='utf8') as fobj:
+            from_lines = RNotebook.from_lines(fobj)
+        assert from_lines.nb_str == nb.nb_str
+        assert from_lines.chunks == nb.chunks
+    # Any iterable of lines.
+    nb = RNotebook.from_lines(iter(['Text\n', '```{r}\n', 'a = 1\n', '```\n']),
+                              keep_str=False)
+    assert [(c.code, c.start_line, c.end_line) for c in nb.chunks] == [
+        ('a = 1\n', 2, 2)]
+    # Lines split as for the notebook string, whatever the line endings.
+    for sep in ('\r\n', '\r', '\n'):
+        nb_str = sep.join(['Text', '```{r}', 'a = 1\x0cb = 2', '```',
+                           'x\ry', '```{r}', 'c', '```', ''])
+        nb = RNotebook.from_string(nb_str)
+        assert [(c.start_line, c.end_line) for c in nb.chunks] == [
+            (2, 3), (8, 8)]
+        for keep_str in (True, False):
+            from_lines = RNotebook.from_lines(StringIO(nb_str), keep_str)
+            assert from_lines.chunks == nb.chunks
+            assert from_lines.nb_str == (nb_str if keep_str else None)
+
+
 def test_chunks():
     for nb_def in NB_DEFS:
         fname = pjoin(DATA_DIR, nb_def['name'] + '.Rmd')
@@ -70,6 +112,74 @@ def test_chunk():
     chunk3 = Chunk('a = 1', 'python', 10, 13, (), '', '', {})
     assert chunk3.code == 'a = 1'
     assert chunk3.end_line == 13
+    assert not hasattr(chunk, '__dict__')
+    assert chunk.content_hash == sha1(b'a = 1').hexdigest()
+    chunk.code = 'b = 2'
+    assert chunk.content_hash == sha1(b'b = 2').hexdigest()
+    assert chunk != chunk2
+
+
+class OldChunkPickler(pickle.Pickler):
+    """ Pickle chunks as before chunks had slots, with instance dictionary
+    """
+
+    def reducer_override(self, obj):
+        if not isinstance(obj, Chunk):
+            return NotImplemented
+        state = dict(zip(('code', 'language', 'start_line', 'end_line',
+                          'classes', 'options', 'id', 'kvs'),
+                         obj._fields()))
+        return copyreg.__newobj__, (Chunk,), state
+
+
+def test_chunk_views():
+    buffer = 'Text\n```{r}\na = 1\n```\n'
+    chunk = Chunk.from_buffer(buffer, 12, 18, 'r', 2, 2)
+    assert chunk.code == 'a = 1\n'
+    assert chunk == Chunk('a = 1\n', 'r', 2, 2)
+    assert chunk.content_hash == Chunk('a = 1\n', 'r', 2).content_hash
+    # Pickled and copied chunks have their own code.
+    for copied in (pickle.loads(pickle.dumps(chunk)), deepcopy(chunk)):
+        assert copied == chunk
+        assert copied._buffer is None
+    # Pickles from before chunks had slots.
+    fobj = BytesIO()
+    OldChunkPickler(fobj).dump(chunk)
+    assert pickle.loads(fobj.getvalue()) == chunk
+    # Parsed chunks are views on notebook string, unless not keeping string.
+    for engine in ('lines', 'regex'):
+        nb = RNotebook(MARKUP_NB, engine=engine)
+        assert [c._buffer is nb.nb_str for c in nb.chunks] == [True, False]
+        streamed = RNotebook.from_string(MARKUP_NB, False, engine)
+        assert [c._buffer for c in streamed.chunks] == [None, None]
+        assert streamed.chunks == nb.chunks
+
+
+def test_parse_options():
+    assert parse_options('') == ('', {})
+    assert parse_options('setup, include=FALSE') == (
+        'setup', {'include': False})
+    assert parse_options('eval = F, cache=TRUE, x=NULL') == (
+        '', {'eval': False, 'cache': True, 'x': None})
+    assert parse_options('label="a-b", fig.cap="One, two", n=2L, w=3.5') == (
+        'a-b', {'fig.cap': 'One, two', 'n': 2, 'w': 3.5})
+    # R expressions kept as strings.
+    assert parse_options('lab, x=c(1, 2), echo=!is_html') == (
+        'lab', {'x': 'c(1, 2)', 'echo': '!is_html'})
+
+
+def test_chunk_options():
+    nb = load(pjoin(DATA_DIR, 'chunk_options.Rmd'))
+    assert [(c.options, c.id, c.kvs) for c in nb.chunks] == [
+        ('echo=FALSE', '', {'echo': False}),
+        ('', '', {}),
+        ('echo=FALSE', '', {'echo': False})]
+    chunks = loads('```{r a, eval=FALSE}\n```\n'
+                   '```{r, cache=TRUE}\n```\n').chunks
+    assert chunks[0].id == 'a'
+    assert [c.is_evaluated for c in chunks] == [False, True]
+    assert [c.is_cached for c in chunks] == [False, True]
+    assert Chunk('a = 1', 'r', 1).is_evaluated
 
 
 def test_rmd_header_re():
@@ -115,3 +225,123 @@ def test_get_chunks():
 ```
 """
     assert (get_chunks(in_str) == ['# One\n', ''])
+
+
+EDGE_NBS = (
+    '',
+    'Foo ``` not a chunk\n```{r}\na = 1\n```',
+    '```{r}\n```\n```{r}\n\n```\n',
+    '   ```{r}\n   a = 1\n  b = 2\n   ```\n```{r}\nc = 3\n```\n',
+    '```{r}\na = 1\n```\n```{r}\nb = 2\n',
+    '```{r}\r\na = 1\r\n```\r\n',
+    '```{r}\ra = 1\r```\r',
+    '```{r}\x0ca = 1\n```\n',
+    '```{r}\na = 1\n````\n```{r, echo=FALSE}  \nb\n```',
+)
+
+
+def test_regex_engine():
+    nb_strs = [read_file(fname) for fname in ALL_NBS] + list(EDGE_NBS)
+    for nb_str in nb_strs:
+        nb = RNotebook(nb_str, engine='regex')
+        assert nb.chunks == loads(nb_str).chunks
+        assert RNotebook.from_string(nb_str, engine='regex') == nb
+    # Markups found from chunks.
+    assert RNotebook(MARKUP_NB, engine='regex').markups == ('2.0', '-2.5')
+    with pytest.raises(ValueError):
+        RNotebook('', engine='foo')
+
+
+MARKUP_NB = """
+Text
+#M: 10
+
+```{r}
+a <- 1
+# M: 2.0
+```
+
+  ```{r}
+  #M : -2.5
+  b <- 2
+  ```
+"""
+
+
+def test_markups():
+    nb = loads(MARKUP_NB)
+    assert nb.markups == ('2.0', '-2.5')
+    assert RNotebook.from_lines(MARKUP_NB.splitlines(True)).markups == (
+        '2.0', '-2.5')
+    # From chunks.
+    assert RNotebook(None, nb.chunks).markups == ('2.0', '-2.5')
+    assert loads('```{r}\na = 1\n```\n').markups == ()
+    # Unclosed chunks give no markups.
+    unclosed = MARKUP_NB + '```{r}\n#M: 3\nc <- 3\n'
+    for engine in ('lines', 'regex'):
+        assert RNotebook(unclosed, engine=engine).markups == ('2.0', '-2.5')
+    assert RNotebook.from_lines(unclosed.splitlines(True)).markups == (
+        '2.0', '-2.5')
+
+
+def test_notebook_cache():
+    cache = NotebookCache(max_size=2)
+    nb = cache.load(NB_DEFAULT)
+    assert nb.nb_str is None
+    assert nb == load(NB_DEFAULT)
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Same contents, from file object, gives same notebook.
+    with open(NB_DEFAULT, 'rt', encoding='utf8') as fobj:
+        assert cache.load(fobj) is nb
+    assert cache.loads(read_file(NB_DEFAULT)) is nb
+    assert (cache.hits, cache.misses) == (2, 1)
+    markup_nb = cache.loads(MARKUP_NB)
+    assert markup_nb.markups == ('2.0', '-2.5')
+    assert len(cache) == 2
+    # Least recently used dropped.
+    cache.loads('```{r}\na = 1\n```\n')
+    assert len(cache) == 2
+    assert cache.loads(MARKUP_NB) is markup_nb
+    assert cache.load(NB_DEFAULT) is not nb
+    assert cache.misses == 4
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_ipynb():
+    nb = nb_from_file = load(PY_IPYNB)
+    assert isinstance(nb, IpynbNotebook)
+    rmd_nb = load(pjoin(DATA_DIR, 'py_solution.Rmd'))
+    assert len(nb.chunks) == len(rmd_nb.chunks)
+    # Jupytext comments out magics in R Markdown.
+    assert ([c.code.replace('# %matplotlib', '%matplotlib')
+             for c in rmd_nb.chunks] == [c.code for c in nb.chunks])
+    assert all(c.language == 'python' for c in nb.chunks)
+    # Lines are cell indices.
+    assert [(c.start_line, c.end_line) for c in nb.chunks][:2] == [
+        (1, 1), (3, 3)]
+    with open(PY_IPYNB, 'rt', encoding='utf8') as fobj:
+        from_fobj = load(fobj, keep_str=False)
+    assert isinstance(from_fobj, IpynbNotebook)
+    assert from_fobj.nb_str is None
+    assert from_fobj == nb
+    nb = IpynbNotebook.from_string(
+        '{"metadata": {"kernelspec": {"language": "R"}}, "cells": ['
+        '{"cell_type": "markdown", "source": "Text"}, '
+        '{"cell_type": "code", "source": ["a <- 1\\n", "# M: 2"]}]}')
+    assert [(c.code, c.language, c.start_line) for c in nb.chunks] == [
+        ('a <- 1\n# M: 2\n', 'r', 1)]
+    assert nb.markups == ('2',)
+    # Cache parses by file type.
+    cache = NotebookCache()
+    assert cache.load(PY_IPYNB) == load(PY_IPYNB)
+    assert isinstance(cache.load(PY_IPYNB), IpynbNotebook)
+    # File-like objects without names; notebook type from contents.
+    with open(PY_IPYNB, 'rt', encoding='utf8') as fobj:
+        contents = fobj.read()
+    assert load(StringIO(contents)) == nb_from_file
+    assert cache.load(StringIO(contents)) == nb_from_file
+    assert isinstance(load(StringIO(' ' + contents)), IpynbNotebook)
+    rmd_nb = load(StringIO(read_file(pjoin(DATA_DIR, 'py_solution.Rmd'))))
+    assert isinstance(rmd_nb, RNotebook)
+    assert not isinstance(rmd_nb, IpynbNotebook)
@@ -4,6 +4,7 @@
 from os.path import join as pjoin, dirname
 
 from rnbgrader import JupyterKernel
+from rnbgrader.chunkrunner import ChunkCache
 from rnbgrader.grader import NBRunner
 
 DATA = pjoin(dirname(__file__), 'data')
@@ -19,3 +20,37 @@ def test_smoke():
     assert contents[0] is None
     assert contents[1] == "['speed', 'dist']"
     assert contents[2] == '(50, 2)'
+
+
+def test_ipynb():
+    runner = NBRunner()
+    with JupyterKernel('python3', cwd=DATA) as pk:
+        rmd_results = runner.run(pjoin(DATA, 'py_solution.Rmd'), pk)
+    with JupyterKernel('python3', cwd=DATA) as pk:
+        ipynb_results = runner.run(pjoin(DATA, 'py_solution.ipynb'), pk)
+    def contents(results):
+        return [[(o['type'], o['content']) for o in c.results or ()]
+                for c in results]
+
+    assert contents(ipynb_results)[1:] == contents(rmd_results)[1:]
+
+
+class PreRunner(NBRunner):
+
+    pre_code = 'x = 1'
+
+    def pre_run(self, rk):
+        rk.run_code(self.pre_code)
+
+
+def test_pre_run_cache():
+    solution_rmd = pjoin(DATA, 'py_solution.Rmd')
+    runner = PreRunner()
+    runner.chunk_cache = ChunkCache(cacheable=lambda c: True)
+    for pre_code, cached in (('x = 1', False), ('x = 1', True),
+                             ('x = 2', False)):
+        runner.pre_code = pre_code
+        with JupyterKernel('python3', cwd=DATA) as pk:
+            results = runner.run(solution_rmd, pk)
+        # Pre-run code is part of the cache key.
+        assert {c.cached for c in results if c.results} == {cached}
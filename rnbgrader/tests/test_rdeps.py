@@ -0,0 +1,137 @@
+""" Test R dependency analysis
+"""
+
+from rnbgrader import loads
+from rnbgrader.rdeps import (tokenize, analyze_code, chunk_deps, dead_chunks,
+                             dead_chunk_report, needed_chunks)
+
+
+def test_tokenize():
+    assert tokenize('x <- 1 # comment') == [
+        ('name', 'x'), ('op', '<-'), ('number', '1')]
+    assert tokenize('a$b[["c"]]\n') == [
+        ('name', 'a'), ('op', '$'), ('name', 'b'), ('op', '['), ('op', '['),
+        ('string', '"c"'), ('op', ']'), ('op', ']'), ('newline', '\n')]
+    assert tokenize('x %in% .y') == [
+        ('name', 'x'), ('op', '%in%'), ('name', '.y')]
+    assert tokenize('"a # b" -> `c d`') == [
+        ('string', '"a # b"'), ('op', '->'), ('backtick', '`c d`')]
+    assert [k for k, t in tokenize(r'y <- r"(a "b")"')] == [
+        'name', 'op', 'raw']
+
+
+def _summary(code):
+    deps = analyze_code(code)
+    return (deps.defines, deps.uses, deps.shows_output, deps.side_effects,
+            deps.sure)
+
+
+def test_analyze_code():
+    assert _summary('x <- 1') == ({'x'}, set(), False, False, True)
+    assert _summary('x <- y + 1\nz = 2') == (
+        {'x', 'z'}, {'y'}, False, False, True)
+    assert _summary('1 -> q') == ({'q'}, set(), False, False, True)
+    assert _summary('x <- c(1,\n  2)') == ({'x'}, {'c'}, False, False, True)
+    # Modifying an object uses it.
+    assert _summary('x$a <- f(b)') == (
+        {'x'}, {'x', 'f', 'b'}, False, False, True)
+    # Argument names are not uses.
+    assert _summary('y <- f(a = 1)')[:2] == ({'y'}, {'f'})
+    # Visible values show output.
+    assert _summary('x')[2]
+    assert _summary('x <- 1; y')[2]
+    assert _summary('(x <- 5)')[2]
+    assert _summary('if (a) b <- 1 else 3')[2]
+    assert not _summary('library(dplyr)')[2]
+    # Output from calls inside assignments.
+    assert _summary('h <- hist(x)')[2]
+    assert _summary('f <- function() print(1)')[2]
+    # Side effects.
+    assert _summary('x <- rnorm(10)')[3]
+    assert _summary('set.seed(42)')[3]
+    assert _summary('write.csv(d, "out.csv")')[3]
+    # A variable called "data" is not a call to data().
+    assert _summary('data <- read.csv("f.csv")') == (
+        {'data'}, {'read.csv'}, False, False, True)
+    # Chunks we cannot follow.
+    assert _summary('y <- get("x")')[3:] == (True, False)
+    assert _summary('x <- "unterminated')[3:] == (True, False)
+    assert _summary('x <- (1')[3:] == (True, False)
+
+
+def test_chunk_deps():
+    nb = loads('```{r}\nx <- 1\n```\n\n```{python}\nx = 1\n```\n')
+    assert chunk_deps(nb.chunks[0]).sure
+    assert not chunk_deps(nb.chunks[1]).sure
+    # Chunks with eval=FALSE do nothing.
+    nb = loads('```{r, eval=FALSE}\nget("x")\n```\n')
+    assert _summary(nb.chunks[0].code)[3:] == (True, False)
+    deps = chunk_deps(nb.chunks[0])
+    assert (deps.defines, deps.shows_output, deps.sure) == (set(), False, True)
+
+
+def _chunks(*codes):
+    return loads(''.join(f'```{{r}}\n{code}\n```\n\n' for code in codes)
+                ).chunks
+
+
+def test_dead_chunks():
+    chunks = _chunks(
+        'a <- 1',
+        'b <- a * 2',  # Dead; b never used.
+        'c <- a + 1',
+        'c')
+    assert dead_chunks(chunks) == [1]
+    # Keep predicate.
+    assert dead_chunks(chunks, lambda chunk: 'b' in chunk.code) == []
+    # Unused definitions before unused definitions are dead too.
+    chunks = _chunks('a <- 1', 'b <- a', 'd <- 2', 'd')
+    assert dead_chunks(chunks) == [0, 1]
+    # Chunks with output or side effects are live.
+    chunks = _chunks('a <- 1', 'a', 'set.seed(1)', 'b <- 2')
+    assert dead_chunks(chunks) == [3]
+    # Calls to functions defined in notebook are live.
+    chunks = _chunks('f <- function() x <<- 2', 'y <- f()', 'x')
+    assert dead_chunks(chunks) == []
+    # Calls to notebook functions need the symbols the functions use.
+    chunks = _chunks('f <- function(a) a + b', 'b <- 2', 'f(1)')
+    assert dead_chunks(chunks) == []
+    chunks = _chunks('x <- 1', 'g <- function() x', 'x <- 5', 'g()')
+    assert dead_chunks(chunks) == []
+    # A chunk we cannot follow keeps all chunks defining symbols before it.
+    chunks = _chunks('a <- 1', 'b <- 2', 'get("a")', 'c <- 3')
+    assert dead_chunks(chunks) == [3]
+    # Non-R chunks are also unsure.
+    chunks = loads('```{r}\na <- 1\n```\n\n```{python}\nprint(1)\n```\n'
+                  ).chunks
+    assert dead_chunks(chunks) == []
+
+
+def test_needed_chunks():
+    chunks = _chunks(
+        'a <- 1',
+        'b <- a * 2',
+        'c <- 3',
+        'd <- b + 1',
+        'e <- 5')
+    assert needed_chunks(chunks, [3]) == [0, 1, 3]
+    # Only candidates added.
+    assert needed_chunks(chunks, [3], [1, 2, 3, 4]) == [1, 3]
+    assert needed_chunks(chunks, []) == []
+    # Chunks with side effects, or that we cannot follow.
+    chunks = _chunks('library(foo)', 'a <- 1', 'b <- 2', 'get("a")')
+    assert needed_chunks(chunks, [3]) == [0, 1, 2, 3]
+    chunks = _chunks('library(foo)', 'a <- 1', 'b <- 2', 'a')
+    assert needed_chunks(chunks, [3]) == [0, 1, 3]
+    chunks = _chunks('f <- function(a) a + b', 'b <- 2', 'c <- 3', 'f(1)')
+    assert needed_chunks(chunks, [3]) == [0, 1, 2, 3]
+
+
+def test_dead_chunk_report():
+    chunks = _chunks('a <- 1', 'b <- a * 2; d = 3', 'a')
+    report = dead_chunk_report(chunks, dead_chunks(chunks))
+    assert list(report.columns) == ['index', 'start_line', 'defines', 'code']
+    assert report['index'].tolist() == [1]
+    assert report['start_line'].tolist() == [chunks[1].start_line]
+    assert report['defines'].tolist() == ['b d']
+    assert len(dead_chunk_report(chunks, [])) == 0